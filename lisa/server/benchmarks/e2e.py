@@ -0,0 +1,291 @@
+# -*- coding: UTF-8 -*-
+#-----------------------------------------------------------------------------
+# project     : Lisa server
+# module      : benchmarks
+# file        : e2e.py
+# description : End-to-end latency benchmark of the line protocol
+# author      : G.Dumee
+#-----------------------------------------------------------------------------
+# copyright   : Neotique
+#-----------------------------------------------------------------------------
+"""
+Drive simulated clients against a local server, over TCP or TLS
+
+The server runs in this process with an in-memory database, a local Wit
+stand-in and a synthetic echo plugin. Each phase is measured from the client
+side, from the request line to the expected answer line :
+    login : login req => login ack
+    chat : utterance => plugin speech
+    ask : utterance => question
+    answer : answer => plugin speech
+    broadcast : utterance of one client => speech received by every client
+
+Results are written as JSON : throughput and latency percentiles per phase.
+
+Usage : python -m lisa.server.benchmarks.e2e [--clients N] [--zones M] [--messages K] [--tls] [--output file]
+"""
+
+
+#-----------------------------------------------------------------------------
+# Imports
+#-----------------------------------------------------------------------------
+import sys, json, time
+from twisted.internet import reactor, defer, ssl
+from twisted.internet.protocol import ClientFactory as TwistedClientFactory
+from twisted.protocols.basic import LineReceiver
+from twisted.python import usage, log
+from twisted.web import server
+from lisa.server.benchmarks import fixtures
+
+
+#-----------------------------------------------------------------------------
+# Options
+#-----------------------------------------------------------------------------
+class Options(usage.Options):
+    optParameters = [
+        ['clients', 'c', 20, "Number of simulated clients", int],
+        ['zones', 'z', 4, "Number of zones", int],
+        ['messages', 'm', 20, "Number of chat messages per client", int],
+        ['questions', 'q', 5, "Number of questions per client", int],
+        ['broadcasts', 'b', 10, "Number of broadcasts", int],
+        ['cert', None, None, "TLS certificate, default is server 'lisa_ssl_crt'"],
+        ['key', None, None, "TLS private key, default is server 'lisa_ssl_key'"],
+        ['output', 'o', None, "JSON results file, default is standard output"],
+    ]
+    optFlags = [
+        ['tls', 't', "Use TLS connections"],
+        ['verbose', 'v', "Show server logs"],
+    ]
+
+
+#-----------------------------------------------------------------------------
+# BenchClient
+#-----------------------------------------------------------------------------
+class BenchClient(LineReceiver):
+    """
+    Simulated client : sends lines, waits for expected answers
+    """
+
+    #-----------------------------------------------------------------------------
+    def __init__(self, name, zone):
+        self.name = name
+        self.zone = zone
+        self.connected_d = defer.Deferred()
+
+        # Waited answers : list of (predicate, Deferred)
+        self._expected = []
+
+    #-----------------------------------------------------------------------------
+    def connectionMade(self):
+        self.connected_d.callback(self)
+
+    #-----------------------------------------------------------------------------
+    def lineReceived(self, line):
+        jsonData = json.loads(line)
+        now = time.time()
+        for expected in list(self._expected):
+            if expected[0](jsonData) == True:
+                self._expected.remove(expected)
+                expected[1].callback(now)
+                return
+
+    #-----------------------------------------------------------------------------
+    def expect(self, predicate):
+        """
+        Return a Deferred fired with the reception time of the first line matching predicate
+        """
+        d = defer.Deferred()
+        self._expected.append((predicate, d))
+        return d
+
+    #-----------------------------------------------------------------------------
+    def send(self, jsonData):
+        jsonData['from'] = self.name
+        jsonData['zone'] = self.zone
+        self.sendLine(json.dumps(jsonData))
+        return time.time()
+
+    #-----------------------------------------------------------------------------
+    def request(self, jsonData, predicate):
+        """
+        Send a line, return a Deferred fired with the latency of the expected answer
+        """
+        d = self.expect(predicate)
+        start = self.send(jsonData)
+        d.addCallback(lambda end: end - start)
+        return d
+
+    #-----------------------------------------------------------------------------
+    def chat(self, text, predicate):
+        return self.request({'type': 'chat', 'body': text}, predicate)
+
+
+#-----------------------------------------------------------------------------
+class _BenchClientFactory(TwistedClientFactory):
+    def __init__(self, client):
+        self.client = client
+
+    def buildProtocol(self, addr):
+        return self.client
+
+    def clientConnectionFailed(self, connector, reason):
+        self.client.connected_d.errback(reason)
+
+
+#-----------------------------------------------------------------------------
+# Tools
+#-----------------------------------------------------------------------------
+def _isSpeech(text):
+    return lambda jsonData: jsonData.get('type') == 'chat' and jsonData.get('message') == text
+
+#-----------------------------------------------------------------------------
+def _isCommand(command):
+    return lambda jsonData: jsonData.get('type') == 'command' and jsonData.get('command') == command
+
+#-----------------------------------------------------------------------------
+def _phaseResult(latencies, duration, errors = 0):
+    # Latency percentiles, and throughput in answers per second
+    result = fixtures.percentiles(latencies)
+    result['errors'] = errors
+    result['duration'] = duration
+    result['throughput'] = len(latencies) / duration if duration > 0 else 0.0
+    return result
+
+
+#-----------------------------------------------------------------------------
+# Benchmark
+#-----------------------------------------------------------------------------
+@defer.inlineCallbacks
+def run(options):
+    # In-memory database, before first server query
+    fixtures.useMemoryDatabase()
+    fixtures.installEchoPlugin()
+
+    # Local Wit stand-in
+    wit_port = reactor.listenTCP(0, server.Site(fixtures.WitStub()), interface = '127.0.0.1')
+
+    from lisa.server.config_manager import ConfigManager
+    from lisa.server.libs.server import ClientFactory
+    configuration = ConfigManager.getConfiguration()
+    configuration['wit_url'] = "http://127.0.0.1:{port}".format(port = wit_port.getHost().port)
+    configuration['debug']['debug_output'] = False
+    configuration['debug']['debug_wit'] = False
+
+    # Server
+    if options['tls'] == True:
+        context = ssl.DefaultOpenSSLContextFactory(options['key'] or configuration['lisa_ssl_key'], options['cert'] or configuration['lisa_ssl_crt'])
+        server_port = reactor.listenSSL(0, ClientFactory.get(), context, interface = '127.0.0.1')
+    else:
+        server_port = reactor.listenTCP(0, ClientFactory.get(), interface = '127.0.0.1')
+    port = server_port.getHost().port
+
+    # Connect clients
+    clients = []
+    for i in xrange(options['clients']):
+        client = BenchClient(name = "client{i}".format(i = i), zone = "zone{z}".format(z = i % options['zones']))
+        if options['tls'] == True:
+            reactor.connectSSL('127.0.0.1', port, _BenchClientFactory(client), ssl.ClientContextFactory())
+        else:
+            reactor.connectTCP('127.0.0.1', port, _BenchClientFactory(client))
+        clients.append(client)
+    yield defer.gatherResults([client.connected_d for client in clients])
+
+    # Login
+    results = {}
+    start = time.time()
+    outcomes = yield defer.DeferredList([client.request({'type': 'command', 'command': 'login req'}, _isCommand('login ack')) for client in clients], consumeErrors = True)
+    latencies = [value for success, value in outcomes if success == True]
+    results['login'] = _phaseResult(latencies, time.time() - start, errors = len(outcomes) - len(latencies))
+
+    # Chat : each client sends its messages one after the other
+    latencies = []
+    @defer.inlineCallbacks
+    def chat(client):
+        for i in xrange(options['messages']):
+            text = u"echo {name} {i}".format(name = client.name, i = i)
+            latency = yield client.chat(text, _isSpeech(text))
+            latencies.append(latency)
+    start = time.time()
+    yield defer.gatherResults([chat(client) for client in clients])
+    results['chat'] = _phaseResult(latencies, time.time() - start)
+
+    # Questions and answers
+    ask_latencies, answer_latencies = [], []
+    @defer.inlineCallbacks
+    def ask(client):
+        for i in xrange(options['questions']):
+            latency = yield client.chat(u"ask {name} {i}".format(name = client.name, i = i), _isCommand('ask'))
+            ask_latencies.append(latency)
+            text = u"yes {name} {i}".format(name = client.name, i = i)
+            latency = yield client.chat(text, _isSpeech(text))
+            answer_latencies.append(latency)
+    start = time.time()
+    yield defer.gatherResults([ask(client) for client in clients])
+    duration = time.time() - start
+    results['ask'] = _phaseResult(ask_latencies, duration)
+    results['answer'] = _phaseResult(answer_latencies, duration)
+
+    # Broadcasts : latency until each client receives the speech
+    latencies = []
+    start = time.time()
+    for i in xrange(options['broadcasts']):
+        text = u"broadcast {i}".format(i = i)
+        received = [client.expect(_isSpeech(text)) for client in clients]
+        sent = clients[0].send({'type': 'chat', 'body': text})
+        times = yield defer.gatherResults(received)
+        latencies.extend(t - sent for t in times)
+    results['broadcast'] = _phaseResult(latencies, time.time() - start)
+
+    # Stop
+    for client in clients:
+        client.transport.loseConnection()
+    yield server_port.stopListening()
+    yield wit_port.stopListening()
+
+    defer.returnValue({'config': dict((k, options[k]) for k in ('clients', 'zones', 'messages', 'questions', 'broadcasts', 'tls')),
+                       'phases': results})
+
+
+#-----------------------------------------------------------------------------
+# Main
+#-----------------------------------------------------------------------------
+def main(argv = None):
+    options = Options()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError, e:
+        print "{error}\n{usage}".format(error = e, usage = options)
+        sys.exit(1)
+    if options['verbose'] == True:
+        log.startLogging(sys.stderr)
+
+    outcome = {}
+    def _done(result):
+        outcome['result'] = result
+    def _error(failure):
+        outcome['error'] = failure
+    def _start():
+        # Started once the reactor runs, so it can be stopped even if run fails at once
+        d = run(options)
+        d.addCallbacks(_done, _error)
+        d.addBoth(lambda _: reactor.stop())
+    reactor.callWhenRunning(_start)
+    reactor.run()
+
+    if outcome.has_key('error') == True:
+        outcome['error'].printTraceback()
+        sys.exit(1)
+
+    # Write results
+    output = json.dumps(outcome['result'], indent = 4, sort_keys = True)
+    if options['output'] is None:
+        print output
+    else:
+        with open(options['output'], 'w') as f:
+            f.write(output + '\n')
+
+#-----------------------------------------------------------------------------
+if __name__ == '__main__':
+    main()
+
+# --------------------- End of e2e.py  ---------------------
@@ -0,0 +1,142 @@
+# -*- coding: UTF-8 -*-
+#-----------------------------------------------------------------------------
+# project     : Lisa server
+# module      : benchmarks
+# file        : fixtures.py
+# description : Benchmarks fixtures : in-memory database, synthetic plugin
+# author      : G.Dumee
+#-----------------------------------------------------------------------------
+# copyright   : Neotique
+#-----------------------------------------------------------------------------
+
+
+#-----------------------------------------------------------------------------
+# Imports
+#-----------------------------------------------------------------------------
+import json, math
+from twisted.web import resource
+
+
+#-----------------------------------------------------------------------------
+# Globals
+#-----------------------------------------------------------------------------
+ECHO_PLUGIN_NAME = "BenchEcho"
+ECHO_INTENTS = {'bench_echo': "echo", 'bench_ask': "ask", 'bench_broadcast': "broadcast"}
+
+
+#-----------------------------------------------------------------------------
+# Database
+#-----------------------------------------------------------------------------
+def useMemoryDatabase():
+    """
+    Replace the Mongo connection by an in-memory one
+
+    Must be called before the first query, needs mongomock
+    """
+    try:
+        import mongomock
+    except ImportError:
+        raise ImportError("Benchmarks need mongomock : pip install mongomock")
+    from mongoengine import connect
+    from mongoengine.connection import disconnect
+    from lisa.server.web.weblisa.settings import DBNAME
+
+    # Models connect on import, replace their connection
+    import lisa.server.web.manageplugins.models
+    disconnect()
+    connect(DBNAME, host = "mongomock://localhost")
+
+#-----------------------------------------------------------------------------
+def installEchoPlugin():
+    """
+    Add the synthetic echo plugin and its intents to the database, return the plugin
+    """
+    from lisa.server.web.manageplugins.models import Plugin, Intent
+    from lisa.server.config_manager import ConfigManager
+    configuration = ConfigManager.getConfiguration()
+
+    plugin = Plugin(name = ECHO_PLUGIN_NAME, enabled = True, lang = [configuration['lang_short']], version = "1.0")
+    plugin.module = __name__ + ".EchoPlugin"
+    plugin.save()
+    for intent_name, method_name in ECHO_INTENTS.iteritems():
+        Intent(plugin = plugin, name = intent_name, plugin_name = ECHO_PLUGIN_NAME, method_name = method_name, enabled = True).save()
+
+    # The synthetic plugin has no JSON file on disk, keep it out of plugins updates
+    from lisa.server.plugins.PluginManager import PluginManager
+    update = PluginManager._updatePlugin
+    def _updatePlugin(plugin):
+        if plugin.name != ECHO_PLUGIN_NAME:
+            update(plugin = plugin)
+    PluginManager._updatePlugin = staticmethod(_updatePlugin)
+
+    return plugin
+
+
+#-----------------------------------------------------------------------------
+# EchoPlugin
+#-----------------------------------------------------------------------------
+class EchoPlugin(object):
+    """
+    Synthetic plugin : repeats the utterance, asks a question, broadcasts to every client
+    """
+
+    #-----------------------------------------------------------------------------
+    def __init__(self):
+        # UID will be set by PluginManager just after constructor
+        self.uid = None
+
+    #-----------------------------------------------------------------------------
+    def echo(self, jsonInput):
+        jsonInput['context'].speakToClient(plugin_uid = self.uid, text = _text(jsonInput))
+
+    #-----------------------------------------------------------------------------
+    def ask(self, jsonInput):
+        jsonInput['context'].askClient(plugin_uid = self.uid, text = _text(jsonInput), answer_cbk = self.answer)
+
+    #-----------------------------------------------------------------------------
+    def answer(self, context, jsonAnswer):
+        if jsonAnswer is not None:
+            context.speakToClient(plugin_uid = self.uid, text = _text(jsonAnswer))
+
+    #-----------------------------------------------------------------------------
+    def broadcast(self, jsonInput):
+        jsonInput['context'].speakToClient(plugin_uid = self.uid, text = _text(jsonInput), client_uids = ['all'])
+
+
+#-----------------------------------------------------------------------------
+# WitStub
+#-----------------------------------------------------------------------------
+class WitStub(resource.Resource):
+    """
+    Local Wit stand-in : the intent is 'bench_' + first word, the text is in the 'text' entity
+    """
+    isLeaf = True
+
+    #-----------------------------------------------------------------------------
+    def render_GET(self, request):
+        text = request.args['q'][0].decode('utf-8')
+        outcome = {'intent': "bench_" + text.split(' ', 1)[0], 'confidence': 1.0, 'entities': {'text': {'value': text}}}
+        request.setHeader('content-type', 'application/json')
+        return json.dumps({'msg_body': text, 'outcome': outcome})
+
+
+#-----------------------------------------------------------------------------
+# Tools
+#-----------------------------------------------------------------------------
+def _text(jsonInput):
+    return jsonInput['outcome']['entities']['text']['value']
+
+#-----------------------------------------------------------------------------
+def percentiles(values):
+    """
+    Return count, min, p50, p95, p99 and max of a list of durations, in milliseconds
+    """
+    if len(values) == 0:
+        return {'count': 0}
+    values = sorted(values)
+    def rank(p):
+        return values[max(0, int(math.ceil(p * len(values))) - 1)] * 1000.0
+    return {'count': len(values), 'min': values[0] * 1000.0, 'p50': rank(0.50), 'p95': rank(0.95),
+            'p99': rank(0.99), 'max': values[-1] * 1000.0}
+
+# --------------------- End of fixtures.py  ---------------------
@@ -0,0 +1,219 @@
+# -*- coding: UTF-8 -*-
+#-----------------------------------------------------------------------------
+# project     : Lisa server
+# module      : benchmarks
+# file        : micro.py
+# description : Micro benchmarks of the dialog and fan-out hot paths
+# author      : G.Dumee
+#-----------------------------------------------------------------------------
+# copyright   : Neotique
+#-----------------------------------------------------------------------------
+"""
+Time hot paths of the server with an in-memory database
+
+Each benchmark gives the best time per operation over several runs, in
+microseconds. Results can be saved as a JSON baseline, then compared with a
+later run : benchmarks slower than the baseline by more than the threshold
+are flagged, and the exit status is 1.
+
+Usage : python -m lisa.server.benchmarks.micro [--save file] [--compare file] [--threshold 0.2] [--only name]
+"""
+
+
+#-----------------------------------------------------------------------------
+# Imports
+#-----------------------------------------------------------------------------
+import sys, json, timeit, platform, itertools
+from datetime import datetime, timedelta
+from dateutil.rrule import rrule, DAILY
+from twisted.python import usage
+from twisted.test import proto_helpers
+from lisa.server.benchmarks import fixtures
+
+
+#-----------------------------------------------------------------------------
+# Globals
+#-----------------------------------------------------------------------------
+FANOUT_SIZES = (10, 100, 1000)
+SCHEDULER_SIZES = (10, 100, 1000, 10000)
+
+# Minimum duration of a timed run, in seconds
+_MIN_RUN_TIME = 0.1
+
+
+#-----------------------------------------------------------------------------
+# Options
+#-----------------------------------------------------------------------------
+class Options(usage.Options):
+    optParameters = [
+        ['save', 's', None, "Save results as a JSON baseline"],
+        ['compare', 'c', None, "Compare results with a JSON baseline"],
+        ['threshold', 't', 0.2, "Slowdown ratio flagged as a regression", float],
+        ['only', 'o', None, "Run benchmarks whose name contains this string"],
+        ['repeat', 'r', 5, "Number of timed runs", int],
+    ]
+
+
+#-----------------------------------------------------------------------------
+# Tools
+#-----------------------------------------------------------------------------
+class _NullTransport(proto_helpers.StringTransport):
+    """
+    Transport dropping written data
+    """
+    def write(self, data):
+        pass
+
+    def writeSequence(self, data):
+        pass
+
+#-----------------------------------------------------------------------------
+def _timePerOp(func, repeat):
+    # Calibrate number of calls per run, then keep best run
+    number = 1
+    while True:
+        elapsed = timeit.timeit(func, number = number)
+        if elapsed >= _MIN_RUN_TIME or number >= 1000000:
+            break
+        number *= 10
+    best = min([elapsed] + timeit.repeat(func, number = number, repeat = repeat - 1))
+    return best * 1e6 / number
+
+
+#-----------------------------------------------------------------------------
+# Benchmarks
+#-----------------------------------------------------------------------------
+def _benchmarks():
+    """
+    Build benchmarks, return a list of (name, function)
+    """
+    from lisa.server.config_manager import ConfigManager
+    from lisa.server.libs.server import ClientFactory
+    from lisa.server.libs.NeoDialog import NeoContext
+    from lisa.server.plugins.PluginManager import PluginManager
+    from lisa.server.libs.txscheduler.manager import ScheduledTaskManager
+    from lisa.server.libs.txscheduler.tasks import ScheduledTask
+    configuration = ConfigManager.getConfiguration()
+    configuration['debug']['debug_output'] = False
+    configuration['debug']['debug_scheduler'] = False
+
+    # Server with the echo plugin
+    fixtures.useMemoryDatabase()
+    fixtures.installEchoPlugin()
+    factory = ClientFactory.get()
+    factory.startFactory()
+    plugin = PluginManager.getPlugin(plugin_name = fixtures.ECHO_PLUGIN_NAME)
+    context = ClientFactory.initClient(client_name = "bench", zone_name = "bench")['context']
+
+    benchmarks = []
+    benchmarks.append(('create_step', lambda: NeoContext._create_step(plugin_uid = plugin.uid, context = context)))
+
+    # Clients and zones
+    counter = itertools.count()
+    benchmarks.append(('init_client_new', lambda: ClientFactory.initClient(client_name = "client{i}".format(i = next(counter)), zone_name = "bench")))
+    benchmarks.append(('init_client_existing', lambda: ClientFactory.initClient(client_name = "bench", zone_name = "bench")))
+    benchmarks.append(('get_or_create_zone', lambda: ClientFactory.getOrCreateZone("bench")))
+
+    # Fan-out to a zone of connected clients
+    for size in FANOUT_SIZES:
+        zone_name = "fanout{size}".format(size = size)
+        for i in xrange(size):
+            protocol = factory.buildProtocol(('127.0.0.1', 0))
+            protocol.makeConnection(_NullTransport())
+            protocol.initClient(client_name = "{zone}-{i}".format(zone = zone_name, i = i), zone_name = zone_name)
+        jsonData = {'type': 'chat', 'message': "Bench fan-out message"}
+        zone_uids = [ClientFactory.getOrCreateZone(zone_name)]
+        benchmarks.append(('send_to_clients_{size}'.format(size = size),
+                           lambda jsonData = jsonData, zone_uids = zone_uids: ClientFactory.sendToClients(jsonData = jsonData, zone_uids = zone_uids)))
+
+    # Plugins registry
+    benchmarks.append(('get_intent', lambda: PluginManager.getIntent(intent_name = "bench_echo")))
+    benchmarks.append(('get_plugin_by_name', lambda: PluginManager.getPlugin(plugin_name = fixtures.ECHO_PLUGIN_NAME)))
+    benchmarks.append(('get_plugin_by_uid', lambda: PluginManager.getPlugin(plugin_uid = plugin.uid)))
+
+    # Scheduler check, no task due
+    tomorrow = datetime.now() + timedelta(days = 1)
+    for size in SCHEDULER_SIZES:
+        manager = ScheduledTaskManager(configuration)
+        manager.init_flag = True
+        for i in xrange(size):
+            manager.add_task(ScheduledTask("task{i}".format(i = i), rrule(DAILY, dtstart = tomorrow), lambda: None))
+        benchmarks.append(('scheduler_run_{size}'.format(size = size), manager.run))
+
+    return benchmarks
+
+#-----------------------------------------------------------------------------
+def run(only = None, repeat = 5):
+    """
+    Run benchmarks, return {name: microseconds per operation}
+    """
+    results = {}
+    for name, func in _benchmarks():
+        if only is not None and only not in name:
+            continue
+        results[name] = _timePerOp(func, repeat = repeat)
+    return results
+
+#-----------------------------------------------------------------------------
+def compare(results, baseline, threshold):
+    """
+    Compare results with a baseline, return a list of (name, baseline, result, ratio, regression)
+    """
+    lines = []
+    for name in sorted(results):
+        base = baseline.get(name)
+        if base is None or base <= 0:
+            lines.append((name, None, results[name], None, False))
+            continue
+        ratio = results[name] / base
+        lines.append((name, base, results[name], ratio, ratio > 1 + threshold))
+    return lines
+
+
+#-----------------------------------------------------------------------------
+# Main
+#-----------------------------------------------------------------------------
+def main(argv = None):
+    options = Options()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError, e:
+        print "{error}\n{usage}".format(error = e, usage = options)
+        sys.exit(1)
+
+    results = run(only = options['only'], repeat = options['repeat'])
+
+    # Save baseline
+    if options['save'] is not None:
+        with open(options['save'], 'w') as f:
+            json.dump({'date': datetime.now().isoformat(), 'python': platform.python_version(), 'platform': platform.platform(),
+                       'results': results}, f, indent = 4, sort_keys = True)
+            f.write('\n')
+
+    # Show results
+    if options['compare'] is None:
+        for name in sorted(results):
+            print "{name:<24} {time:>12.2f} us".format(name = name, time = results[name])
+        return
+
+    # Compare with baseline
+    with open(options['compare']) as f:
+        baseline = json.load(f)['results']
+    regressions = 0
+    for name, base, result, ratio, regression in compare(results, baseline, options['threshold']):
+        if ratio is None:
+            print "{name:<24} {base:>12} {time:>12.2f} us".format(name = name, base = "-", time = result)
+            continue
+        print "{name:<24} {base:>12.2f} {time:>12.2f} us {ratio:>7.2f}x{flag}".format(name = name, base = base, time = result, ratio = ratio,
+                                                                                       flag = "  SLOWER" if regression == True else "")
+        if regression == True:
+            regressions += 1
+    if regressions > 0:
+        print "{count} benchmark(s) slower than baseline by more than {threshold:.0%}".format(count = regressions, threshold = options['threshold'])
+        sys.exit(1)
+
+#-----------------------------------------------------------------------------
+if __name__ == '__main__':
+    main()
+
+# --------------------- End of micro.py  ---------------------
@@ -0,0 +1,110 @@
+# -*- coding: UTF-8 -*-
+#-----------------------------------------------------------------------------
+# project     : Lisa server
+# module      : benchmarks
+# file        : steps.py
+# description : Dialog steps creation micro benchmark
+# author      : G.Dumee
+#-----------------------------------------------------------------------------
+# copyright   : Neotique
+#-----------------------------------------------------------------------------
+"""
+Compare dialog steps stored as dicts keyed by uuid1 strings with slotted steps
+
+Usage : python -m lisa.server.benchmarks.steps [count]
+"""
+
+
+#-----------------------------------------------------------------------------
+# Imports
+#-----------------------------------------------------------------------------
+import sys, time, timeit, uuid
+from datetime import datetime
+from lisa.server.libs.history import Step, StepHistory
+
+
+#-----------------------------------------------------------------------------
+# Tools
+#-----------------------------------------------------------------------------
+class _Clock(object):
+    seconds = staticmethod(time.time)
+
+#-----------------------------------------------------------------------------
+def _deep_size(obj, seen):
+    # Approximate memory of an object graph, counting each object once
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += _deep_size(key, seen) + _deep_size(value, seen)
+    elif isinstance(obj, Step):
+        for name in Step.__slots__:
+            size += _deep_size(getattr(obj, name), seen)
+    return size
+
+
+#-----------------------------------------------------------------------------
+# Dict steps, as created before slotted steps
+#-----------------------------------------------------------------------------
+def dict_steps(count):
+    history = {}
+    steps = {'count': 0, 'first': None, 'last': None}
+    client_steps = {'count': 0, 'first': None, 'last': None}
+    for i in xrange(count):
+        step_uid = str(uuid.uuid1())
+        step = {'uid': step_uid, 'date': datetime.now(), 'previous': None, 'next': None, 'client_uid': 1, 'client_previous': None, 'client_next': None, 'plugin_uid': None, 'plugin_previous': None, 'plugin_next': None}
+        history[step_uid] = step
+        step['type'] = "Plugin speech"
+        for chain, previous_key, next_key in ((steps, 'previous', 'next'), (client_steps, 'client_previous', 'client_next')):
+            chain['count'] += 1
+            if chain['first'] is None:
+                chain['first'] = step_uid
+            if chain['last'] is not None:
+                history[chain['last']][next_key] = step_uid
+                step[previous_key] = history[chain['last']]['uid']
+            chain['last'] = step_uid
+    return history
+
+#-----------------------------------------------------------------------------
+def slotted_steps(count):
+    history = StepHistory(capacity = count, clock = _Clock())
+    client_steps = {'count': 0, 'first': None, 'last': None}
+    for i in xrange(count):
+        step = Step(type = "Plugin speech")
+        step.client_uid = 1
+        history.add(step, client_steps = client_steps)
+    return history
+
+
+#-----------------------------------------------------------------------------
+# Main
+#-----------------------------------------------------------------------------
+def main(count = 100000):
+    # Memory
+    dict_size = _deep_size(dict_steps(count), set())
+    slotted = slotted_steps(count)
+    seen = set()
+    slotted_size = _deep_size(slotted._ring, seen)
+    for step in slotted._ring:
+        slotted_size += _deep_size(step, seen)
+
+    # Creation time
+    dict_time = min(timeit.repeat(lambda: dict_steps(count), number = 1, repeat = 3))
+    slotted_time = min(timeit.repeat(lambda: slotted_steps(count), number = 1, repeat = 3))
+
+    print "{count} steps".format(count = count)
+    print "{name:<8} {size:>17} {time:>18}".format(name = "", size = "memory", time = "creation")
+    print "{name:<8} {size:>10.0f} B/step {time:>10.2f} us/step".format(name = "dict", size = float(dict_size) / count, time = dict_time * 1e6 / count)
+    print "{name:<8} {size:>10.0f} B/step {time:>10.2f} us/step".format(name = "slotted", size = float(slotted_size) / count, time = slotted_time * 1e6 / count)
+    print "ratio    {size:>10.1f}x        {time:>10.1f}x".format(size = float(dict_size) / slotted_size, time = dict_time / slotted_time)
+
+#-----------------------------------------------------------------------------
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
+
+# --------------------- End of steps.py  ---------------------
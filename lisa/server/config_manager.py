@@ -38,11 +38,12 @@ class ConfigManager(object):
 
         # Read configuration file
         if os.path.isfile(config_file) == True and config_file.endswith('.json') == True:
-            self.configuration = json.load(open(config_file))
+            self.config_file = config_file
         elif os.path.isfile('/etc/lisa/server/configuration/lisa.json') == True:
-            self.configuration = json.load(open('/etc/lisa/server/configuration/lisa.json'))
+            self.config_file = '/etc/lisa/server/configuration/lisa.json'
         else:
-            self.configuration = json.load(open(pkg_resources.resource_filename(__name__, 'configuration/lisa.json.sample')))
+            self.config_file = pkg_resources.resource_filename(__name__, 'configuration/lisa.json.sample')
+        self.configuration = json.load(open(self.config_file))
 
         # Path
         self.configuration['path'] = os.path.dirname(__file__)
@@ -100,6 +101,93 @@ class ConfigManager(object):
             log.err("Error configuration : no server port : 'lisa_port'")
             self.valid_flag = False
 
+        # Clients outbound queues params
+        if self.configuration.has_key('client_queue_high_water') == False:
+            self.configuration['client_queue_high_water'] = 1000
+        if self.configuration.has_key('client_queue_low_water') == False:
+            self.configuration['client_queue_low_water'] = 100
+        if self.configuration.has_key('client_queue_policy') == False:
+            self.configuration['client_queue_policy'] = "drop_oldest"
+        if self.configuration['client_queue_policy'] not in ('drop_oldest', 'coalesce', 'disconnect'):
+            log.err("Error configuration : unknown client queue policy {} : 'client_queue_policy'".format(self.configuration['client_queue_policy']))
+            self.valid_flag = False
+
+        # Clients inputs params
+        if self.configuration.has_key('client_max_pending') == False:
+            self.configuration['client_max_pending'] = 10
+
+        # Dialog params
+        if self.configuration.has_key('answer_timeout') == False:
+            self.configuration['answer_timeout'] = 20
+
+        # Plugins execution params
+        if self.configuration.has_key('plugin_threads') == False:
+            self.configuration['plugin_threads'] = 10
+        if self.configuration.has_key('plugin_concurrency') == False:
+            self.configuration['plugin_concurrency'] = 2
+        if self.configuration.has_key('plugin_queue_depth') == False:
+            self.configuration['plugin_queue_depth'] = 20
+        if self.configuration.has_key('plugin_timeout') == False:
+            self.configuration['plugin_timeout'] = 30
+        if self.configuration.has_key('plugin_workers') == False:
+            self.configuration['plugin_workers'] = 0
+        if self.configuration.has_key('plugin_workers_shard') == False:
+            self.configuration['plugin_workers_shard'] = "plugin"
+        if self.configuration['plugin_workers_shard'] not in ('plugin', 'client'):
+            log.err("Error configuration : unknown plugin workers shard {} : 'plugin_workers_shard'".format(self.configuration['plugin_workers_shard']))
+            self.valid_flag = False
+
+        # Scheduler params
+        if self.configuration.has_key('cron_threads') == False:
+            self.configuration['cron_threads'] = 4
+        if self.configuration.has_key('cron_timeout') == False:
+            self.configuration['cron_timeout'] = 600
+        if self.configuration.has_key('cron_overlap') == False:
+            self.configuration['cron_overlap'] = "skip"
+        if self.configuration['cron_overlap'] not in ('skip', 'queue', 'allow'):
+            log.err("Error configuration : unknown cron overlap policy {} : 'cron_overlap'".format(self.configuration['cron_overlap']))
+            self.valid_flag = False
+        if self.configuration.has_key('cron_catchup') == False:
+            self.configuration['cron_catchup'] = "skip"
+        if self.configuration['cron_catchup'] not in ('skip', 'once', 'all'):
+            log.err("Error configuration : unknown cron catch-up policy {} : 'cron_catchup'".format(self.configuration['cron_catchup']))
+            self.valid_flag = False
+        if self.configuration.has_key('cron_catchup_max') == False:
+            self.configuration['cron_catchup_max'] = 10
+        if self.configuration.has_key('cron_catchup_spread') == False:
+            self.configuration['cron_catchup_spread'] = 1
+        if self.configuration.has_key('cron_state_flush') == False:
+            self.configuration['cron_state_flush'] = 10
+
+        # Dialog history params
+        if self.configuration.has_key('history_capacity') == False:
+            self.configuration['history_capacity'] = 10000
+        if self.configuration.has_key('history_retention') == False:
+            self.configuration['history_retention'] = 86400
+        if self.configuration.has_key('history_spill') == False:
+            self.configuration['history_spill'] = ""
+        if self.configuration['history_spill'] not in ("", 'mongo', 'file'):
+            log.err("Error configuration : unknown history spill storage {} : 'history_spill'".format(self.configuration['history_spill']))
+            self.valid_flag = False
+        if self.configuration.has_key('history_spill_batch') == False:
+            self.configuration['history_spill_batch'] = 100
+        if self.configuration.has_key('history_spill_size') == False:
+            self.configuration['history_spill_size'] = 16 * 1024 * 1024
+        if self.configuration.has_key('history_spill_file') == False:
+            self.configuration['history_spill_file'] = "/var/log/lisa/history.log"
+
+        # Wit params
+        if self.configuration.has_key('wit_url') == False:
+            self.configuration['wit_url'] = "https://api.wit.ai"
+        if self.configuration.has_key('wit_timeout') == False:
+            self.configuration['wit_timeout'] = 5
+        if self.configuration.has_key('wit_max_requests') == False:
+            self.configuration['wit_max_requests'] = 4
+        if self.configuration.has_key('wit_cache_size') == False:
+            self.configuration['wit_cache_size'] = 1000
+        if self.configuration.has_key('wit_cache_ttl') == False:
+            self.configuration['wit_cache_ttl'] = 3600
+
         # SSL params
         if self.configuration.has_key('enable_secure_mode') == True and self.configuration['enable_secure_mode'] == True:
             # SSL cert
@@ -135,6 +223,13 @@ class ConfigManager(object):
             cls.__instance = ConfigManager()
         return cls.__instance.configuration
 
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def getConfigurationFile(cls):
+        if cls.__instance is None:
+            cls.__instance = ConfigManager()
+        return cls.__instance.config_file
+
     #-----------------------------------------------------------------------------
     @classmethod
     def setConfiguration(cls, config_file):
@@ -13,11 +13,13 @@
 #-----------------------------------------------------------------------------
 # Imports
 #-----------------------------------------------------------------------------
-import lisa.plugins, json, uuid, threading, os, inspect
-from datetime import datetime
+import lisa.plugins, json, threading, os, inspect, copy
 from twisted.python import log
-from lisa.Neotique.NeoTimer import NeoTimer
 from lisa.server.config_manager import ConfigManager
+from lisa.server.libs.history import Step, StepHistory, FileStepSink, MongoStepSink
+from lisa.server.libs.timingwheel import TimingWheel
+from lisa.server.libs.executor import PluginExecutor, ExecutorFull, ExecutorTimeout
+from lisa.server.libs.workers import WorkerPool, WorkerCallback
 from lisa.server.plugins.PluginManager import PluginManager
 
 
@@ -33,23 +35,66 @@ _ = configuration_server['trans']
 #-----------------------------------------------------------------------------
 class NeoContext():
     # Global context
-    __lock = threading.RLock()
     __global_ctx = {}
-    __history = {}
-    __steps = {'count': 0, 'first': None, 'last': None}
+    __history = None
+    __wheel = None
+    __executor = None
+    __workers = None
     __Vars = {}
     __factory = None
+    __ContextClass = None
 
     #-----------------------------------------------------------------------------
-    def __init__(self, client_uid):
+    def __init__(self, client_uid, template = None):
         # Client context
         self.client = NeoContext.__factory.getClient(client_uid)
         self.wait_step = None
+        self._lock = threading.Lock()
         self._client_steps = {'count': 0, 'first': None, 'last': None}
-        self.Vars = {}
 
         # Init plugins client variables
-        PluginManager.initContext(context = self)
+        if template is None:
+            template = PluginManager.getContextTemplate()
+        self.Vars = template.cloneClientVars()
+
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def create(cls, client_uid):
+        """
+        Create a client context
+
+        The context class has accessors for the variables declared by enabled
+        plugins, it is compiled again only when plugins change
+        """
+        template = PluginManager.getContextTemplate()
+        context_class = cls.__ContextClass
+        if context_class is None or context_class.template is not template:
+            context_class = cls._compileContextClass(template = template)
+        return context_class(client_uid = client_uid, template = template)
+
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def _compileContextClass(cls, template):
+        # Add new global variables, keep current values
+        for name, default in template.global_vars:
+            if NeoContext.__Vars.has_key(name) == False:
+                NeoContext.__Vars[name] = copy.deepcopy(default)
+
+        # Variables accessors
+        attributes = {'template': template}
+        for scope, scope_vars, accessor in (('client', template.client_vars, _clientVarProperty), ('global', template.global_vars, _globalVarProperty)):
+            for name, default in scope_vars:
+                if hasattr(NeoContext, name) == True and isinstance(getattr(NeoContext, name), property) == False:
+                    log.err("Context var {name} hides a context attribute, it will be ignored".format(name = name))
+                    continue
+                if attributes.has_key(name) == True:
+                    log.err("Context var {name} is declared as client and global var, client var will be ignored".format(name = name))
+                attributes[name] = accessor(name)
+
+        # Generate context class
+        context_class = type('NeoClientContext', (NeoContext, object), attributes)
+        cls.__ContextClass = context_class
+        return context_class
 
     #-----------------------------------------------------------------------------
     def parse(self, jsonInput, plugin_name = None, method_name = None):
@@ -103,30 +148,49 @@ class NeoContext():
         step['type'] = "Plugin call"
         step['in_json'] = jsonInput.copy()
 
-        # Call plugin method
-        jsonInput['context'] = self
-        try:
-            jsonOutput = methodToCall(jsonInput)
-        except:
-            # In debug mode, raise exception
-            if configuration_server['debug']['debug_plugin'] == True:
-                raise
-
-            # Add an error step
-            step = NeoContext._create_step(context = self)
-            step['type'] = "error plugin exec"
-            step['plugin_name'] = plugin_name
-            step['method_name'] = method_name
-            step['in_json'] = jsonInput.copy()
-
-            # Return an error to client
-            jsonData = {'type': 'Error', 'message': _("error_plugin_exec")}
-            NeoContext.__factory.sendToClients(client_uids = [self.client['uid']], jsonData = jsonData)
-            return
+        # Call plugin method in a worker process, core intents stay in the server
+        if NeoContext.__workers is not None and plugin.name != "Core":
+            d = NeoContext.__workers.call(plugin_uid = plugin.uid, module = plugin.module, method = method_name, jsonInput = jsonInput,
+                                          context = self, timeout = getattr(plugin, 'exec_timeout', None))
+        # Call plugin method in plugins worker pool
+        else:
+            jsonInput['context'] = self
+            NeoContext._setPluginLimits(plugin = plugin)
+            d = NeoContext.__executor.run(plugin.uid, methodToCall, jsonInput)
+        d.addCallbacks(self._pluginResult, self._pluginError, callbackKeywords = {'plugin_uid': plugin.uid},
+                       errbackKeywords = {'plugin_name': plugin_name, 'method_name': method_name, 'jsonInput': jsonInput})
+        return d
 
+    #-----------------------------------------------------------------------------
+    def _pluginResult(self, jsonOutput, plugin_uid):
         # Old-style plugin output
         if jsonOutput is not None:
-            self.speakToClient(plugin_uid = plugin.uid, text = jsonOutput['body'])
+            self.speakToClient(plugin_uid = plugin_uid, text = jsonOutput['body'])
+
+    #-----------------------------------------------------------------------------
+    def _pluginError(self, failure, plugin_name, method_name, jsonInput):
+        # Plugin is too slow or too busy
+        if failure.check(ExecutorTimeout) is not None:
+            step_type, message = "error plugin timeout", _("error_plugin_timeout")
+        elif failure.check(ExecutorFull) is not None:
+            step_type, message = "error plugin busy", _("error_plugin_busy")
+        else:
+            # In debug mode, raise exception
+            if configuration_server['debug']['debug_plugin'] == True:
+                return failure
+            log.err(failure, "Error while executing {plugin}.{method}".format(plugin = plugin_name, method = method_name))
+            step_type, message = "error plugin exec", _("error_plugin_exec")
+
+        # Add an error step
+        step = NeoContext._create_step(context = self)
+        step['type'] = step_type
+        step['plugin_name'] = plugin_name
+        step['method_name'] = method_name
+        step['in_json'] = jsonInput.copy()
+
+        # Return an error to client
+        jsonData = {'type': 'Error', 'message': message}
+        NeoContext.__factory.sendToClients(client_uids = [self.client['uid']], jsonData = jsonData)
 
     #-----------------------------------------------------------------------------
     def speakToClient(self, plugin_uid, text, client_uids = None, zone_uids = None):
@@ -146,7 +210,7 @@ class NeoContext():
         NeoContext.globalSpeakToClient(context = self, text = text, plugin_uid = plugin_uid, client_uids = client_uids, zone_uids = zone_uids)
 
     #-----------------------------------------------------------------------------
-    def askClient(self, plugin_uid, text, answer_cbk, wit_context = None, client_uids = None, zone_uids = None):
+    def askClient(self, plugin_uid, text, answer_cbk, wit_context = None, client_uids = None, zone_uids = None, timeout = None):
         """
         Ask a question, and wait for an answer
 
@@ -156,6 +220,7 @@ class NeoContext():
         client_uids : optional list of destination clients, use clients uids
         zone_uids : optional list of destination zones, use zone uids
         answer_cbk : function called on answer
+        timeout : optional answer timeout in seconds, default is plugin 'answer_timeout', or server 'answer_timeout'
 
         To answer a client, do net set client_uids and zone_uids
         To send to everyone : client_uids = ['all'] or zone_uids = ['all']
@@ -165,7 +230,7 @@ class NeoContext():
             jsonAnswer : json received from the client (!!may have no intent!!), None when no answer is received after a timeout
         """
         # Call global API
-        NeoContext.globalAskToClient(context = self, text = text, answer_cbk = answer_cbk, plugin_uid = plugin_uid, wit_context = wit_context, client_uids = client_uids, zone_uids = zone_uids)
+        NeoContext.globalAskToClient(context = self, text = text, answer_cbk = answer_cbk, plugin_uid = plugin_uid, wit_context = wit_context, client_uids = client_uids, zone_uids = zone_uids, timeout = timeout)
 
     #-----------------------------------------------------------------------------
     @classmethod
@@ -194,7 +259,7 @@ class NeoContext():
 
     #-----------------------------------------------------------------------------
     @classmethod
-    def globalAskToClient(cls, text, answer_cbk, plugin_uid = None, context = None, wit_context = None, client_uids = None, zone_uids = None):
+    def globalAskToClient(cls, text, answer_cbk, plugin_uid = None, context = None, wit_context = None, client_uids = None, zone_uids = None, timeout = None):
         # Check params
         if client_uids is None:
             client_uids = []
@@ -215,21 +280,20 @@ class NeoContext():
         if wit_context is not None:
             step['wit_context'] = wit_context
 
-        # Lock access
-        NeoContext.__lock.acquire()
-
         # TODO : don't work, no global step, no global wait step
         if context is not None:
-            # If there is a current question, end it without answer
-            context._process_answer()
-
             # Set waiting state
             step['answer_cbk'] = answer_cbk
-            step['wait_timer'] = NeoTimer(duration_s = 20, user_cbk = context._timer_cbk, user_param = None)
-            context.wait_step = step
+            step['wait_timer'] = cls.__wheel.schedule(cls._getAnswerTimeout(plugin_uid = plugin_uid, timeout = timeout), context._timer_cbk, step)
+
+            # Lock client context
+            with context._lock:
+                previous_step = context.wait_step
+                context.wait_step = step
 
-        # Release access
-        NeoContext.__lock.release()
+            # If there was a current question, end it without answer
+            if previous_step is not None:
+                context._end_question(step = previous_step)
 
         # Send to client
         jsonData = {}
@@ -242,31 +306,37 @@ class NeoContext():
         NeoContext.__factory.sendToClients(client_uids = client_uids, zone_uids = zone_uids, jsonData = jsonData)
 
     #-----------------------------------------------------------------------------
-    def _timer_cbk(self, param):
+    def _timer_cbk(self, step):
         """
-        Internal timer callback
+        Internal timer callback, called in reactor thread
         """
+        # Lock client context, the question may be already answered
+        with self._lock:
+            if self.wait_step is not step:
+                return
+            self.wait_step = None
+
         # No answer timeout
-        self._process_answer()
+        self._end_question(step = step)
 
     #-----------------------------------------------------------------------------
     def _process_answer(self, jsonAnswer = None):
-        # Lock access
-        NeoContext.__lock.acquire()
+        # Lock client context, answer and timeout may arrive simultaneously
+        with self._lock:
+            step = self.wait_step
+            self.wait_step = None
 
-        # Answer may arrive simultaneously
-        if self.wait_step is None:
-            # Release access
-            NeoContext.__lock.release()
+        # If not waiting an answer
+        if step is None:
             return False
 
-        # Keep step locally
-        step = self.wait_step
-        self.wait_step = None
+        self._end_question(step = step, jsonAnswer = jsonAnswer)
+        return True
 
+    #-----------------------------------------------------------------------------
+    def _end_question(self, step, jsonAnswer = None):
         # Stop timer
-        step['wait_timer'].stop()
-        step.pop('wait_timer')
+        step.pop('wait_timer').cancel()
 
         # Add a step
         new_step = NeoContext._create_step(plugin_uid = step['plugin_uid'], context = self)
@@ -274,81 +344,113 @@ class NeoContext():
         new_step['question_step'] = step['uid']
         step['answer_step'] = new_step
 
-        # Release access
-        NeoContext.__lock.release()
-
         # If there is an answer
         if jsonAnswer is not None:
             new_step['json'] = jsonAnswer.copy()
             jsonAnswer['context'] = self
 
-        # Callback caller without answer
-        step['answer_cbk'](context = self, jsonAnswer = jsonAnswer)
-
-        # Clear step
-        step.pop('answer_cbk')
+        # Callback caller, in its worker process
+        answer_cbk = step.pop('answer_cbk')
+        if isinstance(answer_cbk, WorkerCallback) == True:
+            d = answer_cbk(context = self, jsonAnswer = jsonAnswer)
+        # Callback caller, in plugins worker pool
+        else:
+            d = NeoContext.__executor.run(step['plugin_uid'], answer_cbk, context = self, jsonAnswer = jsonAnswer)
+        d.addErrback(log.err, "Error in answer callback of plugin {uid}".format(uid = step['plugin_uid']))
+        d.addCallback(self._answerProcessed, step = step)
+        return d
 
+    #-----------------------------------------------------------------------------
+    def _answerProcessed(self, result, step):
         # Change client mode
         jsonData = {}
         jsonData['type'] = 'command'
         jsonData['command'] = 'kws'
         NeoContext.__factory.sendToClients(client_uids = step['clients'], zone_uids = step['zones'], jsonData = jsonData)
-        return True
 
     #-----------------------------------------------------------------------------
     @classmethod
-    def _create_step(cls, plugin_uid = None, context = None):
-        # Lock access
-        NeoContext.__lock.acquire()
+    def _getAnswerTimeout(cls, plugin_uid = None, timeout = None):
+        # Question timeout
+        if timeout is not None:
+            return timeout
 
-        # Create a step
-        step_uid = str(uuid.uuid1())
-        step = {'uid': step_uid, 'date': datetime.now(), 'previous': None, 'next': None, 'client_uid': None, 'client_previous': None, 'client_next': None, 'plugin_uid': plugin_uid, 'plugin_previous': None, 'plugin_next': None}
-        cls.__history[step_uid] = step
+        # Plugin timeout
+        plugin = PluginManager.getPlugin(plugin_uid = plugin_uid)
+        if plugin is not None and getattr(plugin, 'answer_timeout', None) is not None:
+            return plugin.answer_timeout
 
-        # First step
-        cls.__steps['count'] += 1
-        if cls.__steps['first'] is None:
-            cls.__steps['first'] = step_uid
+        # Server timeout
+        return configuration_server['answer_timeout']
 
-        # Link to last step
-        if cls.__steps['last'] is not None:
-            cls.__history[cls.__steps['last']]['next'] = step_uid
-            step['previous'] = cls.__history[cls.__steps['last']]['uid']
-        cls.__steps['last'] = step_uid
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def _setPluginLimits(cls, plugin):
+        # Plugin execution limits from its JSON, server defaults otherwise
+        cls.__executor.setLimits(plugin.uid, concurrency = getattr(plugin, 'max_concurrency', None),
+                                 queue_depth = getattr(plugin, 'queue_depth', None), timeout = getattr(plugin, 'exec_timeout', None))
 
-        # link to a client
-        if context is not None:
-            # Set client uid
-            step['client_uid'] = context.client['uid']
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def getPluginsStats(cls):
+        """
+        Return plugins execution statistics, by plugin uid
+        """
+        return cls.__executor.getStats()
 
-            # First client step
-            context._client_steps['count'] += 1
-            if context._client_steps['first'] is None:
-                context._client_steps['first'] = step_uid
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def getWorkersStats(cls):
+        """
+        Return workers processes statistics, empty when plugins run in the server
+        """
+        if cls.__workers is None:
+            return []
+        return cls.__workers.getStats()
 
-            # Link to client last step
-            if context._client_steps['last'] is not None:
-                cls.__history[context._client_steps['last']]['client_next'] = step_uid
-                step['client_previous'] = cls.__history[context._client_steps['last']]['uid']
-            context._client_steps['last'] = step_uid
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def _workerSpeak(cls, context, plugin_uid, message):
+        # Speech of a plugin in a worker process
+        if context is None:
+            cls.globalSpeakToClient(text = message['text'], plugin_uid = plugin_uid, client_uids = message['client_uids'], zone_uids = message['zone_uids'])
+        else:
+            context.speakToClient(plugin_uid = plugin_uid, text = message['text'], client_uids = message['client_uids'], zone_uids = message['zone_uids'])
+
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def _workerAsk(cls, context, plugin_uid, message, answer_cbk):
+        # Question of a plugin in a worker process, the answer callback is called in the worker
+        cls.globalAskToClient(text = message['text'], answer_cbk = answer_cbk, plugin_uid = plugin_uid, context = context, wit_context = message['wit_context'],
+                              client_uids = message['client_uids'], zone_uids = message['zone_uids'], timeout = message['timeout'])
+
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def getPendingQuestions(cls):
+        """
+        Return the number of questions waiting for an answer
+        """
+        return len(cls.__wheel)
+
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def _create_step(cls, plugin_uid = None, context = None):
+        # Create a step
+        step = Step(plugin_uid = plugin_uid)
+        client_steps = None
+        plugin_steps = None
+
+        # link to a client
+        if context is not None:
+            step.client_uid = context.client['uid']
+            client_steps = context._client_steps
 
         # link to a plugin
         if plugin_uid is not None:
-            # First plugin step
-            plugin = PluginManager.getPlugin(plugin_uid = plugin_uid)
-            plugin.steps['count'] += 1
-            if plugin.steps['first'] is None:
-                plugin.steps['first'] = step_uid
+            plugin_steps = PluginManager.getPluginSteps(plugin_uid = plugin_uid)
 
-            # Link to plugin last step
-            if plugin.steps['last'] is not None:
-                cls.__history[plugin.steps['last']]['plugin_next'] = step_uid
-                step['plugin_previous'] = cls.__history[plugin.steps['last']]['uid']
-            plugin.steps['last'] = step_uid
-
-        # Release access
-        cls.__lock.release()
+        # Add to history, oldest steps may be evicted, global order is given by the history
+        cls.__history.add(step, client_steps = client_steps, plugin_steps = plugin_steps)
 
         return step
 
@@ -379,16 +481,8 @@ class NeoContext():
     @classmethod
     def logSteps(cls):
         # TODO add debug tool that use this function
-        # Lock access
-        cls.__lock.acquire()
-
-        uid = cls.__steps['first']
-        while uid is not None:
-            print cls.__history[uid]
-            uid = cls.__history[uid]['next']
-
-        # Release access
-        cls.__lock.release()
+        for step in cls.__history.getSteps():
+            print step
 
     #-----------------------------------------------------------------------------
     @classmethod
@@ -396,29 +490,81 @@ class NeoContext():
         # Set factory
         cls.__factory = factory
 
+        # Create steps history
+        cls.__history = cls._createHistory()
+
+        # Create answers timeouts wheel
+        cls.__wheel = TimingWheel()
+
+        # Start plugins worker pool
+        cls.__executor = PluginExecutor(max_threads = configuration_server['plugin_threads'], concurrency = configuration_server['plugin_concurrency'],
+                                        queue_depth = configuration_server['plugin_queue_depth'], timeout = configuration_server['plugin_timeout'])
+        cls.__executor.start()
+
+        # Start plugins worker processes
+        if configuration_server['plugin_workers'] > 0:
+            cls.__workers = WorkerPool(count = configuration_server['plugin_workers'], shard = configuration_server['plugin_workers_shard'],
+                                       timeout = configuration_server['plugin_timeout'], on_speak = cls._workerSpeak, on_ask = cls._workerAsk,
+                                       config_file = ConfigManager.getConfigurationFile())
+            cls.__workers.start()
+
         # Init plugin manager
         PluginManager.init(global_context = cls)
 
+        # Compile context class, and init global variables
+        cls._compileContextClass(template = PluginManager.getContextTemplate())
+
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def getHistoryStats(cls):
+        return cls.__history.getStats()
+
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def _createHistory(cls):
+        # Storage for evicted steps
+        sink = None
+        if configuration_server['history_spill'] == "mongo":
+            sink = MongoStepSink(server = configuration_server['database']['server'], port = configuration_server['database']['port'], size = configuration_server['history_spill_size'])
+        elif configuration_server['history_spill'] == "file":
+            sink = FileStepSink(path = configuration_server['history_spill_file'])
+
+        return StepHistory(capacity = configuration_server['history_capacity'], retention = configuration_server['history_retention'],
+                           sink = sink, batch_size = configuration_server['history_spill_batch'])
+
     #-----------------------------------------------------------------------------
     @classmethod
     def deinit(cls):
-        # Lock access
-        cls.__lock.acquire()
+        # Write remaining steps
+        if cls.__history is not None:
+            cls.__history.clear()
+
+        # Stop answers timeouts
+        if cls.__wheel is not None:
+            cls.__wheel.stop()
+
+        # Stop plugins worker pool
+        if cls.__executor is not None:
+            cls.__executor.stop()
+
+        # Stop plugins worker processes
+        if cls.__workers is not None:
+            cls.__workers.stop()
 
         # Clean global vars
         cls.__global_ctx = None
         cls.__history = None
-        cls.__steps = None
-        cls.__Vars = None
+        cls.__wheel = None
+        cls.__executor = None
+        cls.__workers = None
+        cls.__Vars = {}
         cls._ = None
         cls.__factory = None
+        cls.__ContextClass = None
 
         # Deinit plugin manager
         PluginManager.deinit()
 
-        # Release access
-        cls.__lock.release()
-
     #-----------------------------------------------------------------------------
     @classmethod
     def createGlobalVar(cls, name, default = None):
@@ -446,4 +592,25 @@ class NeoContext():
     def _getGlobalVar(cls, name):
         return cls.__Vars[name]
 
+
+#-----------------------------------------------------------------------------
+# Tools
+#-----------------------------------------------------------------------------
+def _clientVarProperty(name):
+    # Accessor of a client variable
+    def fget(self):
+        return self.Vars[name]
+    def fset(self, value):
+        self.Vars[name] = value
+    return property(fget, fset)
+
+#-----------------------------------------------------------------------------
+def _globalVarProperty(name):
+    # Accessor of a global variable
+    def fget(self):
+        return NeoContext._getGlobalVar(name)
+    def fset(self, value):
+        NeoContext._setGlobalVar(name, value)
+    return property(fget, fset)
+
 # --------------------- End of NeoDialog.py  ---------------------
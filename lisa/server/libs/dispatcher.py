@@ -0,0 +1,146 @@
+# -*- coding: UTF-8 -*-
+#-----------------------------------------------------------------------------
+# project     : Lisa server
+# module      : libs
+# file        : dispatcher.py
+# description : Ordered processing of clients inputs
+# author      : G.Dumee
+#-----------------------------------------------------------------------------
+# copyright   : Neotique
+#-----------------------------------------------------------------------------
+
+
+#-----------------------------------------------------------------------------
+# Imports
+#-----------------------------------------------------------------------------
+import time
+from collections import deque
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.python.failure import Failure
+from twisted.python import log
+
+
+#-----------------------------------------------------------------------------
+# Exceptions
+#-----------------------------------------------------------------------------
+class DispatcherFull(Exception):
+    """
+    The client has too many pending inputs
+    """
+
+
+#-----------------------------------------------------------------------------
+# ClientDispatcher
+#-----------------------------------------------------------------------------
+class ClientDispatcher(object):
+    """
+    Process inputs of a client one after the other, clients in parallel
+
+    An input is processed when the Deferred returned by the previous input of
+    the same client has fired. A line identical to a pending one is collapsed
+    with it : it is not processed again, and gets the same result.
+
+    Must be used in the reactor thread.
+    """
+
+    #-----------------------------------------------------------------------------
+    def __init__(self, max_pending = 10, clock = None):
+        """
+        max_pending : maximum number of inputs waiting per client, 0 for no limit
+        clock : optional IReactorTime provider, used by tests
+        """
+        self.max_pending = max_pending
+        if clock is None:
+            self._now = time.time
+        else:
+            self._now = clock.seconds
+
+        # Clients states : key => state
+        self._clients = {}
+
+    #-----------------------------------------------------------------------------
+    def dispatch(self, key, line, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs) after pending inputs of client key
+
+        line : input line, None to never collapse this input
+        Return a Deferred fired with the result of func
+        """
+        state = self._getState(key)
+        d = Deferred()
+
+        # Collapse with a waiting identical line
+        if line is not None:
+            for entry in state['queue']:
+                if entry['line'] == line:
+                    state['collapsed'] += 1
+                    entry['waiters'].append(d)
+                    return d
+
+        # Too many waiting inputs
+        if self.max_pending > 0 and len(state['queue']) >= self.max_pending:
+            state['rejected'] += 1
+            d.errback(DispatcherFull("Client {key} has too many pending inputs".format(key = key)))
+            return d
+
+        # Queue input
+        state['queue'].append({'line': line, 'func': func, 'args': args, 'kwargs': kwargs, 'queued': self._now(), 'waiters': [d]})
+        state['depth_max'] = max(state['depth_max'], len(state['queue']))
+        self._next(state)
+        return d
+
+    #-----------------------------------------------------------------------------
+    def getStats(self):
+        """
+        Return statistics per client key : queue depth, inputs counts, wait times in seconds
+        """
+        stats = {}
+        for key, state in self._clients.iteritems():
+            stats[key] = dict((name, state[name]) for name in ('running', 'depth_max', 'processed', 'collapsed', 'rejected', 'wait_max'))
+            stats[key]['depth'] = len(state['queue'])
+            stats[key]['wait_avg'] = state['wait_total'] / state['processed'] if state['processed'] > 0 else 0.0
+        return stats
+
+    #-----------------------------------------------------------------------------
+    def _getState(self, key):
+        state = self._clients.get(key)
+        if state is None:
+            state = {'key': key, 'queue': deque(), 'running': False, 'depth_max': 0,
+                     'processed': 0, 'collapsed': 0, 'rejected': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+            self._clients[key] = state
+        return state
+
+    #-----------------------------------------------------------------------------
+    def _next(self, state):
+        # Client is busy, or nothing to do
+        if state['running'] == True or len(state['queue']) == 0:
+            return
+
+        # Start next input
+        entry = state['queue'].popleft()
+        state['running'] = True
+        state['processed'] += 1
+        wait = self._now() - entry['queued']
+        state['wait_total'] += wait
+        state['wait_max'] = max(state['wait_max'], wait)
+
+        d = maybeDeferred(entry['func'], *entry['args'], **entry['kwargs'])
+        d.addBoth(self._ended, state, entry)
+
+    #-----------------------------------------------------------------------------
+    def _ended(self, result, state, entry):
+        # Give result to all collapsed inputs
+        for d in entry['waiters']:
+            try:
+                if isinstance(result, Failure) == True:
+                    d.errback(result)
+                else:
+                    d.callback(result)
+            except:
+                log.err(None, "Error in client {key} input callback".format(key = state['key']))
+
+        # Next input of client
+        state['running'] = False
+        self._next(state)
+
+# --------------------- End of dispatcher.py  ---------------------
@@ -0,0 +1,298 @@
+# -*- coding: UTF-8 -*-
+#-----------------------------------------------------------------------------
+# project     : Lisa server
+# module      : libs
+# file        : executor.py
+# description : Plugins methods execution in a worker pool
+# author      : G.Dumee
+#-----------------------------------------------------------------------------
+# copyright   : Neotique
+#-----------------------------------------------------------------------------
+
+
+#-----------------------------------------------------------------------------
+# Imports
+#-----------------------------------------------------------------------------
+import time, threading
+from collections import deque
+from twisted.internet.defer import Deferred
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+from twisted.python.failure import Failure
+from twisted.python import log, threadable
+
+
+#-----------------------------------------------------------------------------
+# Exceptions
+#-----------------------------------------------------------------------------
+class ExecutorFull(Exception):
+    """
+    The plugin has too many calls waiting
+    """
+
+#-----------------------------------------------------------------------------
+class ExecutorTimeout(Exception):
+    """
+    The plugin call did not end in time
+    """
+
+
+#-----------------------------------------------------------------------------
+# PluginExecutor
+#-----------------------------------------------------------------------------
+class PluginExecutor(object):
+    """
+    Execute plugins methods in a bounded thread pool
+
+    Each plugin has a maximum number of concurrent calls, a maximum number of
+    waiting calls, and a timeout. On timeout the caller gets an ExecutorTimeout
+    failure : the thread can't be stopped, so the call keeps its slot until it
+    really ends, and only its plugin is slowed down.
+
+    Calls may be made from any thread, results are returned in the reactor thread.
+
+    Running calls may wait for the reactor (steps history, nested calls), so the
+    pool is stopped before the reactor shutdown, while the reactor still runs.
+    """
+
+    #-----------------------------------------------------------------------------
+    def __init__(self, max_threads = 10, concurrency = 2, queue_depth = 20, timeout = 30, reactor = None):
+        """
+        max_threads : size of the thread pool
+        concurrency, queue_depth, timeout : default limits of a plugin, timeout in seconds, 0 for no timeout
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._pool = ThreadPool(minthreads = 0, maxthreads = max_threads, name = "plugins")
+        self.concurrency = concurrency
+        self.queue_depth = queue_depth
+        self.timeout = timeout
+
+        # Plugins states : key => state
+        self._plugins = {}
+
+        # Stop state : shutdown trigger, Deferreds waiting for the end of threads
+        self._trigger = None
+        self._stopped = False
+        self._stop_waiters = None
+
+    #-----------------------------------------------------------------------------
+    def start(self):
+        self._pool.start()
+        self._stopped = False
+
+        # The reactor waits for 'before' shutdown triggers only
+        self._trigger = self._reactor.addSystemEventTrigger('before', 'shutdown', self._shutdown)
+
+    #-----------------------------------------------------------------------------
+    def _shutdown(self):
+        self._trigger = None
+        return self.stop()
+
+    #-----------------------------------------------------------------------------
+    def stop(self):
+        """
+        Stop the pool, return a Deferred fired when its threads have ended
+
+        New and waiting calls are rejected with ExecutorFull. In the reactor
+        thread, threads are joined in another thread : running calls waiting
+        for the reactor can end.
+        """
+        d = Deferred()
+        if self._stop_waiters is not None:
+            self._stop_waiters.append(d)
+            return d
+        if self._trigger is not None:
+            self._reactor.removeSystemEventTrigger(self._trigger)
+            self._trigger = None
+        if self._stopped == True or self._pool.started == False:
+            self._stopped = True
+            d.callback(None)
+            return d
+        self._stopped = True
+        self._stop_waiters = [d]
+
+        # Reject waiting calls
+        for state in self._plugins.itervalues():
+            while len(state['queue']) > 0:
+                self._reject(state, state['queue'].popleft(), "Plugins executor is stopped")
+
+        # Join threads
+        if threadable.ioThread is not None and threadable.isInIOThread() == True:
+            threading.Thread(target = self._join, name = "plugins stop").start()
+        else:
+            self._pool.stop()
+            self._joined()
+        return d
+
+    #-----------------------------------------------------------------------------
+    def _join(self):
+        # In a helper thread
+        self._pool.stop()
+        self._reactor.callFromThread(self._joined)
+
+    #-----------------------------------------------------------------------------
+    def _joined(self):
+        waiters, self._stop_waiters = self._stop_waiters, None
+        for d in waiters:
+            d.callback(None)
+
+    #-----------------------------------------------------------------------------
+    def run(self, key, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs) in the pool, return a Deferred fired in the reactor thread
+
+        key : plugin key, limits and statistics are per key
+        """
+        return self._run(key, func, args, kwargs, None)
+
+    #-----------------------------------------------------------------------------
+    def runTracked(self, key, func, *args, **kwargs):
+        """
+        Like run, also return a Deferred fired with None when the call really ends
+
+        After a timeout, the call keeps running in its thread : the second
+        Deferred tells when its slot is released. Return (result, end) Deferreds.
+        """
+        end = Deferred()
+        return self._run(key, func, args, kwargs, end), end
+
+    #-----------------------------------------------------------------------------
+    def _run(self, key, func, args, kwargs, end):
+        d = Deferred()
+        call = {'d': d, 'end': end, 'func': func, 'args': args, 'kwargs': kwargs, 'queued': time.time(), 'timer': None}
+
+        # Plugins may call other plugins from a pool thread
+        if threadable.ioThread is not None and threadable.isInIOThread() == False:
+            self._reactor.callFromThread(self._submit, key, call)
+        else:
+            self._submit(key, call)
+        return d
+
+    #-----------------------------------------------------------------------------
+    def _submit(self, key, call):
+        state = self._getState(key)
+
+        # Stopped pool
+        if self._stopped == True:
+            self._reject(state, call, "Plugins executor is stopped")
+            return
+
+        # Too many waiting calls
+        if state['running'] >= state['concurrency'] and len(state['queue']) >= state['queue_depth']:
+            self._reject(state, call, "Plugin {key} has too many waiting calls".format(key = key))
+            return
+
+        # Queue call
+        state['queue'].append(call)
+        self._next(state)
+
+    #-----------------------------------------------------------------------------
+    def setLimits(self, key, concurrency = None, queue_depth = None, timeout = None):
+        """
+        Set limits of a plugin, None keeps the default
+        """
+        state = self._getState(key)
+        state['concurrency'] = self.concurrency if concurrency is None else max(concurrency, 1)
+        state['queue_depth'] = self.queue_depth if queue_depth is None else queue_depth
+        state['timeout'] = self.timeout if timeout is None else timeout
+        self._next(state)
+
+    #-----------------------------------------------------------------------------
+    def getStats(self):
+        """
+        Return statistics per plugin key : calls, queue wait and execution times in seconds
+        """
+        stats = {}
+        for key, state in self._plugins.iteritems():
+            stats[key] = dict((name, state[name]) for name in ('running', 'concurrency', 'queue_depth', 'timeout', 'calls', 'errors',
+                                                              'timeouts', 'rejected', 'wait_max', 'exec_max'))
+            stats[key]['waiting'] = len(state['queue'])
+            stats[key]['wait_avg'] = state['wait_total'] / state['calls'] if state['calls'] > 0 else 0.0
+            stats[key]['exec_avg'] = state['exec_total'] / state['ended'] if state['ended'] > 0 else 0.0
+        return stats
+
+    #-----------------------------------------------------------------------------
+    def _getState(self, key):
+        state = self._plugins.get(key)
+        if state is None:
+            state = {'key': key, 'queue': deque(), 'running': 0,
+                     'concurrency': self.concurrency, 'queue_depth': self.queue_depth, 'timeout': self.timeout,
+                     'calls': 0, 'ended': 0, 'errors': 0, 'timeouts': 0, 'rejected': 0,
+                     'wait_total': 0.0, 'wait_max': 0.0, 'exec_total': 0.0, 'exec_max': 0.0}
+            self._plugins[key] = state
+        return state
+
+    #-----------------------------------------------------------------------------
+    def _next(self, state):
+        # Start waiting calls while there are free slots
+        while state['running'] < state['concurrency'] and len(state['queue']) > 0:
+            call = state['queue'].popleft()
+            state['running'] += 1
+            state['calls'] += 1
+            wait = time.time() - call['queued']
+            state['wait_total'] += wait
+            state['wait_max'] = max(state['wait_max'], wait)
+
+            # Caller timeout
+            if state['timeout'] > 0:
+                call['timer'] = self._reactor.callLater(state['timeout'], self._timeout, state, call)
+
+            d = deferToThreadPool(self._reactor, self._pool, self._execute, call['func'], *call['args'], **call['kwargs'])
+            d.addCallback(self._ended, state, call)
+            d.addErrback(log.err)
+
+    #-----------------------------------------------------------------------------
+    def _reject(self, state, call, reason):
+        state['rejected'] += 1
+        call['d'].errback(ExecutorFull(reason))
+        if call['end'] is not None:
+            call['end'].callback(None)
+
+    #-----------------------------------------------------------------------------
+    def _execute(self, func, *args, **kwargs):
+        # In a pool thread : return (success, result or failure, execution time)
+        start = time.time()
+        try:
+            result = func(*args, **kwargs)
+            return (True, result, time.time() - start)
+        except:
+            return (False, Failure(), time.time() - start)
+
+    #-----------------------------------------------------------------------------
+    def _timeout(self, state, call):
+        call['timer'] = None
+        state['timeouts'] += 1
+        log.err("Plugin {key} call did not end after {timeout}s".format(key = state['key'], timeout = state['timeout']))
+        d, call['d'] = call['d'], None
+        d.errback(ExecutorTimeout("Plugin {key} call did not end in time".format(key = state['key'])))
+
+    #-----------------------------------------------------------------------------
+    def _ended(self, outcome, state, call):
+        # Release slot
+        state['running'] -= 1
+        state['ended'] += 1
+        if call['timer'] is not None:
+            call['timer'].cancel()
+            call['timer'] = None
+
+        # Statistics
+        success, result, exec_time = outcome
+        if success == False:
+            state['errors'] += 1
+        state['exec_total'] += exec_time
+        state['exec_max'] = max(state['exec_max'], exec_time)
+
+        # Start next call, then return result to caller if it did not time out
+        self._next(state)
+        d, call['d'] = call['d'], None
+        if d is not None:
+            if success == True:
+                d.callback(result)
+            else:
+                d.errback(result)
+        if call['end'] is not None:
+            call['end'].callback(None)
+
+# --------------------- End of executor.py  ---------------------
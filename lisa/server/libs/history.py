@@ -0,0 +1,454 @@
+# -*- coding: UTF-8 -*-
+#-----------------------------------------------------------------------------
+# project     : Lisa server
+# module      : libs
+# file        : history.py
+# description : Bounded dialog steps history
+# author      : G.Dumee
+#-----------------------------------------------------------------------------
+# copyright   : Neotique
+#-----------------------------------------------------------------------------
+
+
+#-----------------------------------------------------------------------------
+# Imports
+#-----------------------------------------------------------------------------
+import json, threading
+from datetime import datetime
+from twisted.python import log, threadable
+
+
+#-----------------------------------------------------------------------------
+# Globals
+#-----------------------------------------------------------------------------
+# Step keys holding live objects, never written to storage
+_transient_keys = ('answer_cbk', 'wait_timer')
+
+
+#-----------------------------------------------------------------------------
+# Step
+#-----------------------------------------------------------------------------
+class Step(object):
+    """
+    Dialog step
+
+    Links to other steps are integer uids. Other fields (in_json, message...)
+    are stored in a dict allocated on first use. The step can be read and
+    written like a dict for debug code.
+    """
+    __slots__ = ('uid', 'date', 'type', 'previous', 'next', 'client_uid', 'client_previous', 'client_next',
+                 'plugin_uid', 'plugin_previous', 'plugin_next', '_extra', '_client_chain', '_plugin_chain')
+
+    # Fields seen as dict keys
+    _fields = __slots__[:11]
+
+    #-----------------------------------------------------------------------------
+    def __init__(self, type = None, client_uid = None, plugin_uid = None):
+        self.uid = None
+        self.date = None
+        self.type = type
+        self.previous = None
+        self.next = None
+        self.client_uid = client_uid
+        self.client_previous = None
+        self.client_next = None
+        self.plugin_uid = plugin_uid
+        self.plugin_previous = None
+        self.plugin_next = None
+        self._extra = None
+        self._client_chain = None
+        self._plugin_chain = None
+
+    #-----------------------------------------------------------------------------
+    def __getitem__(self, key):
+        if key == 'date' and self.date is not None:
+            return datetime.fromtimestamp(self.date)
+        if key in Step._fields:
+            return getattr(self, key)
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    #-----------------------------------------------------------------------------
+    def __setitem__(self, key, value):
+        if key in Step._fields:
+            setattr(self, key, value)
+            return
+        if self._extra is None:
+            self._extra = {}
+        self._extra[key] = value
+
+    #-----------------------------------------------------------------------------
+    def __contains__(self, key):
+        return key in Step._fields or (self._extra is not None and key in self._extra)
+
+    #-----------------------------------------------------------------------------
+    def has_key(self, key):
+        return key in self
+
+    #-----------------------------------------------------------------------------
+    def get(self, key, default = None):
+        if key in self:
+            return self[key]
+        return default
+
+    #-----------------------------------------------------------------------------
+    def pop(self, key, *default):
+        if key in Step._fields:
+            raise KeyError("Step field {key} can't be removed".format(key = key))
+        if self._extra is None:
+            if len(default) > 0:
+                return default[0]
+            raise KeyError(key)
+        return self._extra.pop(key, *default)
+
+    #-----------------------------------------------------------------------------
+    def keys(self):
+        keys = list(Step._fields)
+        if self._extra is not None:
+            keys.extend(self._extra)
+        return keys
+
+    #-----------------------------------------------------------------------------
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self[key]
+
+    #-----------------------------------------------------------------------------
+    def items(self):
+        return list(self.iteritems())
+
+    #-----------------------------------------------------------------------------
+    def copy(self):
+        """
+        Return a dict copy of the step
+        """
+        return dict(self.iteritems())
+
+    #-----------------------------------------------------------------------------
+    def __repr__(self):
+        return repr(self.copy())
+
+
+#-----------------------------------------------------------------------------
+# StepHistory
+#-----------------------------------------------------------------------------
+class StepHistory(object):
+    """
+    Fixed capacity ring of dialog steps
+
+    Steps get increasing integer uids and are stored in a list at index
+    uid % capacity. They are linked in chains : the global one, one per client
+    and one per plugin. Each chain is described by a dict {'count', 'first', 'last'}.
+    When a step is evicted, the chains heads and the links of the following
+    steps are updated, so the navigation stays consistent on the steps still
+    in memory.
+
+    A step is evicted when the ring is full, or when it is older than the
+    retention. Evicted steps are optionally written by batches to a sink.
+
+    The ring and the chains belong to the reactor thread, so they need no
+    lock : a step added from another thread is added by the reactor, the
+    calling thread waits for its uid. Only the spill counters, updated by the
+    writing threads, have a lock.
+    """
+
+    #-----------------------------------------------------------------------------
+    def __init__(self, capacity = 10000, retention = 0, sink = None, batch_size = 100, max_batches = 10, clock = None):
+        """
+        capacity : maximum number of steps in memory
+        retention : maximum age of a step in memory in seconds, 0 for no limit
+        sink : optional object with a write(docs) method, called in a thread
+        batch_size : number of evicted steps written at once
+        max_batches : maximum number of batches waiting to be written, next ones are dropped
+        clock : optional clock with a seconds() method, reactor by default
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.capacity = max(capacity, 1)
+        self.retention = retention
+        self.sink = sink
+        self.batch_size = max(batch_size, 1)
+        self.max_batches = max_batches
+        self._clock = clock
+        self._spill_lock = threading.Lock()
+
+        # Global chain
+        self.steps = {'count': 0, 'first': None, 'last': None}
+
+        # Ring : steps with uids from _oldest to _next - 1
+        self._ring = [None] * self.capacity
+        self._oldest = 1
+        self._next = 1
+
+        # Evicted steps waiting to be written
+        self._batch = []
+        self._writing = 0
+
+        # Counters
+        self.evicted = 0
+        self.spilled = 0
+        self.spill_dropped = 0
+
+    #-----------------------------------------------------------------------------
+    def add(self, step, client_steps = None, plugin_steps = None):
+        """
+        Set step uid, and link it at the end of its chains
+
+        client_steps : chain of the client of the step
+        plugin_steps : chain of the plugin of the step
+        """
+        # Plugins add steps from worker threads, the history is updated in reactor thread only
+        if threadable.ioThread is not None and threadable.isInIOThread() == False:
+            from twisted.internet import reactor, threads
+            return threads.blockingCallFromThread(reactor, self.add, step, client_steps = client_steps, plugin_steps = plugin_steps)
+
+        self._add(step, self._clock.seconds(), client_steps, plugin_steps)
+        return step
+
+    #-----------------------------------------------------------------------------
+    def _add(self, step, now, client_steps, plugin_steps):
+        # Evict old steps
+        if self.retention > 0:
+            self._expire(now)
+        if self._next - self._oldest >= self.capacity:
+            self._evictOldest()
+
+        # Store step
+        uid = self._next
+        self._next += 1
+        step.uid = uid
+        step.date = now
+        self._ring[uid % self.capacity] = step
+
+        # Link step
+        step.previous = self._link(self.steps, uid)
+        if step.previous is not None:
+            self._ring[step.previous % self.capacity].next = uid
+        if client_steps is not None:
+            step._client_chain = client_steps
+            step.client_previous = self._link(client_steps, uid)
+            if step.client_previous is not None:
+                self._ring[step.client_previous % self.capacity].client_next = uid
+        if plugin_steps is not None:
+            step._plugin_chain = plugin_steps
+            step.plugin_previous = self._link(plugin_steps, uid)
+            if step.plugin_previous is not None:
+                self._ring[step.plugin_previous % self.capacity].plugin_next = uid
+
+    #-----------------------------------------------------------------------------
+    def get(self, uid):
+        """
+        Get a step, None if it was evicted
+        """
+        if uid is None or uid < self._oldest or uid >= self._next:
+            return None
+        return self._ring[uid % self.capacity]
+
+    #-----------------------------------------------------------------------------
+    def getSteps(self):
+        """
+        Return the steps in memory, oldest first
+        """
+        return [self._ring[uid % self.capacity] for uid in xrange(self._oldest, self._next)]
+
+    #-----------------------------------------------------------------------------
+    def __len__(self):
+        return self._next - self._oldest
+
+    #-----------------------------------------------------------------------------
+    def expire(self):
+        """
+        Evict steps older than retention
+        """
+        if self.retention > 0:
+            self._expire(self._clock.seconds())
+
+    #-----------------------------------------------------------------------------
+    def flush(self):
+        """
+        Write pending evicted steps synchronously
+        """
+        batch, self._batch = self._batch, []
+        if self.sink is not None and len(batch) > 0:
+            self._writeBatch(batch)
+
+    #-----------------------------------------------------------------------------
+    def clear(self):
+        """
+        Evict all steps, then write them synchronously, used on shutdown
+        """
+        while self._next > self._oldest:
+            self._evictOldest(spill = False)
+        self.flush()
+
+    #-----------------------------------------------------------------------------
+    def getStats(self):
+        with self._spill_lock:
+            return {'size': len(self), 'capacity': self.capacity, 'evicted': self.evicted,
+                    'pending': len(self._batch), 'writing': self._writing, 'spilled': self.spilled,
+                    'spill_dropped': self.spill_dropped}
+
+    #-----------------------------------------------------------------------------
+    def _link(self, chain, uid):
+        # Add uid at the end of a chain, return previous last uid
+        previous = chain['last']
+        chain['count'] += 1
+        if chain['first'] is None:
+            chain['first'] = uid
+        chain['last'] = uid
+        return previous
+
+    #-----------------------------------------------------------------------------
+    def _expire(self, now):
+        while self._next > self._oldest and now - self._ring[self._oldest % self.capacity].date >= self.retention:
+            self._evictOldest()
+
+    #-----------------------------------------------------------------------------
+    def _evictOldest(self, spill = True):
+        index = self._oldest % self.capacity
+        step = self._ring[index]
+        self._ring[index] = None
+        self._oldest += 1
+        self.evicted += 1
+
+        # Unlink step from its chains
+        self._unlink(self.steps, step.uid, step.next)
+        if step.next is not None:
+            self._ring[step.next % self.capacity].previous = None
+        if step._client_chain is not None:
+            self._unlink(step._client_chain, step.uid, step.client_next)
+            if step.client_next is not None:
+                self._ring[step.client_next % self.capacity].client_previous = None
+            step._client_chain = None
+        if step._plugin_chain is not None:
+            self._unlink(step._plugin_chain, step.uid, step.plugin_next)
+            if step.plugin_next is not None:
+                self._ring[step.plugin_next % self.capacity].plugin_previous = None
+            step._plugin_chain = None
+
+        # Spill step
+        if self.sink is None:
+            return
+        self._batch.append(self._export(step))
+        if spill == True and len(self._batch) >= self.batch_size:
+            batch, self._batch = self._batch, []
+            with self._spill_lock:
+                if self._writing >= self.max_batches:
+                    self.spill_dropped += len(batch)
+                    return
+                self._writing += 1
+            self._write(batch)
+
+    #-----------------------------------------------------------------------------
+    def _unlink(self, chain, uid, next_uid):
+        # Remove the first step of a chain
+        if chain['first'] == uid:
+            chain['first'] = next_uid
+        if chain['last'] == uid:
+            chain['last'] = None
+
+    #-----------------------------------------------------------------------------
+    def _write(self, batch):
+        # Write in a thread of the reactor pool
+        from twisted.internet import reactor
+        reactor.callInThread(self._writeBatch, batch, True)
+
+    #-----------------------------------------------------------------------------
+    def _writeBatch(self, batch, threaded = False):
+        written = 0
+        try:
+            self.sink.write(batch)
+            written = len(batch)
+        except:
+            log.err(None, "Error writing {count} dialog steps".format(count = len(batch)))
+
+        # Update counters
+        with self._spill_lock:
+            if threaded == True:
+                self._writing -= 1
+            self.spilled += written
+
+    #-----------------------------------------------------------------------------
+    def _export(self, step):
+        # Copy storable values of a step
+        doc = {}
+        for key, value in step.iteritems():
+            if key in _transient_keys:
+                continue
+            if key == 'answer_step' and value is not None:
+                value = value['uid']
+            doc[key] = value
+        return doc
+
+
+#-----------------------------------------------------------------------------
+# FileStepSink
+#-----------------------------------------------------------------------------
+class FileStepSink(object):
+    """
+    Append evicted steps to a file, one json document per line
+    """
+
+    #-----------------------------------------------------------------------------
+    def __init__(self, path):
+        self.path = path
+
+    #-----------------------------------------------------------------------------
+    def write(self, docs):
+        lines = [json.dumps(doc, default = _json_default) for doc in docs]
+        with open(self.path, 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+#-----------------------------------------------------------------------------
+# MongoStepSink
+#-----------------------------------------------------------------------------
+class MongoStepSink(object):
+    """
+    Insert evicted steps in a capped Mongo collection
+    """
+
+    #-----------------------------------------------------------------------------
+    def __init__(self, server, port, collection = "steps", size = 16 * 1024 * 1024):
+        self.server = server
+        self.port = port
+        self.collection_name = collection
+        self.size = size
+        self._collection = None
+
+    #-----------------------------------------------------------------------------
+    def write(self, docs):
+        if self._collection is None:
+            self._collection = self._open()
+        self._collection.insert_many([_storable(doc) for doc in docs], ordered = False)
+
+    #-----------------------------------------------------------------------------
+    def _open(self):
+        from pymongo import MongoClient
+        database = MongoClient(self.server, self.port).lisa
+        if self.collection_name not in database.collection_names():
+            database.create_collection(self.collection_name, capped = True, size = self.size)
+        return database[self.collection_name]
+
+
+#-----------------------------------------------------------------------------
+# Tools
+#-----------------------------------------------------------------------------
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return repr(value)
+
+#-----------------------------------------------------------------------------
+def _storable(value):
+    # Convert a value to types accepted by Mongo
+    if isinstance(value, dict):
+        return dict((unicode(k), _storable(v)) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [_storable(v) for v in value]
+    if value is None or isinstance(value, (basestring, bool, int, long, float, datetime)):
+        return value
+    return repr(value)
+
+# --------------------- End of history.py  ---------------------
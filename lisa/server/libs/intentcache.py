@@ -0,0 +1,110 @@
+# -*- coding: UTF-8 -*-
+#-----------------------------------------------------------------------------
+# project     : Lisa server
+# module      : libs
+# file        : intentcache.py
+# description : Cache of decoded intents
+# author      : G.Dumee
+#-----------------------------------------------------------------------------
+# copyright   : Neotique
+#-----------------------------------------------------------------------------
+
+
+#-----------------------------------------------------------------------------
+# Imports
+#-----------------------------------------------------------------------------
+import json, copy, threading, time
+from collections import OrderedDict
+
+
+#-----------------------------------------------------------------------------
+# IntentCache
+#-----------------------------------------------------------------------------
+class IntentCache(object):
+    """
+    Bounded cache of decoded intents
+
+    Entries expire after a TTL, the least recently used entry is evicted
+    when the cache is full
+    """
+
+    #-----------------------------------------------------------------------------
+    def __init__(self, size = 1000, ttl = 3600, clock = None):
+        """
+        size : maximum number of entries, 0 disables the cache
+        ttl : lifetime of an entry in seconds, 0 for no expiration
+        clock : optional IReactorTime provider, used by tests
+        """
+        self.size = size
+        self.ttl = ttl
+        if clock is None:
+            self._now = time.time
+        else:
+            self._now = clock.seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    #-----------------------------------------------------------------------------
+    @staticmethod
+    def makeKey(text, lang, context = None):
+        """
+        Build a cache key from an utterance, a language and an optional Wit context
+        """
+        text = u' '.join(unicode(text).lower().split())
+        if context is None:
+            return (text, lang, None)
+        return (text, lang, json.dumps(context, sort_keys = True))
+
+    #-----------------------------------------------------------------------------
+    def get(self, key):
+        """
+        Return a copy of the cached value, None when not found or expired
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or (self.ttl > 0 and entry[0] + self.ttl <= self._now()):
+                self.misses += 1
+                return None
+
+            # Most recently used entry is the last one
+            self._entries[key] = entry
+            self.hits += 1
+
+        return copy.deepcopy(entry[1])
+
+    #-----------------------------------------------------------------------------
+    def set(self, key, value):
+        """
+        Store a copy of the value
+        """
+        if self.size <= 0:
+            return
+
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (self._now(), value)
+
+            # Evict least recently used entries
+            while len(self._entries) > self.size:
+                self._entries.popitem(last = False)
+                self.evictions += 1
+
+    #-----------------------------------------------------------------------------
+    def flush(self):
+        """
+        Remove all entries
+        """
+        with self._lock:
+            self._entries.clear()
+
+    #-----------------------------------------------------------------------------
+    def getStats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+# --------------------- End of intentcache.py  ---------------------
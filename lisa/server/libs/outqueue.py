@@ -0,0 +1,151 @@
+# -*- coding: UTF-8 -*-
+#-----------------------------------------------------------------------------
+# project     : Lisa server
+# module      : libs
+# file        : outqueue.py
+# description : Outbound queue of a client connection
+# author      : G.Dumee
+#-----------------------------------------------------------------------------
+# copyright   : Neotique
+#-----------------------------------------------------------------------------
+
+
+#-----------------------------------------------------------------------------
+# Imports
+#-----------------------------------------------------------------------------
+from collections import deque
+from zope.interface import implementer
+from twisted.internet.interfaces import IPushProducer
+from twisted.python import log
+
+
+#-----------------------------------------------------------------------------
+# OutboundQueue
+#-----------------------------------------------------------------------------
+@implementer(IPushProducer)
+class OutboundQueue(object):
+    """
+    Bounded outbound queue of a connection
+
+    The queue is registered as a push producer on the transport : lines are
+    written directly while the transport accepts data, and queued while it is
+    paused. When the queue reaches its high water mark, the overflow policy is
+    applied :
+        drop_oldest : the oldest queued line is dropped
+        coalesce : a queued line with the same key is removed and the new line queued
+                   at the tail, so commands keep their order, else the oldest is dropped
+        disconnect : the connection is aborted
+    The connection is reported as congested until the queue is back under its
+    low water mark.
+    """
+    policies = ('drop_oldest', 'coalesce', 'disconnect')
+
+    #-----------------------------------------------------------------------------
+    def __init__(self, send, disconnect, name = "", high_water = 1000, low_water = 100, policy = 'drop_oldest'):
+        """
+        send : function writing a line on the transport
+        disconnect : function aborting the connection
+        name : connection name for logs
+        """
+        if policy not in OutboundQueue.policies:
+            raise ValueError("Unknown overflow policy {policy}".format(policy = policy))
+        self._send = send
+        self._disconnect = disconnect
+        self.name = name
+        self.high_water = high_water
+        self.low_water = min(low_water, high_water)
+        self.policy = policy
+
+        # State
+        self._queue = deque()
+        self.paused = False
+        self.stopped = False
+        self.congested = False
+
+        # Counters
+        self.sent = 0
+        self.queued = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.pauses = 0
+        self.max_depth = 0
+
+    #-----------------------------------------------------------------------------
+    def push(self, line, key = None):
+        """
+        Send a line, or queue it when the transport is paused
+
+        key : optional key used by the coalesce policy
+        """
+        if self.stopped == True:
+            return
+
+        # Write directly when possible
+        if self.paused == False and len(self._queue) == 0:
+            self._send(line)
+            self.sent += 1
+            return
+
+        # Queue is full
+        if len(self._queue) >= self.high_water:
+            if self.congested == False:
+                self.congested = True
+                log.err(u"Outbound queue of {name} is full, applying {policy} policy".format(name = self.name, policy = self.policy))
+
+            if self.policy == 'disconnect':
+                self.stopProducing()
+                self._disconnect()
+                return
+            elif self.policy == 'coalesce' and key is not None and self._coalesce(key) == True:
+                pass
+            else:
+                self._queue.popleft()
+                self.dropped += 1
+
+        # Queue line
+        self._queue.append((line, key))
+        self.queued += 1
+        self.max_depth = max(self.max_depth, len(self._queue))
+
+    #-----------------------------------------------------------------------------
+    def pauseProducing(self):
+        self.paused = True
+        self.pauses += 1
+
+    #-----------------------------------------------------------------------------
+    def resumeProducing(self):
+        self.paused = False
+
+        # Write queued lines until transport is paused again
+        while len(self._queue) > 0 and self.paused == False and self.stopped == False:
+            line, key = self._queue.popleft()
+            self._send(line)
+            self.sent += 1
+
+        # End of congestion
+        if self.congested == True and len(self._queue) <= self.low_water:
+            self.congested = False
+            log.msg(u"Outbound queue of {name} is back under its low water mark".format(name = self.name))
+
+    #-----------------------------------------------------------------------------
+    def stopProducing(self):
+        self.stopped = True
+        self._queue.clear()
+
+    #-----------------------------------------------------------------------------
+    def getStats(self):
+        return {'depth': len(self._queue), 'max_depth': self.max_depth, 'sent': self.sent, 'queued': self.queued,
+                'dropped': self.dropped, 'coalesced': self.coalesced, 'pauses': self.pauses,
+                'paused': self.paused, 'congested': self.congested}
+
+    #-----------------------------------------------------------------------------
+    def _coalesce(self, key):
+        # Remove the last queued line with the same key, the new line is queued after later commands
+        for i in range(len(self._queue) - 1, -1, -1):
+            if self._queue[i][1] == key:
+                del self._queue[i]
+                self.coalesced += 1
+                return True
+        return False
+
+# --------------------- End of outqueue.py  ---------------------
@@ -16,15 +16,20 @@
 import os, json, sys, uuid, threading
 from twisted.internet.protocol import Factory
 from twisted.protocols.basic import LineReceiver
-from twisted.python import log
-from twisted.internet import ssl
+from twisted.python import log, threadable
+from twisted.internet import ssl, reactor, threads
+from twisted.internet.defer import succeed
 from OpenSSL import SSL
 from lisa.server.libs.txscheduler.manager import ScheduledTaskManager
 from lisa.server.libs.txscheduler.service import ScheduledTaskService
 from lisa.server.plugins.PluginManager import PluginManager
 from lisa.server.config_manager import ConfigManager
+from lisa.server.libs.witclient import WitClient
+from lisa.server.libs.intentcache import IntentCache
+from lisa.server.libs.singleflight import SingleFlight
+from lisa.server.libs.outqueue import OutboundQueue
+from lisa.server.libs.dispatcher import ClientDispatcher, DispatcherFull
 from NeoDialog import NeoContext
-from wit import Wit
 
 
 #-----------------------------------------------------------------------------
@@ -59,6 +64,8 @@ class LisaProtocol(LineReceiver):
     def __init__(self):
         self.uid = str(uuid.uuid1())
         self.client = None
+        self._json_header = None
+        self.queue = None
 
     #-----------------------------------------------------------------------------
     def connectionMade(self):
@@ -72,12 +79,23 @@ class LisaProtocol(LineReceiver):
             )
             self.transport.startTLS(ctx, ClientFactory.get())
 
+        # Outbound queue, paused by transport when its buffer is full
+        self.queue = OutboundQueue(send = self.sendLine, disconnect = self._abort, name = self.uid,
+                                   high_water = configuration['client_queue_high_water'],
+                                   low_water = configuration['client_queue_low_water'],
+                                   policy = configuration['client_queue_policy'])
+        self.transport.registerProducer(self.queue, True)
+
     #-----------------------------------------------------------------------------
     def connectionLost(self, reason):
+        # Stop outbound queue
+        if self.queue is not None:
+            self.queue.stopProducing()
+
         # Remove protocol from client
         if self.client is not None:
-            log.err("Lost connection with client {name} in zone {zone} with reason : {reason}".format(name = self.client['name'], zone = self.client['zone'], reason = str(reason)))
-            self.client['protocols'].pop(self.uid)
+            log.err(u"Lost connection with client {name} in zone {zone} with reason : {reason}".format(name = self.client['name'], zone = self.client['zone'], reason = str(reason)))
+            ClientFactory.removeProtocol(client_uid = self.client['uid'], protocol = self)
         else:
             log.err("Lost connection with unlogged client")
 
@@ -85,7 +103,7 @@ class LisaProtocol(LineReceiver):
     def lineReceived(self, data):
         # Debug
         if self.client is not None and configuration['debug']['debug_output']:
-            log.msg("INPUT from {name} in zone {zone} : {data}".format(name = self.client['name'], zone = self.client['zone'], data = str(data)))
+            log.msg(u"INPUT from {name} in zone {zone} : {data}".format(name = self.client['name'], zone = self.client['zone'], data = data.decode('utf-8', 'replace')))
 
         # Try to get Json
         jsonData = {}
@@ -102,7 +120,7 @@ class LisaProtocol(LineReceiver):
 
         # Read type
         if self.client is not None and jsonData['type'] == "chat":
-            ClientFactory.parseChat(jsonData = jsonData, client_uid = self.client['uid'])
+            ClientFactory.dispatchChat(jsonData = jsonData, client_uid = self.client['uid'], line = data)
         elif jsonData['type'] == "command" and jsonData.has_key('command') == True:
             # Select command
             if jsonData['command'].lower() == 'login req':
@@ -111,7 +129,7 @@ class LisaProtocol(LineReceiver):
 
                 # Debug
                 if configuration['debug']['debug_output']:
-                    log.msg("INPUT from {name} in zone {zone} : {data}".format(name = self.client['name'], zone = self.client['zone'], data = str(data)))
+                    log.msg(u"INPUT from {name} in zone {zone} : {data}".format(name = self.client['name'], zone = self.client['zone'], data = data.decode('utf-8', 'replace')))
 
                 # Send login ack
                 jsonOut = {'type': 'command', 'command': 'login ack', 'bot_name': configuration['bot_name']}
@@ -125,7 +143,14 @@ class LisaProtocol(LineReceiver):
     def initClient(self, client_name, zone_name):
         # Get client
         self.client = ClientFactory.initClient(client_name = client_name, zone_name = zone_name)
-        self.client['protocols'][self.uid] = {'object': self}
+        ClientFactory.addProtocol(client_uid = self.client['uid'], protocol = self)
+
+        # Serialized destination fields, common to every message sent to this client
+        self._json_header = '{{"from": "Server", "to": {name}, "zone": {zone}'.format(name = json.dumps(self.client['name']), zone = json.dumps(self.client['zone']))
+
+        # Name outbound queue after client
+        if self.queue is not None:
+            self.queue.name = u"client {name} in zone {zone}".format(name = self.client['name'], zone = self.client['zone'])
 
     #-----------------------------------------------------------------------------
     def sendError(self, msg):
@@ -135,21 +160,46 @@ class LisaProtocol(LineReceiver):
 
     #-----------------------------------------------------------------------------
     def sendToClient(self, jsonData):
+        # Send message
+        self.sendSerialized(ClientFactory.serialize(jsonData), key = ClientFactory.coalesceKey(jsonData))
+
+    #-----------------------------------------------------------------------------
+    def sendSerialized(self, body, key = None):
+        """
+        Send a message serialized with ClientFactory.serialize
+
+        key : optional key of the message, queued messages with the same key may be coalesced
+        """
         # If no client logged in
         if self.client is None:
             return
 
         # Add info to data
-        jsonData['from'] = 'Server'
-        jsonData['to'] = self.client['name']
-        jsonData['zone'] = self.client['zone']
+        line = self._json_header + body
 
         # Debug
         if configuration['debug']['debug_output']:
-            log.msg("OUTPUT to {name} in zone {zone} : {data}".format(name = self.client['name'], zone = self.client['zone'], data = str(jsonData)))
+            log.msg(u"OUTPUT to {name} in zone {zone} : {data}".format(name = self.client['name'], zone = self.client['zone'], data = line))
 
         # Send message
-        self.sendLine(json.dumps(jsonData))
+        if self.queue is not None:
+            self.queue.push(line, key)
+        else:
+            self.sendLine(line)
+
+    #-----------------------------------------------------------------------------
+    def getQueueStats(self):
+        if self.queue is None:
+            return None
+        return self.queue.getStats()
+
+    #-----------------------------------------------------------------------------
+    def _abort(self):
+        log.err(u"Disconnecting {name} : outbound queue is full".format(name = self.queue.name))
+        if hasattr(self.transport, 'abortConnection') == True:
+            self.transport.abortConnection()
+        else:
+            self.transport.loseConnection()
 
 
 #-----------------------------------------------------------------------------
@@ -169,7 +219,22 @@ class ClientFactory(Factory):
         self.clients = {}
         self.zones = {}
         self._lock = threading.RLock()
+
+        # Indexes : (client name, zone name) => client uid, zone name => zone uid
+        self._client_index = {}
+        self._zone_index = {}
+
+        # Fan-out : zone uid => protocols, all protocols
+        self._zone_protocols = {}
+        self._all_protocols = set()
         self.wit = None
+        self.intent_cache = IntentCache(size = configuration['wit_cache_size'], ttl = configuration['wit_cache_ttl'])
+
+        # Identical concurrent utterances share one Wit request
+        self.wit_flights = SingleFlight()
+
+        # Inputs of a client are processed in order, clients in parallel
+        self.dispatcher = ClientDispatcher(max_pending = configuration['client_max_pending'])
 
     #-----------------------------------------------------------------------------
     def startFactory(self):
@@ -177,7 +242,7 @@ class ClientFactory(Factory):
         NeoContext.init(factory = self)
 
         # Init Wit
-        self.wit = Wit(configuration['wit_token'])
+        self.wit = WitClient(token = configuration['wit_token'], url = configuration['wit_url'], timeout = configuration['wit_timeout'], max_requests = configuration['wit_max_requests'])
 
     #-----------------------------------------------------------------------------
     def buildProtocol(self, addr):
@@ -190,6 +255,12 @@ class ClientFactory(Factory):
         if ClientFactory.__instance is not None:
             ClientFactory.__instance.clients = {}
             ClientFactory.__instance.zones = {}
+            ClientFactory.__instance._client_index = {}
+            ClientFactory.__instance._zone_index = {}
+            ClientFactory.__instance._zone_protocols = {}
+            ClientFactory.__instance._all_protocols = set()
+            if ClientFactory.__instance.wit is not None:
+                ClientFactory.__instance.wit.close()
             ClientFactory.__instance.wit = None
             ClientFactory.__instance = None
 
@@ -205,45 +276,97 @@ class ClientFactory(Factory):
         self = cls.__instance
 
         # Lock access
-        self._lock.acquire()
+        with self._lock:
+            # Get zone
+            zone_uid = cls.getOrCreateZone(zone_name)
 
-        # Get zone
-        zone_uid = cls.getOrCreateZone(zone_name)
+            # Search if we already had a connection with this client
+            client_uid = self._client_index.get((client_name, zone_name))
+            if client_uid is not None:
+                return self.clients[client_uid]
 
-        # Search if we already had a connection with this client
-        client = None
-        client_uid = None
-        for c in self.clients:
-            if self.clients[c]['name'] == client_name and self.clients[c]['zone'] == zone_name:
-                return self.clients[c]
-
-        # If not found
-        if client is None:
             # Add client
             client_uid = str(uuid.uuid1())
             self.clients[client_uid] = {'uid': client_uid, 'protocols': {}, 'name': client_name, 'zone': zone_name, 'zone_uid': zone_uid}
             client = self.clients[client_uid]
+            self._client_index[(client_name, zone_name)] = client_uid
 
             # Each client has its own context
-            client['context'] = NeoContext(client_uid = client_uid)
+            client['context'] = NeoContext.create(client_uid = client_uid)
 
             # Add client to zone
-            found_flag = False
-            for c in self.zones[zone_uid]['client_uids']:
-                if c == client['uid']:
-                    found_flag = True
-                    break
-            if found_flag == False:
-                self.zones[zone_uid]['client_uids'].append(client['uid'])
-
-        # Release access
-        self._lock.release()
+            self.zones[zone_uid]['client_uids'].append(client_uid)
 
         return client
 
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def addProtocol(cls, client_uid, protocol):
+        """
+        Attach a connection to a logged client
+        """
+        self = cls.get()
+        with self._lock:
+            client = self.clients[client_uid]
+            client['protocols'][protocol.uid] = {'object': protocol}
+            self._zone_protocols.setdefault(client['zone_uid'], set()).add(protocol)
+            self._all_protocols.add(protocol)
+
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def removeProtocol(cls, client_uid, protocol):
+        """
+        Detach a lost connection from its client
+
+        The client is kept, with its context, for its next connection
+        """
+        self = cls.get()
+        with self._lock:
+            client = self.clients.get(client_uid)
+            if client is not None:
+                client['protocols'].pop(protocol.uid, None)
+                self._zone_protocols.get(client['zone_uid'], set()).discard(protocol)
+            self._all_protocols.discard(protocol)
+
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def dispatchChat(cls, jsonData, client_uid, line = None):
+        """
+        Parse a chat input after the pending inputs of the same client
+
+        line : raw input line, a line identical to a pending one is not parsed twice
+        Return a Deferred fired when the input is processed
+        """
+        d = cls.get().dispatcher.dispatch(client_uid, line, cls.parseChat, jsonData = jsonData, client_uid = client_uid)
+        d.addErrback(cls._dispatchFull, client_uid = client_uid)
+        return d
+
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def _dispatchFull(cls, failure, client_uid):
+        failure.trap(DispatcherFull)
+        log.err("Client {uid} has too many pending inputs, input ignored".format(uid = client_uid))
+
+        # Return an error to client
+        jsonData = {'type': 'Error', 'message': _("error_client_busy")}
+        cls.sendToClients(client_uids = [client_uid], jsonData = jsonData)
+
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def getDispatchStats(cls):
+        """
+        Return inputs processing statistics, by client uid
+        """
+        return cls.get().dispatcher.getStats()
+
     #-----------------------------------------------------------------------------
     @classmethod
     def parseChat(cls, jsonData, client_uid):
+        """
+        Decode intent of a chat input, then dispatch it to the client context
+
+        Return a Deferred fired when the input is dispatched
+        """
         # Create singleton
         if cls.__instance is None:
             cls.__instance = ClientFactory()
@@ -251,15 +374,84 @@ class ClientFactory(Factory):
 
         # If input has already a decoded intent
         if jsonData.has_key("outcome") == True:
-            jsonInput = {}
-            jsonInput['outcome'] = jsonData['outcome']
+            d = succeed({'outcome': jsonData['outcome']})
         elif len(jsonData['body']) > 0:
-            # Ask Wit for intent decoding
-            jsonInput = self.wit.get_message(unicode(jsonData['body']))
+            # Wit context of the pending question
+            wit_context = None
+            wait_step = cls.getClient(client_uid)['context'].wait_step
+            if wait_step is not None:
+                wit_context = wait_step.get('wit_context')
+
+            # Decode intent
+            d = self._decodeIntent(text = jsonData['body'], wit_context = wit_context)
         else:
             # No input => no output
-            return
+            return succeed(None)
+
+        # Dispatch when intent is decoded
+        d.addCallbacks(cls._dispatchChat, cls._decodeError, callbackKeywords = {'jsonData': jsonData, 'client_uid': client_uid}, errbackKeywords = {'client_uid': client_uid})
+        d.addErrback(log.err, "Error while dispatching chat input")
+        return d
 
+    #-----------------------------------------------------------------------------
+    def _decodeIntent(self, text, wit_context = None):
+        """
+        Decode intent of an utterance, return a Deferred fired with a json containing an outcome
+        """
+        # Try intents patterns first
+        outcome = PluginManager.matchIntent(text = text)
+        if outcome is not None:
+            return succeed({'outcome': outcome})
+
+        # Then local classifier
+        outcome = PluginManager.classifyIntent(text = text)
+        if outcome is not None and outcome['confidence'] >= configuration['wit_confidence']:
+            return succeed({'outcome': outcome})
+
+        # Search intent in cache
+        cache_key = IntentCache.makeKey(text = text, lang = configuration['lang_short'], context = wit_context)
+        jsonInput = self.intent_cache.get(cache_key)
+        if jsonInput is not None:
+            return succeed(jsonInput)
+
+        # Ask Wit for intent decoding, or wait for the same pending request
+        return self.wit_flights.call(cache_key, self._askWit, text = text, wit_context = wit_context, cache_key = cache_key)
+
+    #-----------------------------------------------------------------------------
+    def _askWit(self, text, wit_context, cache_key):
+        d = self.wit.get_message(unicode(text), wit_context)
+        d.addCallback(self._cacheIntent, cache_key = cache_key)
+        return d
+
+    #-----------------------------------------------------------------------------
+    def _cacheIntent(self, jsonInput, cache_key):
+        self.intent_cache.set(cache_key, {'outcome': jsonInput['outcome']})
+        return jsonInput
+
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def flushIntentCache(cls):
+        """
+        Remove all decoded intents from cache
+        """
+        cls.get().intent_cache.flush()
+
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def getIntentCacheStats(cls):
+        return cls.get().intent_cache.getStats()
+
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def getWitFlightsStats(cls):
+        """
+        Return Wit requests coalescing statistics : calls, coalesced calls, coalescing rate
+        """
+        return cls.get().wit_flights.getStats()
+
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def _dispatchChat(cls, jsonInput, jsonData, client_uid):
         # Initialize output from input
         jsonInput['from'], jsonInput['type'], jsonInput['zone'] = jsonData['from'], jsonData['type'], jsonData['zone']
 
@@ -269,13 +461,22 @@ class ClientFactory(Factory):
 
         # Execute intent
         client = cls.getClient(client_uid)
-        intent = PluginManager.getIntent(intent_name = jsonInput['outcome']['intent'])
+        intent = PluginManager.getIntent(intent_name = jsonInput['outcome'].get('intent'))
         if intent is not None:
             # Call plugin
-            client['context'].parse(jsonInput = jsonInput, plugin_name = intent.plugin_name, method_name = intent.method_name)
+            return client['context'].parse(jsonInput = jsonInput, plugin_name = intent.plugin_name, method_name = intent.method_name)
         else:
             # Parse without intent
-            client['context'].parse(jsonInput = jsonInput)
+            return client['context'].parse(jsonInput = jsonInput)
+
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def _decodeError(cls, failure, client_uid):
+        log.err(failure, "Error while decoding intent with Wit")
+
+        # Return an error to client
+        jsonData = {'type': 'Error', 'message': _("error_intent_decoding")}
+        cls.sendToClients(client_uids = [client_uid], jsonData = jsonData)
 
     #-----------------------------------------------------------------------------
     @classmethod
@@ -293,50 +494,101 @@ class ClientFactory(Factory):
         # Create singleton
         if cls.__instance is None:
             cls.__instance = ClientFactory()
+        self = cls.__instance
 
         # All zones
         if zone_name == "all":
             return "all"
 
         # Lock access
-        cls.__instance._lock.acquire()
-
-        # Search zone
-        zone = None
-        zone_uid = None
-        for z in cls.__instance.zones:
-            if cls.__instance.zones[z]['name'] == zone_name:
-                zone = cls.__instance.zones[z]
-                zone_uid = z
-                break
-
-        # If not found
-        if zone is None:
-            # Create zone
-            zone_uid = str(uuid.uuid1())
-            cls.__instance.zones[zone_uid] = {'name': zone_name, 'client_uids': []}
-            zone = cls.__instance.zones[zone_uid]
-
-        # Release access
-        cls.__instance._lock.release()
+        with self._lock:
+            # Search zone
+            zone_uid = self._zone_index.get(zone_name)
+
+            # If not found
+            if zone_uid is None:
+                # Create zone
+                zone_uid = str(uuid.uuid1())
+                self.zones[zone_uid] = {'name': zone_name, 'client_uids': []}
+                self._zone_index[zone_name] = zone_uid
 
         return zone_uid
 
     #-----------------------------------------------------------------------------
     @classmethod
     def sendToClients(cls, jsonData, client_uids = [], zone_uids = []):
+        # Plugins speak from worker threads, transports are used in reactor thread only
+        if threadable.ioThread is not None and threadable.isInIOThread() == False:
+            reactor.callFromThread(cls.sendToClients, jsonData = jsonData, client_uids = client_uids, zone_uids = zone_uids)
+            return
+
         # Create singleton
         if cls.__instance is None:
             cls.__instance = ClientFactory()
+        self = cls.__instance
+
+        # Get destination protocols
+        with self._lock:
+            if "all" in zone_uids or "all" in client_uids:
+                protocols = set(self._all_protocols)
+            else:
+                protocols = set()
+                for zone_uid in set(zone_uids):
+                    protocols.update(self._zone_protocols.get(zone_uid, ()))
+                for client_uid in set(client_uids):
+                    client = self.clients.get(client_uid)
+                    if client is not None:
+                        protocols.update(p['object'] for p in client['protocols'].itervalues())
+
+        # No destination
+        if len(protocols) == 0:
+            return
+
+        # Serialize message once for all destinations
+        body = cls.serialize(jsonData)
+        key = cls.coalesceKey(jsonData)
+        for protocol in protocols:
+            protocol.sendSerialized(body, key)
+
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def serialize(cls, jsonData):
+        """
+        Serialize a message without its destination fields (from, to, zone)
+
+        The result is completed by each protocol with its own destination fields
+        """
+        body = json.dumps(dict((k, v) for k, v in jsonData.iteritems() if k not in ('from', 'to', 'zone')))
+        if body == '{}':
+            return '}'
+        return ', ' + body[1:]
+
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def coalesceKey(cls, jsonData):
+        """
+        Commands with the same key replace each other in a full outbound queue,
+        other messages are never coalesced
+        """
+        if jsonData.get('type') != 'command':
+            return None
+        return ('command', jsonData.get('command'))
 
-        # Parse clients
-        for c in cls.__instance.clients:
-            # If client is in destination
-            if "all" in zone_uids or cls.__instance.clients[c]['zone_uid'] in zone_uids or "all" in client_uids or c in client_uids:
-                # Parse client protocols
-                for p in cls.__instance.clients[c]['protocols']:
-                    # Send to client through protocol
-                    cls.__instance.clients[c]['protocols'][p]['object'].sendToClient(jsonData)
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def getClientsStats(cls):
+        """
+        Return outbound queues statistics : {client uid: {'name', 'zone', 'protocols': {protocol uid: stats}}}
+        """
+        self = cls.get()
+        stats = {}
+        with self._lock:
+            for client_uid, client in self.clients.iteritems():
+                protocols = {}
+                for protocol_uid, p in client['protocols'].iteritems():
+                    protocols[protocol_uid] = p['object'].getQueueStats()
+                stats[client_uid] = {'name': client['name'], 'zone': client['zone'], 'protocols': protocols}
+        return stats
 
     #-----------------------------------------------------------------------------
     @classmethod
@@ -350,7 +602,7 @@ class ClientFactory(Factory):
 
     #-----------------------------------------------------------------------------
     @classmethod
-    def SchedReload(cls):
+    def SchedReload(cls, plugin_uid = None):
         global taskman
         # Create singleton
         if cls.__instance is None:
@@ -358,7 +610,11 @@ class ClientFactory(Factory):
 
         log.msg("Reloading task scheduler")
         cls.__instance.taskman = taskman
-        return cls.__instance.taskman.reload()
+
+        # Scheduler and plugins instances belong to the reactor, web API calls come from WSGI threads
+        if threadable.ioThread is not None and threadable.isInIOThread() == False:
+            return threads.blockingCallFromThread(reactor, taskman.reload, plugin_uid)
+        return taskman.reload(plugin_uid = plugin_uid)
 
     #-----------------------------------------------------------------------------
     @classmethod
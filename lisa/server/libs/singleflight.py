@@ -0,0 +1,88 @@
+# -*- coding: UTF-8 -*-
+#-----------------------------------------------------------------------------
+# project     : Lisa server
+# module      : libs
+# file        : singleflight.py
+# description : Coalescing of identical concurrent requests
+# author      : G.Dumee
+#-----------------------------------------------------------------------------
+# copyright   : Neotique
+#-----------------------------------------------------------------------------
+
+
+#-----------------------------------------------------------------------------
+# Imports
+#-----------------------------------------------------------------------------
+import copy
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.python.failure import Failure
+from twisted.python import log
+
+
+#-----------------------------------------------------------------------------
+# SingleFlight
+#-----------------------------------------------------------------------------
+class SingleFlight(object):
+    """
+    Share one in-flight call between concurrent requests with the same key
+
+    Each waiter gets its own copy of the result, so it may modify it.
+    Nothing is kept once the call has ended : caching is left to the caller.
+
+    Must be used in the reactor thread.
+    """
+
+    #-----------------------------------------------------------------------------
+    def __init__(self):
+        # In-flight calls : key => waiters Deferreds
+        self._flights = {}
+
+        # Counters
+        self.calls = 0
+        self.coalesced = 0
+
+    #-----------------------------------------------------------------------------
+    def call(self, key, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs), unless a call with the same key is in flight
+
+        Return a Deferred fired with a copy of the result
+        """
+        d = Deferred()
+        self.calls += 1
+
+        # Join in-flight call
+        waiters = self._flights.get(key)
+        if waiters is not None:
+            self.coalesced += 1
+            waiters.append(d)
+            return d
+
+        # New call
+        self._flights[key] = [d]
+        flight = maybeDeferred(func, *args, **kwargs)
+        flight.addBoth(self._landed, key)
+        return d
+
+    #-----------------------------------------------------------------------------
+    def __len__(self):
+        return len(self._flights)
+
+    #-----------------------------------------------------------------------------
+    def getStats(self):
+        return {'calls': self.calls, 'coalesced': self.coalesced, 'in_flight': len(self._flights),
+                'rate': float(self.coalesced) / self.calls if self.calls > 0 else 0.0}
+
+    #-----------------------------------------------------------------------------
+    def _landed(self, result, key):
+        # Give result to all waiters
+        for d in self._flights.pop(key):
+            try:
+                if isinstance(result, Failure) == True:
+                    d.errback(result)
+                else:
+                    d.callback(copy.deepcopy(result))
+            except:
+                log.err(None, "Error in coalesced request callback")
+
+# --------------------- End of singleflight.py  ---------------------
@@ -0,0 +1,187 @@
+# -*- coding: UTF-8 -*-
+#-----------------------------------------------------------------------------
+# project     : Lisa server
+# module      : libs
+# file        : timingwheel.py
+# description : Hashed timing wheel driven by the reactor
+# author      : G.Dumee
+#-----------------------------------------------------------------------------
+# copyright   : Neotique
+#-----------------------------------------------------------------------------
+
+
+#-----------------------------------------------------------------------------
+# Imports
+#-----------------------------------------------------------------------------
+import math, threading
+from twisted.python import log
+from twisted.python import threadable
+
+
+#-----------------------------------------------------------------------------
+# WheelTimer
+#-----------------------------------------------------------------------------
+class WheelTimer(object):
+    """
+    Timer scheduled in a timing wheel
+    """
+    __slots__ = ('wheel', 'slot', 'rounds', 'callback', 'args', 'kwargs', 'active')
+
+    #-----------------------------------------------------------------------------
+    def __init__(self, wheel, slot, rounds, callback, args, kwargs):
+        self.wheel = wheel
+        self.slot = slot
+        self.rounds = rounds
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.active = True
+
+    #-----------------------------------------------------------------------------
+    def cancel(self):
+        """
+        Cancel timer, return False if it already expired or was cancelled
+        """
+        return self.wheel._cancel(self)
+
+
+#-----------------------------------------------------------------------------
+# TimingWheel
+#-----------------------------------------------------------------------------
+class TimingWheel(object):
+    """
+    Hashed timing wheel
+
+    Timers are stored in a ring of slots, one slot per tick. A timer further
+    than one wheel turn counts the remaining turns. Scheduling and cancellation
+    are O(1) and can be done from any thread, callbacks are called in the
+    reactor thread. The wheel ticks with a single callLater, only while timers
+    are pending.
+    """
+
+    #-----------------------------------------------------------------------------
+    def __init__(self, resolution = 1.0, size = 512, clock = None):
+        """
+        resolution : tick duration in seconds
+        size : number of slots
+        clock : optional clock with seconds() and callLater() methods, reactor by default
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.resolution = float(resolution)
+        self.size = size
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._slots = [set() for i in xrange(size)]
+        self._tick = 0
+        self._count = 0
+
+        # Reactor call of next tick
+        self._call = None
+        self._next_time = None
+
+    #-----------------------------------------------------------------------------
+    def schedule(self, delay, callback, *args, **kwargs):
+        """
+        Call callback(*args, **kwargs) in delay seconds, with the precision of the wheel resolution
+
+        Return a WheelTimer
+        """
+        ticks = max(1, int(math.ceil(delay / self.resolution)))
+
+        # Lock access
+        with self._lock:
+            timer = WheelTimer(self, (self._tick + ticks) % self.size, (ticks - 1) // self.size, callback, args, kwargs)
+            self._slots[timer.slot].add(timer)
+            self._count += 1
+            armed = self._call is not None or self._next_time is not None
+            if armed == False:
+                # Mark as armed until the reactor call is set
+                self._next_time = self._clock.seconds() + self.resolution
+
+        # Start ticking
+        if armed == False:
+            # Reactor thread, or reactor not running yet
+            if threadable.ioThread is None or threadable.isInIOThread() == True:
+                self._arm()
+            else:
+                from twisted.internet import reactor
+                reactor.callFromThread(self._arm)
+
+        return timer
+
+    #-----------------------------------------------------------------------------
+    def __len__(self):
+        return self._count
+
+    #-----------------------------------------------------------------------------
+    def stop(self):
+        """
+        Cancel all timers
+        """
+        with self._lock:
+            for slot in self._slots:
+                for timer in slot:
+                    timer.active = False
+                slot.clear()
+            self._count = 0
+            call, self._call = self._call, None
+            self._next_time = None
+        if call is not None and call.active() == True:
+            call.cancel()
+
+    #-----------------------------------------------------------------------------
+    def _cancel(self, timer):
+        # Lock access
+        with self._lock:
+            if timer.active == False:
+                return False
+            timer.active = False
+            self._slots[timer.slot].discard(timer)
+            self._count -= 1
+            return True
+
+    #-----------------------------------------------------------------------------
+    def _arm(self):
+        with self._lock:
+            if self._call is not None or self._next_time is None:
+                return
+            delay = max(0, self._next_time - self._clock.seconds())
+        self._call = self._clock.callLater(delay, self._onTick)
+
+    #-----------------------------------------------------------------------------
+    def _onTick(self):
+        self._call = None
+        now = self._clock.seconds()
+        expired = []
+
+        # Process all ticks elapsed, the reactor may be late
+        with self._lock:
+            while self._next_time is not None and self._next_time <= now:
+                self._tick += 1
+                self._next_time += self.resolution
+                slot = self._slots[self._tick % self.size]
+                for timer in list(slot):
+                    if timer.rounds > 0:
+                        timer.rounds -= 1
+                        continue
+                    slot.discard(timer)
+                    timer.active = False
+                    self._count -= 1
+                    expired.append(timer)
+
+            # Stop ticking when no more timers
+            if self._count == 0:
+                self._next_time = None
+
+        # Call expired timers, out of lock
+        for timer in expired:
+            try:
+                timer.callback(*timer.args, **timer.kwargs)
+            except:
+                log.err(None, "Error in timer callback")
+
+        # Next tick
+        self._arm()
+
+# --------------------- End of timingwheel.py  ---------------------
@@ -1,11 +1,17 @@
-from datetime import datetime
+import heapq, hashlib, json
+from datetime import datetime, timedelta
+from itertools import count
 from twisted.python import log
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from bson.objectid import ObjectId
 from tasks import ScheduledTask
 from dateutil.rrule import *
-from twisted.python.reflect import namedAny
 from twisted.python import log
 from sys import path
+from lisa.server.libs.executor import PluginExecutor
+
+OVERLAP_POLICIES = ('skip', 'queue', 'allow')
+CATCHUP_POLICIES = ('skip', 'once', 'all')
 
 class TraceTask(ScheduledTask):
 
@@ -21,45 +27,232 @@ class TraceTask(ScheduledTask):
 
 class ScheduledTaskManager(object):
     '''Manages a group of tasks.
+
+    Tasks are kept in a heap ordered by their next runtime, and a single
+    delayed call is armed for the earliest one : nothing runs while no task
+    is due. When a task is due, its next run is scheduled at once, and its
+    overlap policy decides what to do if it is still running.
+
+    Crons run in a bounded pool of threads, so a long cron does not stall
+    the server. A cron returning a Deferred must declare "thread": false.
+
+    Runtimes of the crons are saved in the 'cron_states' collection, by
+    batches. On startup, occurrences missed while the server was down are
+    handled by the cron catch-up policy : 'skip' them, run 'once', or run
+    'all' of them up to 'catchup_max', one after the other. Catch-up runs
+    of different crons are spread by 'cron_catchup_spread' seconds.
+
+    :param configuration: the server configuration
+    :param clock: an IReactorTime provider, the reactor by default
+    :param executor: a PluginExecutor for the tasks, by default one with
+        'cron_threads' threads and 'cron_timeout' timeout
     '''
-    def __init__(self, configuration):
+    def __init__(self, configuration, clock=None, executor=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        if executor is None:
+            executor = PluginExecutor(max_threads=configuration['cron_threads'], concurrency=1,
+                                      queue_depth=1, timeout=configuration['cron_timeout'])
         self.configuration = configuration
+        self.clock = clock
+        self.executor = executor
         mongo = MongoClient(configuration['database']['server'], configuration['database']['port'])
         self.database = mongo.lisa
         self.tasks = []
         self.init_flag = False
 
-    def build_tasks(self):
-        self.tasks = []
+        # tasks built from crons : cron id => {'hash', 'task', 'plugin'}
+        self._crons = {}
+        self.started = False
+
+        # saved runtimes : cron id => state, read and used by the first build
+        self._states = None
+        self._catchups = 0
+
+        # runtimes waiting to be saved : cron id => state
+        self._dirty = {}
+        self._flush_call = None
+
+        # heap of [next runtime, sequence, task], removed tasks entries are
+        # cleared in place and skipped when they reach the top
+        self._heap = []
+        self._entries = {}
+        self._sequence = count()
+        self._call = None
+
+    def now(self):
+        '''Returns the current time of the manager clock.
+        '''
+        return datetime.fromtimestamp(self.clock.seconds())
+
+    def start(self):
+        '''Loads the tasks and waits for the first one to be due.
+        '''
+        self.started = True
+        self.executor.start()
+        if self.init_flag == False:
+            self.build_tasks()
+        self._arm()
+
+    def stop(self):
+        '''Stops waiting for tasks, running tasks are not interrupted.
+        '''
+        self.started = False
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        self.executor.stop()
+
+        # save the last runtimes now
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        batch, self._dirty = self._dirty, {}
+        if len(batch) > 0:
+            self._write_states(batch)
+
+    def build_tasks(self, plugin_uid=None):
+        '''Synchronizes the tasks with the enabled crons.
+
+        Crons are compared with the tasks by id and content hash : only new,
+        changed and removed crons are touched, unchanged tasks keep their
+        runtimes. With a plugin uid, only the crons of this plugin are read.
+        '''
         self.init_flag = True
-        
-        for cron in self.database.crons.find( { "enabled": 1 } ):
+        if self._states is None:
+            self._states = self._read_states()
+        self._catchups = 0
+        query = { "enabled": 1 }
+        if plugin_uid is not None:
+            query['plugin'] = ObjectId(str(plugin_uid))
+
+        seen = set()
+        added = removed = 0
+        for cron in self.database.crons.find(query):
+            seen.add(cron['_id'])
+            digest = hashlib.md5(json.dumps(cron, sort_keys=True, default=str)).hexdigest()
+            entry = self._crons.get(cron['_id'])
+            if entry is not None:
+                if entry['hash'] == digest:
+                    continue
+                self._remove_cron(cron['_id'])
+                removed += 1
+
+            task = self._build_task(cron)
+            if task is not None:
+                self._restore(task, cron)
+                self._crons[cron['_id']] = {'hash': digest, 'task': task, 'plugin': cron.get('plugin')}
+                self._add(task)
+                added += 1
+
+        # crons deleted or disabled
+        for cron_id, entry in self._crons.items():
+            if cron_id not in seen and (plugin_uid is None or str(entry['plugin']) == str(plugin_uid)):
+                self._remove_cron(cron_id)
+                removed += 1
+
+        # runtimes are only restored on startup, not for crons enabled later
+        self._states = {}
+
+        if self.configuration['debug']['debug_scheduler'] == True:
+            log.msg('Scheduledtaskmanager: %d tasks added, %d removed.' % (added, removed))
+
+    def _build_task(self, cron):
+        '''Returns the task of a cron document, None if it cannot be built.
+        '''
+        try:
             rule = rrulestr(str(cron['rule']))
-            
-            object = namedAny(cron['module'] + '.' + cron['class'])()
-            func = namedAny(cron['module'] + '.' + cron['class'] + '.' + cron['method'])
-            if cron['args']:
-                if cron['debug'] == True:
-                    self.tasks.append(TraceTask(cron['name'], rule, func, object, cron['args']))
-                else:
-                    self.tasks.append(ScheduledTask(cron['name'], rule, func, object, cron['args']))
+            func = self._bind(cron)
+        except:
+            log.err(None, 'Error while building cron %s' % cron['name'])
+            return None
+        if cron['args']:
+            if cron['debug'] == True:
+                task = TraceTask(cron['name'], rule, func, cron['args'])
+            else:
+                task = ScheduledTask(cron['name'], rule, func, cron['args'])
+        else:
+            if cron['debug'] == True:
+                task = TraceTask(cron['name'], rule, func)
             else:
-                if cron['debug'] == True:
-                    self.tasks.append(TraceTask(cron['name'], rule, func, object))
-                else:
-                    self.tasks.append(ScheduledTask(cron['name'], rule, func, object))
+                task = ScheduledTask(cron['name'], rule, func)
+
+        # execution options from the plugin JSON
+        task.overlap = cron.get('overlap', self.configuration['cron_overlap'])
+        if task.overlap not in OVERLAP_POLICIES:
+            log.err('Unknown overlap policy %s for cron %s, using skip' % (task.overlap, cron['name']))
+            task.overlap = 'skip'
+        task.timeout = cron.get('timeout')
+        task.executor = self.executor if cron.get('thread', True) == True else None
+        task.cron_id = cron['_id']
+        task.executor_key = str(cron['_id'])
+        return task
+
+    def _restore(self, task, cron):
+        '''Restores the saved runtimes of a cron task, and schedules its missed runs.
+        '''
+        state = self._states.pop(cron['_id'], None)
+        if state is None:
+            return
+        task.last_runtime = state.get('last_runtime')
+        next_runtime = state.get('next_runtime')
+        now = self.now()
+        task._reschedule(now)
+        if next_runtime is None or next_runtime > now:
+            return
+
+        # count missed occurrences, the rule is anchored on the saved next runtime
+        policy = cron.get('catchup', self.configuration['cron_catchup'])
+        if policy not in CATCHUP_POLICIES:
+            log.err('Unknown catch-up policy %s for cron %s, using skip' % (policy, cron['name']))
+            policy = 'skip'
+        limit = 1
+        if policy == 'all':
+            limit = cron.get('catchup_max', self.configuration['cron_catchup_max'])
+        missed = 0
+        for occurrence in rrulestr(str(cron['rule']), dtstart=next_runtime):
+            if occurrence > now or missed >= limit:
+                break
+            if occurrence >= next_runtime:
+                missed += 1
+        if missed == 0:
+            return
+        if policy == 'skip':
+            log.msg('Scheduled task %s missed runs since %s, skipped' % (task.name, next_runtime))
+            return
+
+        # run soon, after the catch-up runs of the previous tasks
+        task.missed = missed - 1
+        task.next_scheduled_runtime = now + timedelta(seconds=self._catchups * self.configuration['cron_catchup_spread'])
+        self._catchups += 1
+        log.msg('Scheduled task %s missed runs since %s, catching up %d runs' % (task.name, next_runtime, missed))
+
+    def _bind(self, cron):
+        '''Returns the cron method, bound to the live plugin instance shared with the intents.
+        '''
+        # imported here, the plugin manager needs the whole server
+        from lisa.server.plugins.PluginManager import PluginManager
+        object = PluginManager.getCronInstance(cron['plugin'], cron['module'] + '.' + cron['class'])
+        return getattr(object, cron['method'])
+
+    def _remove_cron(self, cron_id):
+        task = self._crons.pop(cron_id)['task']
+        self.tasks.remove(task)
+        self._unschedule(task)
 
     def add_task(self, task):
         '''Adds a task to be run.
         
         Expects a :class:`txscheduler.tasks.ScheduledTask` instance.
         '''
-        self.tasks.append(task)
+        self._add(task)
+        self._arm()
 
-    def reload(self):
-        '''Reload the self.tasks
+    def reload(self, plugin_uid=None):
+        '''Reload the self.tasks, only the crons of a plugin when plugin_uid is given
         '''
-        self.build_tasks()
+        self.build_tasks(plugin_uid)
+        self._arm()
         return "OK"
 
     def remove_task(self, task):
@@ -68,18 +261,152 @@ class ScheduledTaskManager(object):
         Expects a :class:`txscheduler.tasks.ScheduledTask` instance.
         '''
         self.tasks.remove(task)
-        
+        self._unschedule(task)
+        for cron_id, entry in self._crons.items():
+            if entry['task'] is task:
+                del self._crons[cron_id]
+        self._arm()
+
+    def get_stats(self):
+        '''Returns the state of each task : running runs, skipped occurrences, timeouts, next runtime.
+        '''
+        stats = {}
+        for task in self.tasks:
+            stats[task.name] = {'runs': task.runs, 'skipped': task.skipped, 'timeouts': task.timeouts, 'queued': task.queued,
+                                'overlap': task.overlap, 'last_runtime': task.last_runtime,
+                                'next_runtime': task.next_scheduled_runtime}
+        return stats
+
     def run(self):
-        '''Checks for tasks which need to be run and runs them.
+        '''Runs the tasks which are due.
         '''
         if self.init_flag == False:
             self.build_tasks()
-        if self.configuration['debug']['debug_scheduler'] == True:
-            log.msg('ScheduledTaskManager: checking for tasks to run...')
-            log.msg(self.tasks)
-        tasks_to_run = [task for task in self.tasks if
-                            task.next_scheduled_runtime < datetime.now()]
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        now = self.now()
+
+        # pop due tasks, in runtime order
+        tasks_to_run = []
+        while len(self._heap) > 0 and (self._heap[0][2] is None or self._heap[0][0] <= now):
+            runtime, sequence, task = heapq.heappop(self._heap)
+            if task is not None:
+                del self._entries[id(task)]
+                tasks_to_run.append(task)
         if self.configuration['debug']['debug_scheduler'] == True:
             log.msg('Scheduledtaskmanager: %d tasks found.' % len(tasks_to_run))
+
         for task in tasks_to_run:
-            task.run()
+            # the next run does not depend on this one
+            task._reschedule(now)
+            self._schedule(task)
+
+            if task.running == False or task.overlap == 'allow':
+                self._launch(task)
+            elif task.overlap == 'queue':
+                task.queued = True
+            else:
+                task.skipped += 1
+                log.msg('Scheduled task %s is still running, run skipped' % task.name)
+            self._mark(task)
+
+        self._arm()
+
+    def _add(self, task):
+        # share the manager clock, and schedule
+        task.now = self.now
+        if task.last_runtime is None:
+            task._reschedule()
+        if task.executor is not None:
+            # concurrent runs wait for a thread instead of being rejected
+            if task.overlap == 'allow':
+                task.executor.setLimits(task.executor_key, concurrency=self.configuration['cron_threads'],
+                                        queue_depth=self.configuration['cron_threads'], timeout=task.timeout)
+            else:
+                task.executor.setLimits(task.executor_key, timeout=task.timeout)
+        self.tasks.append(task)
+        self._schedule(task)
+
+    def _launch(self, task):
+        d = task.run()
+        d.addErrback(log.err, 'Error in scheduled task %s' % task.name)
+        d.addBoth(self._task_ended, task)
+
+    def _schedule(self, task):
+        # a finished recurrence has no next runtime
+        if task.next_scheduled_runtime is None:
+            return
+        entry = [task.next_scheduled_runtime, next(self._sequence), task]
+        self._entries[id(task)] = entry
+        heapq.heappush(self._heap, entry)
+
+    def _unschedule(self, task):
+        entry = self._entries.pop(id(task), None)
+        if entry is not None:
+            entry[2] = None
+
+    def _task_ended(self, result, task):
+        # start the queued run or the next catch-up run, unless the task was removed
+        if task.running == True or task not in self.tasks:
+            return
+        if task.queued == True:
+            task.queued = False
+            self._launch(task)
+        elif task.missed > 0:
+            task.missed -= 1
+            self._launch(task)
+        else:
+            return
+        self._mark(task)
+
+    def _mark(self, task):
+        # runtimes of the crons tasks are saved by batches
+        if task.cron_id is None:
+            return
+        self._dirty[task.cron_id] = {'last_runtime': task.last_runtime, 'next_runtime': task.next_scheduled_runtime}
+        if self._flush_call is None:
+            self._flush_call = self.clock.callLater(self.configuration['cron_state_flush'], self._flush)
+
+    def _flush(self):
+        self._flush_call = None
+        batch, self._dirty = self._dirty, {}
+        if len(batch) > 0:
+            self._write(batch)
+
+    def _write(self, batch):
+        # write in a thread of the reactor pool
+        from twisted.internet import reactor
+        reactor.callInThread(self._write_states, batch)
+
+    def _write_states(self, batch):
+        try:
+            self.database.cron_states.bulk_write([UpdateOne({'_id': cron_id}, {'$set': state}, upsert=True)
+                                                  for cron_id, state in batch.iteritems()], ordered=False)
+        except:
+            log.err(None, 'Error while saving %d cron states' % len(batch))
+
+    def _read_states(self):
+        try:
+            return dict((state['_id'], state) for state in self.database.cron_states.find())
+        except:
+            log.err(None, 'Error while reading cron states')
+            return {}
+
+    def _arm(self):
+        '''Arms the delayed call for the earliest task.
+        '''
+        while len(self._heap) > 0 and self._heap[0][2] is None:
+            heapq.heappop(self._heap)
+        if self.started == False or len(self._heap) == 0:
+            if self._call is not None and self._call.active():
+                self._call.cancel()
+            self._call = None
+            return
+
+        delta = self._heap[0][0] - self.now()
+        delay = max(0, delta.days * 86400 + delta.seconds + delta.microseconds / 1e6)
+        if self._call is not None and self._call.active():
+            self._call.reset(delay)
+        else:
+            self._call = self.clock.callLater(delay, self.run)
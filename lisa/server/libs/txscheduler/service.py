@@ -1,21 +1,22 @@
 '''
 '''
-from twisted.application.internet import TimerService
+from twisted.application import service
 
-#~ class SchedulerService(service.Service):
-class ScheduledTaskService(TimerService):
+class ScheduledTaskService(service.Service):
     '''Service for running scheduled tasks.
+
+    The task manager arms a delayed call for the next due task, there is no
+    polling.
     '''
-    def __init__(self, task_manager, interval=1, *args, **kwargs):
+    def __init__(self, task_manager, *args, **kwargs):
         '''
         '''
-        self.step = interval
-        self.clock = None
-        self.call = (task_manager.run, args, kwargs)
+        self.task_manager = task_manager
 
+    def startService(self):
+        service.Service.startService(self)
+        self.task_manager.start()
 
-    #~ def startService(self):
-        #~ pass
-        
-    #~ def stopService(self):
-        #~ pass
\ No newline at end of file
+    def stopService(self):
+        self.task_manager.stop()
+        return service.Service.stopService(self)
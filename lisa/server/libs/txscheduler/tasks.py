@@ -6,6 +6,7 @@
 from datetime import datetime
 from twisted.python import log
 from twisted.internet.defer import maybeDeferred
+from lisa.server.libs.executor import ExecutorFull, ExecutorTimeout
 
 class ScheduledTask(object):
     '''Represents a scheduled task.
@@ -15,6 +16,19 @@ class ScheduledTask(object):
     :param callable: a callable with the actual work to be done
     :param args: args to send to the callable
     :param kwargs: kwargs to send to the callable
+
+    The task manager sets how runs are executed :
+    overlap : what to do when the task is due while it runs,
+        'skip' the occurrence, 'queue' one more run, or 'allow' concurrent runs
+    executor : a PluginExecutor running the callable in a thread, None to
+        run it in the reactor thread
+    timeout : execution timeout in seconds, None for the executor default
+    executor_key : key of the task limits and statistics in the executor,
+        the cron id for crons, as cron names are only unique in a plugin
+
+    A run which times out is counted in 'timeouts', but the task stays
+    running until the thread of the callable really ends. A run rejected by
+    the executor, with too many runs waiting, is counted in 'skipped'.
     '''
     def __init__(self, name, rrule, callable, *args, **kwargs):
         self.name = name
@@ -24,6 +38,25 @@ class ScheduledTask(object):
         self.last_runtime = None
         self.running = False
 
+        # execution, set by the manager
+        self.overlap = 'skip'
+        self.executor = None
+        self.timeout = None
+        self.executor_key = name
+
+        # number of current runs, skipped occurrences, run waiting for the current one
+        self.runs = 0
+        self.skipped = 0
+        self.queued = False
+        self.timeouts = 0
+
+        # cron document id, None if not built from a cron, and catch-up runs left
+        self.cron_id = None
+        self.missed = 0
+
+        # current time, replaced by the manager clock when the task is added
+        self.now = datetime.now
+
         self.args = args
         self.kwargs = kwargs
 
@@ -40,21 +73,25 @@ class ScheduledTask(object):
         '''
         log.msg('after_execute called')
 
-    def _reschedule(self):
+    def _reschedule(self, after=None):
         '''Determines the next time that the task should be run.
         '''
-        last_time = self.last_runtime
+        last_time = after
+        if last_time is None:
+            last_time = self.last_runtime
         if last_time is None:
-            last_time =  datetime.now()
+            last_time =  self.now()
         next_time = self.recurrence.after(last_time)
         self.next_scheduled_runtime = next_time
 
     def _post_execute(self, result):
         '''Callback run after the task has finished a run.
         
-        Calls the 'after_execute' hook and reschedules the task.
+        Calls the 'after_execute' hook, the manager has already scheduled
+        the next run when this one started.
         '''
-        self._reschedule()
+        self.runs -= 1
+        self.running = self.runs > 0
         self.after_execute()
         return result
 
@@ -63,13 +100,43 @@ class ScheduledTask(object):
         '''
         log.msg('self.args: ')
         log.msg(self.args)
-        self.last_runtime = datetime.now()
+        self.last_runtime = self.now()
+        self.runs += 1
         self.running = True
-        # run the callable
-        d = maybeDeferred( self.callable, *self.args, **self.kwargs )
+        # run the callable, in a worker thread if there is an executor
+        if self.executor is not None:
+            d = self._execute_in_thread()
+        else:
+            d = maybeDeferred( self.callable, *self.args, **self.kwargs )
         d.addBoth(self._post_execute)
         return d
 
+    def _execute_in_thread(self):
+        '''Runs the callable in the executor.
+
+        Returns a Deferred fired when the thread has really ended, with the
+        result, or None if the run timed out.
+        '''
+        d, end = self.executor.runTracked(self.executor_key, self.callable, *self.args, **self.kwargs)
+        outcome = []
+        d.addErrback(self._timed_out)
+        d.addErrback(self._rejected)
+        d.addBoth(outcome.append)
+        end.addCallback(lambda ignored: outcome[0])
+        return end
+
+    def _timed_out(self, failure):
+        failure.trap(ExecutorTimeout)
+        self.timeouts += 1
+        log.msg('Scheduled task %s timed out, it runs until its thread ends' % self.name)
+        return None
+
+    def _rejected(self, failure):
+        failure.trap(ExecutorFull)
+        self.skipped += 1
+        log.msg('Scheduled task %s has too many runs waiting, run skipped' % self.name)
+        return None
+
     def run(self):
         '''Runs the task.
         
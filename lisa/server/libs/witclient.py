@@ -0,0 +1,141 @@
+# -*- coding: UTF-8 -*-
+#-----------------------------------------------------------------------------
+# project     : Lisa server
+# module      : libs
+# file        : witclient.py
+# description : Asynchronous Wit client
+# author      : G.Dumee
+#-----------------------------------------------------------------------------
+# copyright   : Neotique
+#-----------------------------------------------------------------------------
+
+
+#-----------------------------------------------------------------------------
+# Imports
+#-----------------------------------------------------------------------------
+import json, urllib
+from twisted.internet.defer import DeferredSemaphore
+from twisted.python.failure import Failure
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from twisted.web.http_headers import Headers
+
+
+#-----------------------------------------------------------------------------
+# WitError
+#-----------------------------------------------------------------------------
+class WitError(Exception):
+    """
+    Wit answered with an error or an invalid JSON, or did not answer in time
+    """
+    pass
+
+
+#-----------------------------------------------------------------------------
+# WitClient
+#-----------------------------------------------------------------------------
+class WitClient(object):
+    """
+    Asynchronous Wit client
+
+    Requests share a pool of keep-alive connections, the number of requests
+    sent simultaneously is limited, and every request is cancelled after a timeout
+    """
+
+    #-----------------------------------------------------------------------------
+    def __init__(self, token, url = "https://api.wit.ai", timeout = 5, max_requests = 4, reactor = None):
+        """
+        token : Wit server access token
+        url : Wit API url
+        timeout : timeout of a request in seconds
+        max_requests : maximum number of requests sent simultaneously, others are queued
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self.token = token
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+        # Keep-alive connections
+        self._pool = HTTPConnectionPool(reactor, persistent = True)
+        self._pool.maxPersistentPerHost = max_requests
+        self._agent = Agent(reactor, connectTimeout = timeout, pool = self._pool)
+
+        # Concurrent requests limit
+        self._semaphore = DeferredSemaphore(max_requests)
+
+    #-----------------------------------------------------------------------------
+    def get_message(self, text, context = None):
+        """
+        Ask Wit for intent decoding
+
+        text : utterance to decode
+        context : optional json sent to Wit as context input
+
+        Return a Deferred fired with Wit json answer
+        """
+        return self._semaphore.run(self._request, text, context)
+
+    #-----------------------------------------------------------------------------
+    def close(self):
+        """
+        Close keep-alive connections, return a Deferred
+        """
+        return self._pool.closeCachedConnections()
+
+    #-----------------------------------------------------------------------------
+    def _request(self, text, context):
+        # Build url
+        if isinstance(text, unicode) == True:
+            text = text.encode('utf-8')
+        params = {'q': text}
+        if context is not None:
+            params['context'] = json.dumps(context)
+        url = "{url}/message?{params}".format(url = self.url, params = urllib.urlencode(params))
+
+        # Send request
+        headers = Headers({'Authorization': ['Bearer ' + str(self.token)], 'Accept': ['application/json']})
+        d = self._agent.request('GET', url, headers, None)
+        d.addCallback(self._read_response)
+
+        # Cancel request on timeout
+        timer = self._reactor.callLater(self.timeout, d.cancel)
+        def _stop_timer(result):
+            if timer.active() == True:
+                timer.cancel()
+            elif isinstance(result, Failure) == True:
+                raise WitError("Wit request timed out after {timeout}s".format(timeout = self.timeout))
+            return result
+        d.addBoth(_stop_timer)
+
+        d.addCallback(self._decode)
+        return d
+
+    #-----------------------------------------------------------------------------
+    def _read_response(self, response):
+        d = readBody(response)
+        if response.code != 200:
+            def _error(body):
+                raise WitError("Wit error {code} : {body}".format(code = response.code, body = body))
+            d.addCallback(_error)
+        return d
+
+    #-----------------------------------------------------------------------------
+    def _decode(self, body):
+        try:
+            jsonAnswer = json.loads(body)
+        except ValueError, e:
+            raise WitError("Invalid JSON from Wit : " + str(e))
+        if isinstance(jsonAnswer, dict) == False:
+            raise WitError("Wit answer is not an object : " + body)
+
+        # Newer API versions return a list of outcomes
+        if jsonAnswer.has_key('outcome') == False:
+            if jsonAnswer.has_key('outcomes') == True and len(jsonAnswer['outcomes']) > 0:
+                jsonAnswer['outcome'] = jsonAnswer['outcomes'][0]
+            else:
+                raise WitError("No outcome in Wit answer")
+
+        return jsonAnswer
+
+# --------------------- End of witclient.py  ---------------------
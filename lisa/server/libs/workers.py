@@ -0,0 +1,585 @@
+# -*- coding: UTF-8 -*-
+#-----------------------------------------------------------------------------
+# project     : Lisa server
+# module      : libs
+# file        : workers.py
+# description : Plugins execution in a pool of worker processes
+# author      : G.Dumee
+#-----------------------------------------------------------------------------
+# copyright   : Neotique
+#-----------------------------------------------------------------------------
+
+
+#-----------------------------------------------------------------------------
+# Imports
+#-----------------------------------------------------------------------------
+import os, sys, json, time, traceback
+from twisted.internet.defer import Deferred, fail
+from twisted.internet.protocol import ProcessProtocol
+from twisted.python.reflect import namedAny
+from twisted.python import log, threadable
+from lisa.server.libs.executor import ExecutorTimeout
+
+
+#-----------------------------------------------------------------------------
+# Globals
+#-----------------------------------------------------------------------------
+# Messages from a worker are written on this fd, stdout is left to plugins
+_MESSAGES_FD = 3
+
+# Delay before restarting a crashed worker, in seconds
+_RESTART_DELAY = 1.0
+
+# Client keys sent to workers
+_CLIENT_KEYS = ('uid', 'name', 'zone', 'zone_uid')
+
+# Worker process entry point : the libs package is loaded without its __init__, that starts the whole server
+_BOOTSTRAP = """
+import sys, os, imp
+import lisa.server
+libs = imp.new_module('lisa.server.libs')
+libs.__path__ = [os.path.join(path, 'libs') for path in lisa.server.__path__]
+sys.modules['lisa.server.libs'] = libs
+lisa.server.libs = libs
+from lisa.server.libs.workers import serve
+serve(config_file = sys.argv[1] if len(sys.argv) > 1 else None)
+"""
+
+
+#-----------------------------------------------------------------------------
+# Exceptions
+#-----------------------------------------------------------------------------
+class WorkerCrashed(Exception):
+    """
+    The worker process ended before answering
+    """
+
+#-----------------------------------------------------------------------------
+class WorkerError(Exception):
+    """
+    The plugin raised an exception in the worker process
+    """
+
+
+#-----------------------------------------------------------------------------
+# Tools
+#-----------------------------------------------------------------------------
+def _encode(message):
+    # Compact JSON line
+    return json.dumps(message, separators = (',', ':'), default = str) + '\n'
+
+
+#-----------------------------------------------------------------------------
+# _WorkerProtocol
+#-----------------------------------------------------------------------------
+class _WorkerProtocol(ProcessProtocol):
+    """
+    Pipes of a worker process
+    """
+
+    #-----------------------------------------------------------------------------
+    def __init__(self, worker):
+        self.worker = worker
+        self._buffer = ""
+
+    #-----------------------------------------------------------------------------
+    def childDataReceived(self, childFD, data):
+        # Plugins outputs
+        if childFD != _MESSAGES_FD:
+            for line in data.splitlines():
+                log.msg("Worker {index} : {line}".format(index = self.worker.index, line = line))
+            return
+
+        # Messages, one per line
+        lines = (self._buffer + data).split('\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            if len(line) > 0:
+                self.worker._messageReceived(json.loads(line))
+
+    #-----------------------------------------------------------------------------
+    def processEnded(self, reason):
+        self.worker._ended(self, reason)
+
+
+#-----------------------------------------------------------------------------
+# WorkerCallback
+#-----------------------------------------------------------------------------
+class WorkerCallback(object):
+    """
+    Answer callback registered by a plugin in a worker process
+
+    The callback is lost if the worker process restarts : callbacks ids of
+    the new process start again at 1, so the process generation is checked.
+    """
+
+    #-----------------------------------------------------------------------------
+    def __init__(self, worker, cbk_id):
+        self.worker = worker
+        self.cbk_id = cbk_id
+        self.generation = worker.generation
+
+    #-----------------------------------------------------------------------------
+    def __call__(self, context, jsonAnswer):
+        """
+        Call the callback in its worker, return a Deferred fired in the reactor thread
+        """
+        if self.generation != self.worker.generation:
+            return fail(WorkerCrashed("Worker {index} restarted, answer callback lost".format(index = self.worker.index)))
+        return self.worker.answer(cbk_id = self.cbk_id, context = context, jsonAnswer = jsonAnswer)
+
+
+#-----------------------------------------------------------------------------
+# PluginWorker
+#-----------------------------------------------------------------------------
+class PluginWorker(object):
+    """
+    A worker process, and the calls it is running
+
+    The worker runs its calls one after the other, the number of pending calls is its load.
+    """
+
+    #-----------------------------------------------------------------------------
+    def __init__(self, index, pool, reactor):
+        self.index = index
+        self._pool = pool
+        self._reactor = reactor
+        self._protocol = None
+        self._process = None
+        self._running = False
+
+        # Number of spawned processes
+        self.generation = 0
+
+        # Pending calls : id => call
+        self._calls = {}
+        self._next_id = 0
+
+        # Statistics
+        self.stats = {'pid': None, 'calls': 0, 'errors': 0, 'timeouts': 0, 'restarts': 0,
+                      'exec_total': 0.0, 'exec_max': 0.0}
+
+    #-----------------------------------------------------------------------------
+    def start(self):
+        self._running = True
+        self._spawn()
+
+    #-----------------------------------------------------------------------------
+    def stop(self):
+        self._running = False
+        if self._process is not None:
+            # The worker ends on end of input
+            self._process.closeStdin()
+
+    #-----------------------------------------------------------------------------
+    def _spawn(self):
+        if self._running == False or self._process is not None:
+            return
+        self.generation += 1
+        self._protocol = _WorkerProtocol(worker = self)
+        args = [sys.executable, '-c', _BOOTSTRAP]
+        if self._pool.config_file is not None:
+            args.append(self._pool.config_file)
+        self._process = self._reactor.spawnProcess(self._protocol, sys.executable, args, env = os.environ.copy(),
+                                                   childFDs = {0: 'w', 1: 'r', 2: 'r', _MESSAGES_FD: 'r'})
+        self.stats['pid'] = self._process.pid
+
+    #-----------------------------------------------------------------------------
+    def call(self, plugin_uid, module, method, jsonInput, context, timeout):
+        """
+        Call a plugin method, return a Deferred fired with the method result
+        """
+        message = {'type': 'call', 'uid': str(plugin_uid), 'module': module, 'method': method, 'input': jsonInput}
+        return self._request(message = message, plugin_uid = plugin_uid, context = context, timeout = timeout)
+
+    #-----------------------------------------------------------------------------
+    def answer(self, cbk_id, context, jsonAnswer):
+        """
+        Call an answer callback, return a Deferred fired with the callback result
+        """
+        if jsonAnswer is not None:
+            jsonAnswer = dict((k, v) for k, v in jsonAnswer.iteritems() if k != 'context')
+        message = {'type': 'answer', 'cbk': cbk_id, 'input': jsonAnswer}
+        return self._request(message = message, plugin_uid = None, context = context, timeout = self._pool.timeout)
+
+    #-----------------------------------------------------------------------------
+    def _request(self, message, plugin_uid, context, timeout):
+        d = Deferred()
+        call = {'d': d, 'plugin_uid': plugin_uid, 'context': context, 'timer': None, 'start': None}
+
+        # Plugins may call other plugins from a pool thread
+        if threadable.ioThread is not None and threadable.isInIOThread() == False:
+            self._reactor.callFromThread(self._send, message, call, timeout)
+        else:
+            self._send(message, call, timeout)
+        return d
+
+    #-----------------------------------------------------------------------------
+    def _send(self, message, call, timeout):
+        # Worker is restarting
+        if self._process is None:
+            call['d'].errback(WorkerCrashed("Worker {index} is not running".format(index = self.index)))
+            return
+
+        # Answer callbacks are owned by the caller plugin
+        if call['plugin_uid'] is None and message['type'] == 'answer':
+            call['plugin_uid'] = self._pool._callbacks_owners.pop((self.index, message['cbk']), None)
+
+        # Context of the call
+        self._next_id += 1
+        message['id'] = self._next_id
+        context = call['context']
+        if context is not None:
+            message['client'] = dict((k, context.client.get(k)) for k in _CLIENT_KEYS)
+            message['vars'] = context.Vars
+        self._calls[message['id']] = call
+
+        # Caller timeout : the process is killed, so the worker is not blocked
+        if timeout is not None and timeout > 0:
+            call['timer'] = self._reactor.callLater(timeout, self._timeout, message['id'], timeout)
+
+        call['start'] = time.time()
+        self.stats['calls'] += 1
+        self._process.write(_encode(message))
+
+    #-----------------------------------------------------------------------------
+    def _messageReceived(self, message):
+        call = self._calls.get(message.get('id'))
+
+        # Plugin speech or question during a call
+        if message['type'] == 'speak':
+            self._pool._speak(call = call, message = message)
+            return
+        if message['type'] == 'ask':
+            self._pool._ask(worker = self, call = call, message = message)
+            return
+
+        # Call ended
+        self._calls.pop(message['id'], None)
+        if call is None:
+            # Caller already timed out
+            return
+        if call['timer'] is not None:
+            call['timer'].cancel()
+        exec_time = time.time() - call['start']
+        self.stats['exec_total'] += exec_time
+        self.stats['exec_max'] = max(self.stats['exec_max'], exec_time)
+
+        # Plugin error
+        if message['type'] == 'error':
+            self.stats['errors'] += 1
+            call['d'].errback(WorkerError("{error}\n{traceback}".format(error = message['error'], traceback = message['traceback'])))
+            return
+
+        # Update client variables
+        if call['context'] is not None and message.has_key('vars') == True:
+            call['context'].Vars.update(message['vars'])
+        call['d'].callback(message['result'])
+
+    #-----------------------------------------------------------------------------
+    def _timeout(self, call_id, timeout):
+        call = self._calls.pop(call_id, None)
+        if call is None:
+            return
+        call['timer'] = None
+        self.stats['timeouts'] += 1
+        log.err("Worker {index} call did not end after {timeout}s, restarting worker".format(index = self.index, timeout = timeout))
+        call['d'].errback(ExecutorTimeout("Plugin call did not end in time"))
+
+        # Kill blocked worker, it will be restarted
+        if self._process is not None:
+            self._process.signalProcess('KILL')
+
+    #-----------------------------------------------------------------------------
+    def _ended(self, protocol, reason):
+        if protocol is not self._protocol:
+            return
+        self._process = None
+        self._protocol = None
+        self.stats['pid'] = None
+
+        # Fail pending calls
+        calls, self._calls = self._calls, {}
+        for call in calls.itervalues():
+            if call['timer'] is not None:
+                call['timer'].cancel()
+            call['d'].errback(WorkerCrashed("Worker {index} ended".format(index = self.index)))
+
+        # Answer callbacks of the process are lost, the next process reuses their ids
+        for key in [key for key in self._pool._callbacks_owners if key[0] == self.index]:
+            del self._pool._callbacks_owners[key]
+
+        # Restart
+        if self._running == True:
+            log.err("Worker {index} ended : {reason}, restarting".format(index = self.index, reason = reason.getErrorMessage()))
+            self.stats['restarts'] += 1
+            self._reactor.callLater(_RESTART_DELAY, self._spawn)
+
+    #-----------------------------------------------------------------------------
+    def getStats(self):
+        stats = dict(self.stats)
+        stats['index'] = self.index
+        stats['pending'] = len(self._calls)
+        stats['exec_avg'] = stats.pop('exec_total') / stats['calls'] if stats['calls'] > 0 else 0.0
+        return stats
+
+
+#-----------------------------------------------------------------------------
+# WorkerPool
+#-----------------------------------------------------------------------------
+class WorkerPool(object):
+    """
+    Run plugins methods in worker processes
+
+    Calls are sharded by plugin or by client : calls of a plugin (or of a client)
+    always run in the same worker, so plugin instances keep their state. Client
+    variables are sent with each call and updated on result, global variables
+    are not shared with workers.
+
+    Crashed workers are restarted, their pending calls fail with WorkerCrashed.
+    """
+
+    #-----------------------------------------------------------------------------
+    def __init__(self, count, shard = 'plugin', timeout = 30, on_speak = None, on_ask = None, config_file = None, reactor = None):
+        """
+        count : number of worker processes
+        shard : 'plugin' or 'client'
+        timeout : default call timeout in seconds, 0 for no timeout
+        on_speak : function(context, plugin_uid, message) called on plugin speech
+        on_ask : function(context, plugin_uid, message, answer_cbk) called on plugin question
+        config_file : server configuration file, applied in worker processes
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.shard = shard
+        self.timeout = timeout
+        self.config_file = config_file
+        self._on_speak = on_speak
+        self._on_ask = on_ask
+        self._workers = [PluginWorker(index = i, pool = self, reactor = reactor) for i in xrange(count)]
+
+        # Answer callbacks owners : (worker index, cbk id) => plugin uid
+        self._callbacks_owners = {}
+
+    #-----------------------------------------------------------------------------
+    def start(self):
+        for worker in self._workers:
+            worker.start()
+
+    #-----------------------------------------------------------------------------
+    def stop(self):
+        for worker in self._workers:
+            worker.stop()
+
+    #-----------------------------------------------------------------------------
+    def call(self, plugin_uid, module, method, jsonInput, context, timeout = None):
+        """
+        Call a plugin method in its worker, return a Deferred fired in the reactor thread
+
+        jsonInput : input of the method, without context
+        """
+        if self.shard == 'client' and context is not None:
+            key = context.client['uid']
+        else:
+            key = plugin_uid
+        worker = self._workers[hash(str(key)) % len(self._workers)]
+        if timeout is None:
+            timeout = self.timeout
+        return worker.call(plugin_uid = plugin_uid, module = module, method = method, jsonInput = jsonInput, context = context, timeout = timeout)
+
+    #-----------------------------------------------------------------------------
+    def getStats(self):
+        """
+        Return statistics per worker : pid, pending calls, calls, errors, restarts, execution times in seconds
+        """
+        return [worker.getStats() for worker in self._workers]
+
+    #-----------------------------------------------------------------------------
+    def _speak(self, call, message):
+        if self._on_speak is None:
+            return
+        context = call['context'] if call is not None and message['global'] == False else None
+        plugin_uid = call['plugin_uid'] if call is not None else None
+        self._on_speak(context, plugin_uid, message)
+
+    #-----------------------------------------------------------------------------
+    def _ask(self, worker, call, message):
+        if self._on_ask is None:
+            return
+        context = call['context'] if call is not None and message['global'] == False else None
+        plugin_uid = call['plugin_uid'] if call is not None else None
+
+        # Questions without context have no answer callback
+        answer_cbk = None
+        if message['cbk'] is not None:
+            self._callbacks_owners[(worker.index, message['cbk'])] = plugin_uid
+            answer_cbk = WorkerCallback(worker = worker, cbk_id = message['cbk'])
+        self._on_ask(context, plugin_uid, message, answer_cbk)
+
+
+#-----------------------------------------------------------------------------
+# WorkerContext
+#-----------------------------------------------------------------------------
+class WorkerContext(object):
+    """
+    Dialog context given to plugins in a worker process
+
+    Client variables are attributes, speech and questions are sent to the main process
+    """
+
+    #-----------------------------------------------------------------------------
+    def __init__(self, server, client, Vars):
+        object.__setattr__(self, '_server', server)
+        object.__setattr__(self, 'client', client)
+        object.__setattr__(self, 'Vars', Vars)
+
+    #-----------------------------------------------------------------------------
+    def __getattr__(self, name):
+        try:
+            return self.Vars[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    #-----------------------------------------------------------------------------
+    def __setattr__(self, name, value):
+        if self.Vars.has_key(name) == True:
+            self.Vars[name] = value
+        else:
+            object.__setattr__(self, name, value)
+
+    #-----------------------------------------------------------------------------
+    def speakToClient(self, plugin_uid, text, client_uids = None, zone_uids = None):
+        self._server.send({'type': 'speak', 'global': False, 'text': text, 'client_uids': client_uids, 'zone_uids': zone_uids})
+
+    #-----------------------------------------------------------------------------
+    def askClient(self, plugin_uid, text, answer_cbk, wit_context = None, client_uids = None, zone_uids = None, timeout = None):
+        cbk_id = self._server.addCallback(answer_cbk)
+        self._server.send({'type': 'ask', 'global': False, 'cbk': cbk_id, 'text': text, 'wit_context': wit_context,
+                           'client_uids': client_uids, 'zone_uids': zone_uids, 'timeout': timeout})
+
+
+#-----------------------------------------------------------------------------
+# WorkerServer
+#-----------------------------------------------------------------------------
+class WorkerServer(object):
+    """
+    Main loop of a worker process : run calls received from the main process
+    """
+
+    #-----------------------------------------------------------------------------
+    def __init__(self, input, output):
+        self._input = input
+        self._output = output
+
+        # Plugins instances : uid => instance
+        self._plugins = {}
+
+        # Answer callbacks : id => callback
+        self._callbacks = {}
+        self._next_cbk = 0
+
+        # Id of current call
+        self._call_id = None
+
+    #-----------------------------------------------------------------------------
+    def serve(self):
+        for line in iter(self._input.readline, ''):
+            self.handle(json.loads(line))
+
+    #-----------------------------------------------------------------------------
+    def send(self, message):
+        if message.has_key('id') == False:
+            message['id'] = self._call_id
+        self._output.write(_encode(message))
+        self._output.flush()
+
+    #-----------------------------------------------------------------------------
+    def addCallback(self, answer_cbk):
+        self._next_cbk += 1
+        self._callbacks[self._next_cbk] = answer_cbk
+        return self._next_cbk
+
+    #-----------------------------------------------------------------------------
+    def speak(self, text, client_uids = None, zone_uids = None):
+        # Speech without context
+        self.send({'type': 'speak', 'global': True, 'text': text, 'client_uids': client_uids, 'zone_uids': zone_uids})
+
+    #-----------------------------------------------------------------------------
+    def ask(self, text, wit_context = None, client_uids = None, zone_uids = None, timeout = None):
+        # Question without context : as in the main process, its answer callback is never called
+        self.send({'type': 'ask', 'global': True, 'cbk': None, 'text': text, 'wit_context': wit_context,
+                   'client_uids': client_uids, 'zone_uids': zone_uids, 'timeout': timeout})
+
+    #-----------------------------------------------------------------------------
+    def handle(self, message):
+        self._call_id = message['id']
+        context = None
+        if message.has_key('client') == True:
+            context = WorkerContext(server = self, client = message['client'], Vars = message['vars'])
+
+        try:
+            jsonInput = message['input']
+            if jsonInput is not None:
+                jsonInput['context'] = context
+
+            # Plugin method
+            if message['type'] == 'call':
+                result = getattr(self._getPlugin(uid = message['uid'], module = message['module']), message['method'])(jsonInput)
+            # Answer callback
+            else:
+                answer_cbk = self._callbacks.pop(message['cbk'], None)
+                if answer_cbk is None:
+                    raise KeyError("Unknown answer callback {cbk}".format(cbk = message['cbk']))
+                result = answer_cbk(context = context, jsonAnswer = jsonInput)
+
+            response = {'type': 'result', 'result': result}
+            if context is not None:
+                response['vars'] = context.Vars
+        except:
+            response = {'type': 'error', 'error': str(sys.exc_info()[1]), 'traceback': traceback.format_exc()}
+
+        self.send(response)
+        self._call_id = None
+
+    #-----------------------------------------------------------------------------
+    def _getPlugin(self, uid, module):
+        plugin = self._plugins.get(uid)
+        if plugin is None:
+            plugin = namedAny(module)()
+            plugin.uid = uid
+            self._plugins[uid] = plugin
+        return plugin
+
+
+#-----------------------------------------------------------------------------
+def serve(config_file = None):
+    """
+    Entry point of a worker process
+
+    config_file : server configuration file, applied before loading plugins
+    """
+    if config_file is not None:
+        from lisa.server.config_manager import ConfigManager
+        if ConfigManager.setConfiguration(config_file) == False:
+            # Worker stderr is logged by the main process
+            sys.stderr.write("Error : configuration file {file} invalid\n".format(file = config_file))
+
+    server = WorkerServer(input = sys.stdin, output = os.fdopen(_MESSAGES_FD, 'w'))
+
+    # Global speech and questions go to the main process
+    from lisa.server.libs.NeoDialog import NeoContext
+    def globalSpeakToClient(cls, text, plugin_uid = None, context = None, client_uids = None, zone_uids = None):
+        if context is not None:
+            return context.speakToClient(plugin_uid = plugin_uid, text = text, client_uids = client_uids, zone_uids = zone_uids)
+        server.speak(text = text, client_uids = client_uids, zone_uids = zone_uids)
+    def globalAskToClient(cls, text, answer_cbk, plugin_uid = None, context = None, wit_context = None, client_uids = None, zone_uids = None, timeout = None):
+        if context is not None:
+            return context.askClient(plugin_uid = plugin_uid, text = text, answer_cbk = answer_cbk, wit_context = wit_context,
+                                     client_uids = client_uids, zone_uids = zone_uids, timeout = timeout)
+        server.ask(text = text, wit_context = wit_context, client_uids = client_uids, zone_uids = zone_uids, timeout = timeout)
+    NeoContext.globalSpeakToClient = classmethod(globalSpeakToClient)
+    NeoContext.globalAskToClient = classmethod(globalAskToClient)
+
+    server.serve()
+
+# --------------------- End of workers.py  ---------------------
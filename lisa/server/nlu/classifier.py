@@ -0,0 +1,136 @@
+# -*- coding: UTF-8 -*-
+#-----------------------------------------------------------------------------
+# project     : Lisa server
+# module      : nlu
+# file        : classifier.py
+# description : Local intent classifier
+# author      : G.Dumee
+#-----------------------------------------------------------------------------
+# copyright   : Neotique
+#-----------------------------------------------------------------------------
+
+
+#-----------------------------------------------------------------------------
+# Imports
+#-----------------------------------------------------------------------------
+import math, unicodedata
+
+
+#-----------------------------------------------------------------------------
+# LocalClassifier
+#-----------------------------------------------------------------------------
+class LocalClassifier(object):
+    """
+    Local intent classifier trained from example utterances
+
+    Utterances are vectorized as TF-IDF weighted character n-grams.
+    An input gets the intent of the nearest example, the cosine similarity
+    being the confidence.
+    """
+
+    #-----------------------------------------------------------------------------
+    def __init__(self, ngram_min = 3, ngram_max = 5):
+        self.ngram_min = ngram_min
+        self.ngram_max = ngram_max
+
+        # Model : (intents of examples, inverted index ngram => [(example, weight)], idf, unknown ngram idf)
+        self._model = None
+
+    #-----------------------------------------------------------------------------
+    def train(self, examples):
+        """
+        Train the classifier
+
+        examples : {intent_name: [utterance, ...]}
+        """
+        # Vectorize examples
+        intents = []
+        counts = []
+        df = {}
+        for intent_name in examples:
+            for utterance in examples[intent_name]:
+                tf = self._ngrams(utterance)
+                if len(tf) == 0:
+                    continue
+                intents.append(intent_name)
+                counts.append(tf)
+                for ngram in tf:
+                    df[ngram] = df.get(ngram, 0) + 1
+
+        # No example
+        if len(intents) == 0:
+            self._model = None
+            return
+
+        # Inverse document frequencies
+        n = len(intents)
+        idf = {}
+        for ngram in df:
+            idf[ngram] = math.log((1.0 + n) / (1.0 + df[ngram])) + 1.0
+        unknown_idf = math.log(1.0 + n) + 1.0
+
+        # Build inverted index of normalized vectors
+        index = {}
+        for i in range(n):
+            vector = self._normalize(dict((ngram, tf * idf[ngram]) for ngram, tf in counts[i].iteritems()))
+            for ngram, weight in vector.iteritems():
+                index.setdefault(ngram, []).append((i, weight))
+
+        # Swap model
+        self._model = (intents, index, idf, unknown_idf)
+
+    #-----------------------------------------------------------------------------
+    def classify(self, text):
+        """
+        Classify an utterance
+
+        Return an outcome like Wit ones : {'intent', 'entities', 'confidence'}, None if no model
+        """
+        model = self._model
+        if model is None:
+            return None
+        intents, index, idf, unknown_idf = model
+
+        # Vectorize input
+        tf = self._ngrams(text)
+        if len(tf) == 0:
+            return None
+        vector = self._normalize(dict((ngram, count * idf.get(ngram, unknown_idf)) for ngram, count in tf.iteritems()))
+
+        # Cosine similarities with examples sharing ngrams
+        scores = {}
+        for ngram, weight in vector.iteritems():
+            for i, example_weight in index.get(ngram, ()):
+                scores[i] = scores.get(i, 0.0) + weight * example_weight
+        if len(scores) == 0:
+            return None
+
+        # Nearest example
+        best = max(scores, key = scores.get)
+        return {'intent': intents[best], 'entities': {}, 'confidence': min(scores[best], 1.0)}
+
+    #-----------------------------------------------------------------------------
+    def _ngrams(self, text):
+        # Normalize text : lower case, no accent, single spaces
+        text = unicodedata.normalize('NFKD', unicode(text).lower())
+        text = u''.join(c for c in text if unicodedata.combining(c) == False)
+        text = u' ' + u' '.join(text.split()) + u' '
+        if len(text) <= 2:
+            return {}
+
+        # Count ngrams
+        tf = {}
+        for size in range(self.ngram_min, self.ngram_max + 1):
+            for i in range(len(text) - size + 1):
+                ngram = text[i:i + size]
+                tf[ngram] = tf.get(ngram, 0) + 1
+        return tf
+
+    #-----------------------------------------------------------------------------
+    def _normalize(self, vector):
+        norm = math.sqrt(sum(w * w for w in vector.itervalues()))
+        if norm == 0:
+            return vector
+        return dict((ngram, w / norm) for ngram, w in vector.iteritems())
+
+# --------------------- End of classifier.py  ---------------------
@@ -0,0 +1,144 @@
+# -*- coding: UTF-8 -*-
+#-----------------------------------------------------------------------------
+# project     : Lisa server
+# module      : nlu
+# file        : patterns.py
+# description : Intent patterns matcher
+# author      : G.Dumee
+#-----------------------------------------------------------------------------
+# copyright   : Neotique
+#-----------------------------------------------------------------------------
+
+
+#-----------------------------------------------------------------------------
+# Imports
+#-----------------------------------------------------------------------------
+import re
+from twisted.python import log
+
+
+#-----------------------------------------------------------------------------
+# Globals
+#-----------------------------------------------------------------------------
+# Slots in templates : "allume la lumière du {room}"
+_slot_re = re.compile(r"\{(\w+)\}", re.UNICODE)
+
+# Python 2 regular expressions support up to 99 groups
+_max_groups = 99
+
+
+#-----------------------------------------------------------------------------
+# PatternMatcher
+#-----------------------------------------------------------------------------
+class PatternMatcher(object):
+    """
+    Match utterances against intents patterns
+
+    A pattern is a fixed phrase, or a template with slots : "allume la lumière du {room}".
+    Fixed phrases are found with a dict lookup, templates are compiled in combined
+    regular expressions, the most specific templates being tried first.
+    """
+
+    #-----------------------------------------------------------------------------
+    def __init__(self):
+        # Model : (fixed phrase => intent, [(regex, group => (intent, [(slot group, slot name)]))])
+        self._model = ({}, [])
+
+    #-----------------------------------------------------------------------------
+    def compile(self, patterns):
+        """
+        Compile patterns
+
+        patterns : {intent_name: [pattern, ...]}
+        """
+        phrases = {}
+        templates = []
+        for intent_name in patterns:
+            for pattern in patterns[intent_name]:
+                pattern = self._normalize(pattern)
+                slots = _slot_re.findall(pattern)
+
+                # Fixed phrase
+                if len(slots) == 0:
+                    if phrases.has_key(pattern) == True and phrases[pattern] != intent_name:
+                        log.err("Pattern '{pattern}' is declared by intents {first} and {second}".format(pattern = pattern.encode('utf-8'), first = phrases[pattern], second = intent_name))
+                        continue
+                    phrases[pattern] = intent_name
+                    continue
+
+                # Template
+                if len(slots) + 1 > _max_groups or len(set(slots)) != len(slots):
+                    log.err("Invalid pattern '{pattern}' for intent {intent}".format(pattern = pattern.encode('utf-8'), intent = intent_name))
+                    continue
+                literals = _slot_re.split(pattern)[::2]
+                templates.append((len(u''.join(literals)), intent_name, literals, slots))
+
+        # Most specific templates first
+        templates.sort(key = lambda t: t[0], reverse = True)
+
+        # Combine templates in regular expressions
+        regexes = []
+        sources = []
+        groups = {}
+        count = 0
+        for i, (length, intent_name, literals, slots) in enumerate(templates):
+            # Start a new regular expression when there are too many groups
+            if count + len(slots) + 1 > _max_groups:
+                regexes.append(self._combine(sources, groups))
+                sources, groups, count = [], {}, 0
+
+            # Build template source
+            name = "p{i}".format(i = i)
+            slot_groups = []
+            source = re.escape(literals[0])
+            for j, slot in enumerate(slots):
+                slot_group = "{name}_{j}".format(name = name, j = j)
+                slot_groups.append((slot_group, slot))
+                source += u"(?P<{group}>.+?)".format(group = slot_group) + re.escape(literals[j + 1])
+            sources.append(u"(?P<{name}>{source})".format(name = name, source = source))
+            groups[name] = (intent_name, slot_groups)
+            count += len(slots) + 1
+        if len(sources) > 0:
+            regexes.append(self._combine(sources, groups))
+
+        # Swap model
+        self._model = (phrases, regexes)
+
+    #-----------------------------------------------------------------------------
+    def match(self, text):
+        """
+        Match an utterance
+
+        Return an outcome like Wit ones : {'intent', 'entities', 'confidence'}, None when no pattern matches
+        """
+        phrases, regexes = self._model
+        text = self._normalize(text)
+
+        # Fixed phrases
+        intent_name = phrases.get(text)
+        if intent_name is not None:
+            return {'intent': intent_name, 'entities': {}, 'confidence': 1.0}
+
+        # Templates
+        for regex, groups in regexes:
+            m = regex.match(text)
+            if m is None:
+                continue
+            intent_name, slot_groups = groups[m.lastgroup]
+            entities = {}
+            for slot_group, slot in slot_groups:
+                entities[slot] = {'value': m.group(slot_group)}
+            return {'intent': intent_name, 'entities': entities, 'confidence': 1.0}
+
+        return None
+
+    #-----------------------------------------------------------------------------
+    def _combine(self, sources, groups):
+        return (re.compile(u"(?:{sources})\\Z".format(sources = u"|".join(sources)), re.UNICODE), groups)
+
+    #-----------------------------------------------------------------------------
+    def _normalize(self, text):
+        # Lower case, single spaces, no final punctuation
+        return u' '.join(unicode(text).lower().split()).strip(u" .!?")
+
+# --------------------- End of patterns.py  ---------------------
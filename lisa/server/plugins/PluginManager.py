@@ -13,15 +13,16 @@
 #-----------------------------------------------------------------------------
 # Imports
 #-----------------------------------------------------------------------------
-import lisa.plugins, os, pip, shutil, inspect, json, datetime, uuid, importlib
+import lisa.plugins, os, pip, shutil, inspect, json, datetime, uuid, importlib, threading, copy
 import lisa.server.core
 from lisa.server.web.manageplugins.models import Plugin, Cron, Intent
 from twisted.python.reflect import namedAny
 from django.template.loader import render_to_string
 from pymongo import MongoClient
-from twisted.python import log
+from twisted.python import log, threadable
 from lisa.server.config_manager import ConfigManager
-from twisted.python.reflect import namedAny
+from lisa.server.nlu.classifier import LocalClassifier
+from lisa.server.nlu.patterns import PatternMatcher
 
 
 #-----------------------------------------------------------------------------
@@ -35,6 +36,57 @@ server_path = configuration['path']
 plugins_path = os.path.dirname(lisa.plugins.__file__)
 
 
+#-----------------------------------------------------------------------------
+# CorePlugin
+#-----------------------------------------------------------------------------
+class CorePlugin(object):
+    """
+    Core plugin description, the core is not stored in the plugins collection
+    """
+    def __init__(self):
+        self.name = "Core"
+        self.pk = 0
+        self.uid = 0
+
+
+#-----------------------------------------------------------------------------
+# ContextTemplate
+#-----------------------------------------------------------------------------
+class ContextTemplate(object):
+    """
+    Context variables declared by enabled plugins, compiled once per registry build
+
+    client_vars, global_vars : tuples of (name, default)
+    """
+    #-----------------------------------------------------------------------------
+    def __init__(self, plugins = ()):
+        client_vars = {}
+        global_vars = {}
+        for plugin in plugins:
+            if hasattr(plugin, 'context') == False or plugin.context is None:
+                continue
+            for scope, scope_vars in (('client', client_vars), ('global', global_vars)):
+                for name, default in plugin.context.get(scope, {}).iteritems():
+                    scope_vars[str(name)] = default
+
+        self.client_vars = tuple(sorted(client_vars.iteritems()))
+        self.global_vars = tuple(sorted(global_vars.iteritems()))
+
+        # Client variables with a mutable default are copied for each client
+        self._client_defaults = client_vars
+        self._client_mutables = tuple(name for name, default in self.client_vars if isinstance(default, (dict, list)))
+
+    #-----------------------------------------------------------------------------
+    def cloneClientVars(self):
+        """
+        Return a new dict of client variables, set to their defaults
+        """
+        client_vars = self._client_defaults.copy()
+        for name in self._client_mutables:
+            client_vars[name] = copy.deepcopy(client_vars[name])
+        return client_vars
+
+
 #-----------------------------------------------------------------------------
 # PluginManager
 #-----------------------------------------------------------------------------
@@ -45,6 +97,33 @@ class PluginManager(object):
     # Plugins instances
     __PluginsInstances = {}
 
+    # Crons instances of classes other than the plugin one : (plugin pk, class path) => instance
+    __CronsInstances = {}
+
+    # Enabled plugins registry : {'name': {name: plugin}, 'pk': {pk: plugin}}
+    __PluginsIndex = None
+
+    # Intents routing table : intent name => Intent
+    __IntentsRoutes = None
+
+    # Local intent classifier, trained from intents examples
+    __LocalClassifier = None
+
+    # Intents patterns matcher
+    __PatternMatcher = None
+
+    # Context variables template
+    __ContextTemplate = None
+
+    # Serialize registry rebuilds
+    __RegistryLock = threading.Lock()
+
+    # Plugins steps bookkeeping, kept over registry rebuilds
+    __PluginsSteps = {}
+
+    # Core plugin
+    __CorePlugin = CorePlugin()
+
     #-----------------------------------------------------------------------------
     def __init__(self):
         # Not to be implemented
@@ -66,8 +145,12 @@ class PluginManager(object):
     #-----------------------------------------------------------------------------
     @classmethod
     def getEnabledPlugins(cls):
-        # List enabled plugins
-        return Plugin.objects(enabled = True, lang = configuration['lang_short'])
+        # Build registry on first access
+        if cls.__PluginsIndex is None:
+            cls._buildRegistry()
+
+        # List enabled plugins, without core
+        return [plugin for pk, plugin in cls.__PluginsIndex['pk'].iteritems() if pk != 0]
 
     #-----------------------------------------------------------------------------
     @classmethod
@@ -77,6 +160,89 @@ class PluginManager(object):
     #-----------------------------------------------------------------------------
     @classmethod
     def getIntent(cls, intent_name):
+        # Build routing table on first access
+        if cls.__IntentsRoutes is None:
+            cls._buildRegistry()
+
+        # Unknown or ambiguous intents are not in the table
+        return cls.__IntentsRoutes.get(intent_name)
+
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def matchIntent(cls, text):
+        """
+        Match an utterance with intents patterns
+
+        Return an outcome like Wit ones, None when no pattern matches
+        """
+        # Build matcher on first access
+        if cls.__PatternMatcher is None:
+            cls._buildRegistry()
+
+        return cls.__PatternMatcher.match(text)
+
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def classifyIntent(cls, text):
+        """
+        Classify an utterance with the local classifier
+
+        Return an outcome like Wit ones, None when there is no example
+        """
+        # Build classifier on first access
+        if cls.__LocalClassifier is None:
+            cls._buildRegistry()
+
+        return cls.__LocalClassifier.classify(text)
+
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def _buildRegistry(cls):
+        """
+        Build the plugins registry and the intents routing table from the database
+
+        Tables are rebuilt in new dicts, then swapped with the current ones,
+        so readers never see a partial table
+        """
+        with cls.__RegistryLock:
+            # Index enabled plugins by name and pk
+            index = {'name': {"Core": cls.__CorePlugin}, 'pk': {0: cls.__CorePlugin}}
+            for plugin in Plugin.objects(enabled = True, lang = configuration['lang_short']):
+                index['name'][plugin.name] = plugin
+                index['pk'][plugin.pk] = plugin
+
+            # Build intents routing table
+            routes = cls._buildIntentRoutes()
+
+            # Train local classifier with intents examples
+            examples = {}
+            for name, intent in routes.iteritems():
+                if hasattr(intent, 'examples') == True and intent.examples is not None:
+                    examples[name] = intent.examples
+            classifier = LocalClassifier()
+            classifier.train(examples)
+
+            # Compile intents patterns
+            patterns = {}
+            for name, intent in routes.iteritems():
+                if hasattr(intent, 'patterns') == True and intent.patterns is not None:
+                    patterns[name] = intent.patterns
+            matcher = PatternMatcher()
+            matcher.compile(patterns)
+
+            # Compile context variables template
+            template = ContextTemplate(plugins = [plugin for pk, plugin in index['pk'].iteritems() if pk != 0])
+
+            # Swap tables
+            cls.__PluginsIndex = index
+            cls.__IntentsRoutes = routes
+            cls.__LocalClassifier = classifier
+            cls.__PatternMatcher = matcher
+            cls.__ContextTemplate = template
+
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def _buildIntentRoutes(cls):
         # TODO get these intents from a core function
         # Create the default core intents
         defaults_intent_list = {'name': "core_i_can",
@@ -90,14 +256,20 @@ class PluginManager(object):
                                 'enabled': True}
         intent_list, created = Intent.objects.get_or_create(name = 'core_i_can_plugin', defaults = defaults_intent_list)
 
-        # List enabled intents
-        intent_list = Intent.objects(name = intent_name, enabled = True)
+        # Index enabled intents by name
+        routes = {}
+        ambiguous = set()
+        for intent in Intent.objects(enabled = True):
+            if routes.has_key(intent.name) == True:
+                ambiguous.add(intent.name)
+            routes[intent.name] = intent
 
-        # If not a unique enabled intent
-        if intent_list is None or len(intent_list) != 1:
-            return None
+        # An intent must be unique to be routed
+        for name in ambiguous:
+            log.err("Intent {name} is defined by several enabled plugins, it will be ignored".format(name = name))
+            routes.pop(name)
 
-        return intent_list[0]
+        return routes
 
     #-----------------------------------------------------------------------------
     @classmethod
@@ -107,14 +279,16 @@ class PluginManager(object):
         cls.__PluginsInstances[0] = getattr(module, "Intents")()
         cls.__PluginsInstances[0].uid = 0
 
-        # Get enabled plugin lists
-        plugin_list = cls.getEnabledPlugins()
-
         # Update plugin install
-        for plugin in plugin_list:
+        for plugin in Plugin.objects(enabled = True, lang = configuration['lang_short']):
             log.msg("Initiating plugin {name}".format(name = plugin.name))
             cls._updatePlugin(plugin = plugin)
 
+        # Build plugins registry
+        cls._buildRegistry()
+
+        # Instantiate plugins
+        for plugin in cls.getEnabledPlugins():
             try:
                 # Create plugin instance
                 cls.__PluginsInstances[plugin.pk] = namedAny(plugin.module)()
@@ -124,76 +298,66 @@ class PluginManager(object):
                 if configuration['debug']['debug_plugin'] == True:
                     raise
 
-            # Init global context vars
-            if hasattr(plugin, 'context') == True and plugin.context.has_key('global') == True:
-                for var in plugin.context['global']:
-                    try:
-                        global_context.createGlobalVar(name = var, default = plugin.context['global'][var])
-                    except:
-                        log.err("Error while creating global context var {} for plugin {}".format(var, plugin.name))
-                        if configuration['debug']['debug_plugin'] == True:
-                            raise
-
     #-----------------------------------------------------------------------------
     @classmethod
-    def initContext(cls, context):
-        # Get enabled plugin lists
-        plugin_list = cls.getEnabledPlugins()
+    def getContextTemplate(cls):
+        """
+        Return the context variables template of enabled plugins, rebuilt only on plugins changes
+        """
+        # Build registry on first access
+        if cls.__ContextTemplate is None:
+            cls._buildRegistry()
 
-        # Update plugin install
-        for plugin in plugin_list:
-            if hasattr(plugin, 'context') == True and plugin.context.has_key('client') == True:
-                for var in plugin.context['client']:
-                    try:
-                        context.createClientVar(name = var, default = plugin.context['client'][var])
-                    except:
-                        log.err("Error while creating client context var {} for plugin {}".format(var, plugin['name']))
-                        if configuration['debug']['debug_plugin'] == True:
-                            raise
+        return cls.__ContextTemplate
 
     #-----------------------------------------------------------------------------
     @classmethod
     def deinit(cls):
-        # Get enabled plugin lists
-        plugin_list = cls.getEnabledPlugins()
-
         # Delete plugin instances
-        for pk in cls.__PluginsInstances:
+        for instance in cls.__PluginsInstances.values() + cls.__CronsInstances.values():
             try:
-                cls.__PluginsInstances[pk].clean()
+                instance.clean()
             except:
                 pass
         cls.__PluginsInstances = {}
+        cls.__CronsInstances = {}
+        cls.__PluginsIndex = None
+        cls.__IntentsRoutes = None
+        cls.__LocalClassifier = None
+        cls.__PatternMatcher = None
+        cls.__ContextTemplate = None
+        cls.__PluginsSteps = {}
 
     #-----------------------------------------------------------------------------
     @classmethod
     def getPlugin(cls, plugin_name = None, plugin_uid = None):
-        # Return fake core plugin
-        if (plugin_uid is not None and plugin_uid == 0) or (plugin_name is not None and plugin_name == "Core"):
-            class FakePlugin():
-                def __init__(self):
-                    self.name = "Core"
-                    self.pk = 0
-                    self.uid = 0
-                    self.steps = {'count': 0, 'first': None, 'last': None}
-            return FakePlugin()
+        # Build registry on first access
+        if cls.__PluginsIndex is None:
+            cls._buildRegistry()
+        index = cls.__PluginsIndex
 
-        # List enabled plugins
-        plugin_list = Plugin.objects(enabled = True, lang = configuration['lang_short'])
-
-        # Search plugin
-        for plugin in plugin_list:
-            # Search plugin by name
-            if plugin_name is not None and plugin.name == plugin_name:
-                return plugin
+        # Search plugin by name
+        if plugin_name is not None:
+            return index['name'].get(plugin_name)
 
-            # Search plugin by uid
-            if plugin_uid is not None and plugin.pk == plugin_uid:
-                return plugin
+        # Search plugin by uid
+        if plugin_uid is not None:
+            return index['pk'].get(plugin_uid)
 
         # Not found
         return None
 
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def getPluginSteps(cls, plugin_uid):
+        """
+        Return the steps bookkeeping of a plugin : {'count', 'first', 'last'}
+        """
+        steps = cls.__PluginsSteps.get(plugin_uid)
+        if steps is None:
+            steps = cls.__PluginsSteps.setdefault(plugin_uid, {'count': 0, 'first': None, 'last': None})
+        return steps
+
     #-----------------------------------------------------------------------------
     @classmethod
     def getPluginInstance(cls, plugin_name = None, plugin_uid = None):
@@ -206,6 +370,43 @@ class PluginManager(object):
 
         return cls.__PluginsInstances[plugin.pk]
 
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def getCronInstance(cls, plugin_uid, class_path):
+        """
+        Return the instance running the crons of class class_path for a plugin
+
+        The live plugin instance is shared when it is of this class, other
+        classes are instantiated on first use, then kept over scheduler reloads
+        """
+        # Live plugin instance
+        plugin = cls.getPlugin(plugin_uid = plugin_uid)
+        if plugin is not None and plugin.module == class_path and cls.__PluginsInstances.has_key(plugin.pk) == True:
+            return cls.__PluginsInstances[plugin.pk]
+
+        # Cron class instance
+        key = (plugin_uid, class_path)
+        if cls.__CronsInstances.has_key(key) == False:
+            instance = namedAny(class_path)()
+            instance.uid = plugin_uid
+            cls.__CronsInstances[key] = instance
+        return cls.__CronsInstances[key]
+
+    #-----------------------------------------------------------------------------
+    @classmethod
+    def _cleanCronInstances(cls, plugin_uid):
+        # Crons instances are used by the scheduler, in the reactor thread
+        if threadable.ioThread is not None and threadable.isInIOThread() == False:
+            from twisted.internet import reactor
+            reactor.callFromThread(cls._cleanCronInstances, plugin_uid)
+            return
+
+        for key in [key for key in cls.__CronsInstances if key[0] == plugin_uid]:
+            try:
+                cls.__CronsInstances.pop(key).clean()
+            except:
+                pass
+
     #-----------------------------------------------------------------------------
     @classmethod
     def getPluginMethod(cls, plugin, method_name):
@@ -244,6 +445,9 @@ class PluginManager(object):
         # Update plugin in DB
         cls._updatePlugin(plugin = plugin)
 
+        # Update plugins registry
+        cls._buildRegistry()
+
         return {'status': 'success', 'log': 'Plugin installed'}
 
     #-----------------------------------------------------------------------------
@@ -263,6 +467,9 @@ class PluginManager(object):
         # Update plugin
         cls._updatePlugin(plugin = plugin)
 
+        # Update plugins registry
+        cls._buildRegistry()
+
         return {'status': 'success', 'log': 'Plugin updated'}
 
     #-----------------------------------------------------------------------------
@@ -296,9 +503,6 @@ class PluginManager(object):
         # TODO remove when uid are not useful
         setattr(plugin, 'uid', plugin.pk)
 
-        #TODO
-        setattr(plugin, 'steps', {'count': 0, 'first': None, 'last': None})
-
         # Add langages from directory search
         setattr(plugin, 'lang', [])
         localedir = os.path.normpath(plugin_path + '/lang')
@@ -396,7 +600,7 @@ class PluginManager(object):
                 for parameter in intent_item:
                     if parameter == 'method':
                         setattr(intent, 'method_name', intent_item[parameter])
-                    elif parameter == 'i_can':
+                    elif parameter == 'i_can' or parameter == 'examples' or parameter == 'patterns':
                         setattr(intent, parameter, intent_item[parameter])
 
                 # Delete older items
@@ -473,6 +677,9 @@ class PluginManager(object):
             intent.enabled = enabled
             intent.save()
 
+        # Update plugins registry
+        cls._buildRegistry()
+
         return {'status': 'success', 'log': 'Plugin ' + astr}
 
     #-----------------------------------------------------------------------------
@@ -496,6 +703,7 @@ class PluginManager(object):
         # Remove plugin crons
         for cron in Cron.objects(plugin = plugin):
             cron.delete()
+        cls._cleanCronInstances(plugin.pk)
 
         # Remove plugin intents
         for oIntent in Intent.objects(plugin = plugin):
@@ -504,6 +712,9 @@ class PluginManager(object):
         # Remove plugin
         plugin.delete()
 
+        # Update plugins registry
+        cls._buildRegistry()
+
         return {'status': 'success', 'log': 'Plugin uninstalled'}
 
     #-----------------------------------------------------------------------------
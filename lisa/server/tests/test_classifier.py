@@ -0,0 +1,38 @@
+# -*- coding: UTF-8 -*-
+from lisa.server.nlu.classifier import LocalClassifier
+from twisted.trial import unittest
+
+
+class LisaLocalClassifierTestCase(unittest.TestCase):
+    def setUp(self):
+        self.classifier = LocalClassifier()
+        self.classifier.train({
+            'light_on': [u"allume la lumière", u"allume la lampe"],
+            'light_off': [u"éteins la lumière", u"éteins la lampe"],
+            'time': [u"quelle heure est-il", u"il est quelle heure"],
+        })
+
+    def test_exact_example(self):
+        outcome = self.classifier.classify(u"quelle heure est-il")
+        self.assertEqual(outcome['intent'], 'time')
+        self.assertAlmostEqual(outcome['confidence'], 1.0)
+        self.assertEqual(outcome['entities'], {})
+
+    def test_normalization(self):
+        outcome = self.classifier.classify(u"  Eteins   la LUMIERE ")
+        self.assertEqual(outcome['intent'], 'light_off')
+        self.assertAlmostEqual(outcome['confidence'], 1.0)
+
+    def test_near_example(self):
+        outcome = self.classifier.classify(u"allume la lumière du salon")
+        self.assertEqual(outcome['intent'], 'light_on')
+        self.assertTrue(outcome['confidence'] < 1.0)
+
+    def test_unknown(self):
+        outcome = self.classifier.classify(u"joue de la musique")
+        self.assertTrue(outcome is None or outcome['confidence'] < 0.5)
+
+    def test_no_model(self):
+        self.assertEqual(LocalClassifier().classify(u"allume la lumière"), None)
+        self.classifier.train({})
+        self.assertEqual(self.classifier.classify(u"allume la lumière"), None)
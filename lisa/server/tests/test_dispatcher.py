@@ -0,0 +1,49 @@
+from lisa.server.libs.dispatcher import ClientDispatcher, DispatcherFull
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+
+class LisaDispatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.dispatcher = ClientDispatcher(max_pending=2, clock=self.clock)
+        self.calls = []
+
+    def work(self, name):
+        d = defer.Deferred()
+        self.calls.append((name, d))
+        return d
+
+    def test_order(self):
+        d1 = self.dispatcher.dispatch("a", "1", self.work, "a1")
+        d2 = self.dispatcher.dispatch("a", "2", self.work, "a2")
+        self.dispatcher.dispatch("b", "1", self.work, "b1")
+        self.assertEqual([name for name, d in self.calls], ["a1", "b1"])
+        self.clock.advance(3)
+        self.calls[0][1].callback("r1")
+        self.assertEqual(self.successResultOf(d1), "r1")
+        self.assertEqual([name for name, d in self.calls], ["a1", "b1", "a2"])
+        self.calls[2][1].errback(ValueError("error"))
+        self.failureResultOf(d2, ValueError)
+        stats = self.dispatcher.getStats()["a"]
+        self.assertEqual((stats['processed'], stats['depth'], stats['running']), (2, 0, False))
+        self.assertEqual((stats['wait_max'], stats['wait_avg']), (3, 1.5))
+
+    def test_collapse(self):
+        self.dispatcher.dispatch("a", "1", self.work, "a1")
+        d2 = self.dispatcher.dispatch("a", "2", self.work, "a2")
+        d3 = self.dispatcher.dispatch("a", "2", self.work, "a3")
+        self.calls[0][1].callback(None)
+        self.calls[1][1].callback("r2")
+        self.assertEqual((self.successResultOf(d2), self.successResultOf(d3)), ("r2", "r2"))
+        self.assertEqual([name for name, d in self.calls], ["a1", "a2"])
+        self.assertEqual(self.dispatcher.getStats()["a"]['collapsed'], 1)
+
+    def test_full(self):
+        self.dispatcher.dispatch("a", "1", self.work, "a1")
+        self.dispatcher.dispatch("a", "2", self.work, "a2")
+        self.dispatcher.dispatch("a", "3", self.work, "a3")
+        self.failureResultOf(self.dispatcher.dispatch("a", "4", self.work, "a4"), DispatcherFull)
+        stats = self.dispatcher.getStats()["a"]
+        self.assertEqual((stats['depth'], stats['depth_max'], stats['rejected']), (2, 2, 1))
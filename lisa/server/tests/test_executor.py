@@ -0,0 +1,75 @@
+import threading
+from lisa.server.libs.executor import PluginExecutor, ExecutorFull, ExecutorTimeout
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, threads
+
+
+class LisaPluginExecutorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.executor = PluginExecutor(max_threads=4, concurrency=1, queue_depth=1, timeout=0)
+        self.executor.start()
+        self.release = threading.Event()
+        self.addCleanup(self.executor.stop)
+        self.addCleanup(self.release.set)
+
+    def blocking(self, value):
+        self.release.wait(5)
+        return value
+
+    @defer.inlineCallbacks
+    def test_result(self):
+        result = yield self.executor.run("plugin", lambda a, b: a + b, 1, b=2)
+        self.assertEqual(result, 3)
+        stats = self.executor.getStats()["plugin"]
+        self.assertEqual((stats['calls'], stats['running'], stats['errors']), (1, 0, 0))
+
+    @defer.inlineCallbacks
+    def test_error(self):
+        def error():
+            raise ValueError("plugin error")
+        yield self.assertFailure(self.executor.run("plugin", error), ValueError)
+        self.assertEqual(self.executor.getStats()["plugin"]['errors'], 1)
+
+    @defer.inlineCallbacks
+    def test_concurrency(self):
+        d1 = self.executor.run("plugin", self.blocking, 1)
+        d2 = self.executor.run("plugin", self.blocking, 2)
+        d3 = self.executor.run("plugin", self.blocking, 3)
+        d4 = self.executor.run("other", self.blocking, 4)
+        stats = self.executor.getStats()
+        self.assertEqual((stats["plugin"]['running'], stats["plugin"]['waiting']), (1, 1))
+        self.assertEqual(stats["other"]['running'], 1)
+        yield self.assertFailure(d3, ExecutorFull)
+        self.release.set()
+        results = yield defer.gatherResults([d1, d2, d4])
+        self.assertEqual(results, [1, 2, 4])
+        self.assertEqual(self.executor.getStats()["plugin"]['rejected'], 1)
+
+    @defer.inlineCallbacks
+    def test_timeout(self):
+        self.executor.setLimits("plugin", timeout=0.05)
+        d = self.executor.run("plugin", self.blocking, 1)
+        yield self.assertFailure(d, ExecutorTimeout)
+        stats = self.executor.getStats()["plugin"]
+        self.assertEqual((stats['timeouts'], stats['running']), (1, 1))
+        self.release.set()
+
+    @defer.inlineCallbacks
+    def test_stop(self):
+        started = threading.Event()
+        def waiting():
+            started.set()
+            self.release.wait(5)
+            return threads.blockingCallFromThread(reactor, lambda: "reactor")
+        d1 = self.executor.run("plugin", waiting)
+        d2 = self.executor.run("plugin", self.blocking, 2)
+        started.wait(5)
+
+        # The running call waits for the reactor while the pool stops
+        stopped = self.executor.stop()
+        self.release.set()
+        self.assertEqual((yield d1), "reactor")
+        yield self.assertFailure(d2, ExecutorFull)
+        yield stopped
+        yield self.assertFailure(self.executor.run("other", self.blocking, 3), ExecutorFull)
+        self.assertEqual(self.executor.getStats()["plugin"]['rejected'], 1)
@@ -0,0 +1,102 @@
+from lisa.server.libs.history import Step, StepHistory
+from twisted.trial import unittest
+from twisted.internet import defer, threads
+from twisted.internet.task import Clock
+
+
+class ListSink(object):
+    def __init__(self):
+        self.docs = []
+
+    def write(self, docs):
+        self.docs.extend(docs)
+
+
+class LisaStepTestCase(unittest.TestCase):
+    def test_dict_view(self):
+        step = Step(plugin_uid=3)
+        step['type'] = "Plugin speech"
+        step['message'] = u"bonjour"
+        self.assertEqual(step.type, "Plugin speech")
+        self.assertEqual(step['plugin_uid'], 3)
+        self.assertEqual(step.get('message'), u"bonjour")
+        self.assertEqual(step.get('wit_context'), None)
+        self.assertTrue(step.has_key('message'))
+        self.assertEqual(step.pop('message'), u"bonjour")
+        self.assertRaises(KeyError, step.__getitem__, 'message')
+        self.assertEqual(step.pop('message', None), None)
+        self.assertEqual(sorted(step.copy().keys()), sorted(Step._fields))
+
+
+class LisaStepHistoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.sink = ListSink()
+        self.history = StepHistory(capacity=3, retention=60, sink=self.sink, batch_size=2, clock=self.clock)
+        self.batches = []
+        self.history._write = self.batches.append
+        self.client_steps = {'count': 0, 'first': None, 'last': None}
+
+    def add(self, client=False):
+        step = Step()
+        step['answer_cbk'] = self.setUp
+        if client == True:
+            return self.history.add(step, client_steps=self.client_steps)
+        return self.history.add(step)
+
+    def test_links(self):
+        a = self.add(client=True)
+        b = self.add()
+        c = self.add(client=True)
+        self.assertEqual((a.uid, b.uid, c.uid), (1, 2, 3))
+        self.assertEqual(self.history.get(1)['next'], 2)
+        self.assertEqual(self.history.get(3)['previous'], 2)
+        self.assertEqual(self.history.get(3)['client_previous'], 1)
+        self.assertEqual(self.client_steps, {'count': 2, 'first': 1, 'last': 3})
+
+    def test_capacity(self):
+        self.add(client=True)
+        for i in range(4):
+            self.add()
+        self.assertEqual(len(self.history), 3)
+        self.assertEqual(self.history.get(1), None)
+        self.assertEqual(self.history.get(3)['previous'], None)
+        self.assertEqual(self.history.steps, {'count': 5, 'first': 3, 'last': 5})
+        self.assertEqual(self.client_steps, {'count': 1, 'first': None, 'last': None})
+
+    def test_retention(self):
+        self.add()
+        self.clock.advance(30)
+        self.add()
+        self.clock.advance(30)
+        self.history.expire()
+        self.assertEqual(self.history.get(1), None)
+        self.assertEqual(self.history.steps['first'], 2)
+
+    def test_spill_batches(self):
+        for i in range(5):
+            self.add()
+        self.assertEqual(self.history.getStats()['writing'], 1)
+        self.history._writeBatch(self.batches.pop(), threaded=True)
+        self.assertEqual([doc['uid'] for doc in self.sink.docs], [1, 2])
+        self.assertFalse('answer_cbk' in self.sink.docs[0])
+        self.history.clear()
+        self.assertEqual([doc['uid'] for doc in self.sink.docs], [1, 2, 3, 4, 5])
+        self.assertEqual(self.history.getStats()['spilled'], 5)
+
+    @defer.inlineCallbacks
+    def test_threads(self):
+        # steps added from threads are added by the reactor
+        history = StepHistory(capacity=10000, clock=self.clock)
+        def add():
+            for i in range(100):
+                history.add(Step(), client_steps=self.client_steps)
+        yield defer.gatherResults([threads.deferToThread(add) for i in range(4)])
+        uids = []
+        uid = history.steps['first']
+        while uid is not None:
+            uids.append(uid)
+            self.assertEqual(history.get(uid)['client_next'], history.get(uid)['next'])
+            uid = history.get(uid)['next']
+        self.assertEqual(uids, range(1, 401))
+        self.assertEqual(self.client_steps, {'count': 400, 'first': 1, 'last': 400})
@@ -0,0 +1,44 @@
+from lisa.server.libs.intentcache import IntentCache
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+
+
+class LisaIntentCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = IntentCache(size=2, ttl=10, clock=self.clock)
+
+    def test_key_normalization(self):
+        self.assertEqual(IntentCache.makeKey(u"  Allume   la LUMIERE ", "fr"), IntentCache.makeKey(u"allume la lumiere", "fr"))
+        self.assertNotEqual(IntentCache.makeKey(u"oui", "fr"), IntentCache.makeKey(u"oui", "en"))
+        self.assertNotEqual(IntentCache.makeKey(u"oui", "fr"), IntentCache.makeKey(u"oui", "fr", {'state': 'confirm'}))
+
+    def test_hit_returns_copy(self):
+        self.cache.set("a", {'outcome': {'intent': 'hello'}})
+        value = self.cache.get("a")
+        value['outcome']['intent'] = 'changed'
+        self.assertEqual(self.cache.get("a")['outcome']['intent'], 'hello')
+        self.assertEqual(self.cache.getStats()['hits'], 2)
+
+    def test_ttl(self):
+        self.cache.set("a", 1)
+        self.clock.advance(9)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.clock.advance(1)
+        self.assertEqual(self.cache.get("a"), None)
+        self.assertEqual(self.cache.getStats()['misses'], 1)
+
+    def test_lru_eviction(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+        self.assertEqual(self.cache.get("b"), None)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertEqual(self.cache.getStats()['evictions'], 1)
+
+    def test_flush(self):
+        self.cache.set("a", 1)
+        self.cache.flush()
+        self.assertEqual(self.cache.get("a"), None)
+        self.assertEqual(self.cache.getStats()['size'], 0)
@@ -0,0 +1,88 @@
+from lisa.server.libs.outqueue import OutboundQueue
+from twisted.trial import unittest
+
+
+class LisaOutboundQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.lines = []
+        self.disconnected = False
+
+    def build(self, policy):
+        return OutboundQueue(send=self.lines.append, disconnect=self.disconnect, high_water=3, low_water=1, policy=policy)
+
+    def disconnect(self):
+        self.disconnected = True
+
+    def test_direct_write(self):
+        queue = self.build('drop_oldest')
+        queue.push("a")
+        self.assertEqual(self.lines, ["a"])
+        self.assertEqual(queue.getStats()['sent'], 1)
+
+    def test_pause_resume(self):
+        queue = self.build('drop_oldest')
+        queue.pauseProducing()
+        queue.push("a")
+        queue.push("b")
+        self.assertEqual(self.lines, [])
+        queue.resumeProducing()
+        self.assertEqual(self.lines, ["a", "b"])
+        self.assertEqual(queue.getStats()['depth'], 0)
+
+    def test_drop_oldest(self):
+        queue = self.build('drop_oldest')
+        queue.pauseProducing()
+        for line in "abcde":
+            queue.push(line)
+        self.assertTrue(queue.congested)
+        queue.resumeProducing()
+        self.assertEqual(self.lines, ["c", "d", "e"])
+        self.assertEqual(queue.getStats()['dropped'], 2)
+        self.assertFalse(queue.congested)
+
+    def test_coalesce(self):
+        queue = self.build('coalesce')
+        queue.pauseProducing()
+        queue.push("ask1", ('command', 'ask'))
+        queue.push("chat1", None)
+        queue.push("kws", ('command', 'kws'))
+        queue.push("ask2", ('command', 'ask'))
+        queue.push("chat2", None)
+        queue.resumeProducing()
+        self.assertEqual(self.lines, ["kws", "ask2", "chat2"])
+        stats = queue.getStats()
+        self.assertEqual((stats['coalesced'], stats['dropped']), (1, 1))
+
+    def test_coalesce_order(self):
+        # The client must end in ask mode
+        queue = self.build('coalesce')
+        queue.pauseProducing()
+        queue.push("ask1", ('command', 'ask'))
+        queue.push("kws", ('command', 'kws'))
+        queue.push("chat", None)
+        queue.push("ask2", ('command', 'ask'))
+        queue.resumeProducing()
+        self.assertEqual(self.lines, ["kws", "chat", "ask2"])
+
+    def test_disconnect(self):
+        queue = self.build('disconnect')
+        queue.pauseProducing()
+        for line in "abcd":
+            queue.push(line)
+        self.assertTrue(self.disconnected)
+        queue.resumeProducing()
+        self.assertEqual(self.lines, [])
+
+    def test_pause_while_flushing(self):
+        queue = self.build('drop_oldest')
+        queue.pauseProducing()
+        queue.push("a")
+        queue.push("b")
+        lines = []
+        def send(line):
+            lines.append(line)
+            queue.pauseProducing()
+        queue._send = send
+        queue.resumeProducing()
+        self.assertEqual(lines, ["a"])
+        self.assertEqual(queue.getStats()['depth'], 1)
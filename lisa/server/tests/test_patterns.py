@@ -0,0 +1,39 @@
+# -*- coding: UTF-8 -*-
+from lisa.server.nlu.patterns import PatternMatcher
+from twisted.trial import unittest
+
+
+class LisaPatternMatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.matcher = PatternMatcher()
+        self.matcher.compile({
+            'time': [u"quelle heure est-il", u"il est quelle heure"],
+            'light_on': [u"allume la lumière du {room}", u"allume la lumière"],
+            'light_dim': [u"mets la lumière du {room} à {level} pour cent"],
+        })
+
+    def test_phrase(self):
+        outcome = self.matcher.match(u"Quelle heure   est-il ?")
+        self.assertEqual(outcome, {'intent': 'time', 'entities': {}, 'confidence': 1.0})
+
+    def test_template(self):
+        outcome = self.matcher.match(u"allume la lumière du salon")
+        self.assertEqual(outcome['intent'], 'light_on')
+        self.assertEqual(outcome['entities'], {'room': {'value': u"salon"}})
+        outcome = self.matcher.match(u"allume la lumière du salon demain")
+        self.assertEqual(outcome['entities'], {'room': {'value': u"salon demain"}})
+
+    def test_specific_template_first(self):
+        outcome = self.matcher.match(u"mets la lumière du garage à 50 pour cent")
+        self.assertEqual(outcome['intent'], 'light_dim')
+        self.assertEqual(outcome['entities'], {'room': {'value': u"garage"}, 'level': {'value': u"50"}})
+
+    def test_no_match(self):
+        self.assertEqual(self.matcher.match(u"joue de la musique"), None)
+        self.assertEqual(PatternMatcher().match(u"quelle heure est-il"), None)
+
+    def test_many_templates(self):
+        self.matcher.compile({'intent': [u"commande %d {a}" % i for i in range(200)]})
+        outcome = self.matcher.match(u"commande 150 x")
+        self.assertEqual(outcome['entities'], {'a': {'value': u"x"}})
+        self.assertTrue(len(self.matcher._model[1]) > 1)
@@ -0,0 +1,363 @@
+import time, threading
+from datetime import datetime, timedelta
+from dateutil.rrule import rrule, SECONDLY
+from bson.objectid import ObjectId
+from lisa.server.libs.txscheduler.manager import ScheduledTaskManager
+from lisa.server.libs.txscheduler.tasks import ScheduledTask
+from lisa.server.libs.executor import PluginExecutor
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task as twisted_task
+from twisted.internet.task import Clock
+
+
+class QuietTask(ScheduledTask):
+    def before_execute(self):
+        pass
+
+    def after_execute(self):
+        pass
+
+
+class FakeCrons(object):
+    def __init__(self):
+        self.crons = []
+
+    def find(self, query):
+        return [dict(cron) for cron in self.crons
+                if cron['enabled'] == query['enabled'] and query.get('plugin', cron['plugin']) == cron['plugin']]
+
+
+class FakeStates(object):
+    def __init__(self):
+        self.states = []
+        self.writes = 0
+
+    def find(self):
+        return [dict(state) for state in self.states]
+
+    def bulk_write(self, requests, ordered=True):
+        self.writes += 1
+        for request in requests:
+            self.states.append(dict(request._filter, **request._doc['$set']))
+
+
+class CronPlugin(object):
+    cleaned = 0
+
+    def clean(self):
+        CronPlugin.cleaned += 1
+
+
+class OtherCron(CronPlugin):
+    pass
+
+
+class FakePlugin(object):
+    def __init__(self, pk, module):
+        self.pk = pk
+        self.name = "Cron"
+        self.module = module
+        self.deleted = False
+
+    def delete(self):
+        self.deleted = True
+
+
+class FakeObjects(object):
+    def __init__(self, objects):
+        self._objects = objects
+
+    def objects(self, **kwargs):
+        return list(self._objects)
+
+
+class CronTaskManager(ScheduledTaskManager):
+    def __init__(self, *args, **kwargs):
+        ScheduledTaskManager.__init__(self, *args, **kwargs)
+        self.database = type('Database', (object,), {'crons': FakeCrons(), 'cron_states': FakeStates()})()
+        self.calls = []
+
+    def _bind(self, cron):
+        return lambda: self.calls.append((cron['name'], self.clock.seconds()))
+
+    def _write(self, batch):
+        self._write_states(batch)
+
+
+class LisaSchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.base = int(time.time()) + 1
+        self.clock.advance(self.base)
+        configuration = {'database': {'server': 'localhost', 'port': 27017}, 'debug': {'debug_scheduler': False},
+                         'cron_threads': 2, 'cron_timeout': 600, 'cron_overlap': 'skip', 'cron_catchup': 'skip',
+                         'cron_catchup_max': 3, 'cron_catchup_spread': 1, 'cron_state_flush': 10}
+        self.manager = ScheduledTaskManager(configuration, clock=self.clock)
+        self.manager.init_flag = True
+        self.manager.start()
+        self.runs = []
+
+    def tearDown(self):
+        self.manager.stop()
+
+    def task(self, name, interval, func=None, count=None):
+        start = datetime.fromtimestamp(self.clock.seconds())
+        if func is None:
+            func = lambda: self.runs.append((name, self.clock.seconds()))
+        return QuietTask(name, rrule(SECONDLY, interval=interval, dtstart=start, count=count), func)
+
+    def test_single_call(self):
+        self.manager.add_task(self.task("a", 10))
+        self.manager.add_task(self.task("b", 4))
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.assertEqual(self.clock.getDelayedCalls()[0].getTime(), self.base + 4)
+        self.clock.advance(3)
+        self.assertEqual(self.runs, [])
+
+    def test_run_order(self):
+        self.manager.add_task(self.task("a", 10))
+        self.manager.add_task(self.task("b", 4))
+        self.clock.pump([1] * 12)
+        self.assertEqual(self.runs, [("b", self.base + 4), ("b", self.base + 8), ("a", self.base + 10), ("b", self.base + 12)])
+
+    def test_remove(self):
+        a, b = self.task("a", 2), self.task("b", 3)
+        self.manager.add_task(a)
+        self.manager.add_task(b)
+        self.manager.remove_task(a)
+        self.assertEqual(self.clock.getDelayedCalls()[0].getTime(), self.base + 3)
+        self.clock.pump([1] * 6)
+        self.assertEqual([name for name, t in self.runs], ["b", "b"])
+
+    def test_idle(self):
+        self.manager.add_task(self.task("a", 2, count=2))
+        self.clock.pump([1] * 5)
+        self.assertEqual(len(self.runs), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def running_task(self, overlap):
+        # each run returns a Deferred, fired by the test
+        self.pending = []
+        def func():
+            self.runs.append(("a", self.clock.seconds()))
+            d = defer.Deferred()
+            self.pending.append(d)
+            return d
+        task = self.task("a", 2, func=func)
+        task.overlap = overlap
+        self.manager.add_task(task)
+        return task
+
+    def test_overlap_skip(self):
+        task = self.running_task('skip')
+        self.clock.pump([1] * 7)
+        self.assertEqual(len(self.runs), 1)
+        self.assertEqual(task.skipped, 2)
+        self.assertEqual(self.clock.getDelayedCalls()[0].getTime(), self.base + 8)
+        self.pending[0].callback(None)
+        self.assertFalse(task.running)
+        self.clock.advance(1)
+        self.assertEqual(self.runs, [("a", self.base + 2), ("a", self.base + 8)])
+
+    def test_overlap_queue(self):
+        task = self.running_task('queue')
+        self.clock.pump([1] * 7)
+        self.assertEqual(len(self.runs), 1)
+        self.assertTrue(task.queued)
+        self.pending[0].callback(None)
+        self.assertEqual(self.runs, [("a", self.base + 2), ("a", self.base + 7)])
+        self.assertFalse(task.queued)
+        self.assertEqual(task.skipped, 0)
+
+    def test_overlap_allow(self):
+        task = self.running_task('allow')
+        self.clock.pump([1] * 6)
+        self.assertEqual(len(self.runs), 3)
+        self.assertEqual(task.runs, 3)
+        for d in self.pending:
+            d.callback(None)
+        self.assertEqual(task.runs, 0)
+        self.assertFalse(task.running)
+
+    @defer.inlineCallbacks
+    def test_timeout_still_running(self):
+        # the thread of a timed out run keeps the task running
+        release = threading.Event()
+        self.addCleanup(release.set)
+        executor = PluginExecutor(max_threads=2, concurrency=1, queue_depth=1, timeout=0.05)
+        executor.start()
+        self.addCleanup(executor.stop)
+        task = self.task("a", 2, func=lambda: release.wait(5))
+        task.executor = executor
+        self.manager.add_task(task)
+        self.clock.advance(2)
+        yield twisted_task.deferLater(reactor, 0.2, lambda: None)
+        self.assertEqual((task.timeouts, task.running), (1, True))
+
+        # next occurrence is skipped, not queued in the executor
+        self.clock.advance(2)
+        self.assertEqual(task.skipped, 1)
+        self.assertEqual(executor.getStats()["a"]['calls'], 1)
+
+        # the task ends with its thread
+        ended = defer.Deferred()
+        task.after_execute = lambda: ended.callback(None)
+        release.set()
+        yield ended
+        self.assertEqual((task.runs, task.running), (0, False))
+
+    @defer.inlineCallbacks
+    def test_overlap_allow_threads(self):
+        # runs over the cron threads wait, then are skipped
+        release = threading.Event()
+        self.addCleanup(release.set)
+        executor = PluginExecutor(max_threads=2, concurrency=1, queue_depth=1, timeout=0)
+        executor.start()
+        self.addCleanup(executor.stop)
+        task = self.task("a", 2, func=lambda: release.wait(5))
+        task.executor = executor
+        task.overlap = 'allow'
+        ended = []
+        task.after_execute = lambda: ended.append(None)
+        self.manager.add_task(task)
+        self.clock.pump([2] * 5)
+        stats = executor.getStats()["a"]
+        self.assertEqual((stats['running'], stats['waiting'], stats['rejected']), (2, 2, 1))
+        yield twisted_task.deferLater(reactor, 0, lambda: None)
+        self.assertEqual((task.skipped, len(ended)), (1, 1))
+
+        release.set()
+        while len(ended) < 5:
+            yield twisted_task.deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual((task.runs, task.running, executor.getStats()["a"]['calls']), (0, False, 4))
+
+    def cron(self, plugin, name, interval=5):
+        # rules start on the manager clock, not on the real time
+        start = datetime.fromtimestamp(self.clock.seconds()).strftime('%Y%m%dT%H%M%S')
+        rule = 'DTSTART:%s\nRRULE:FREQ=SECONDLY;INTERVAL=%d' % (start, interval)
+        return {'_id': ObjectId(), 'plugin': plugin, 'enabled': 1, 'name': name, 'rule': rule, 'args': None,
+                'debug': False, 'module': 'm', 'class': 'C', 'method': name, 'thread': False}
+
+    def test_reload_diff(self):
+        manager = CronTaskManager(self.manager.configuration, clock=self.clock)
+        plugin_a, plugin_b = ObjectId(), ObjectId()
+        a, b, c = self.cron(plugin_a, "a"), self.cron(plugin_a, "b"), self.cron(plugin_b, "c")
+        manager.database.crons.crons = [a, b, c]
+        manager.reload()
+        tasks = dict((task.name, task) for task in manager.tasks)
+        self.assertEqual(sorted(tasks), ["a", "b", "c"])
+
+        # unchanged crons keep their task
+        manager.reload()
+        self.assertEqual(dict((task.name, task) for task in manager.tasks), tasks)
+
+        # changed, removed and other plugins crons
+        a['rule'] = a['rule'].replace('INTERVAL=5', 'INTERVAL=7')
+        b['enabled'] = 0
+        manager.database.crons.crons.remove(c)
+        manager.reload(plugin_uid=str(plugin_a))
+        names = dict((task.name, task) for task in manager.tasks)
+        self.assertEqual(sorted(names), ["a", "c"])
+        self.assertNotIdentical(names["a"], tasks["a"])
+        self.assertIdentical(names["c"], tasks["c"])
+        manager.reload()
+        self.assertEqual([task.name for task in manager.tasks], ["a"])
+
+    def test_executor_keys(self):
+        # crons of the same name in two plugins do not share executor limits
+        manager = CronTaskManager(self.manager.configuration, clock=self.clock)
+        a, b = self.cron(ObjectId(), "a"), self.cron(ObjectId(), "a")
+        a['thread'] = b['thread'] = True
+        manager.database.crons.crons = [a, b]
+        manager.reload()
+        self.assertEqual(sorted(manager.executor.getStats()), sorted([str(a['_id']), str(b['_id'])]))
+
+    def test_save_states(self):
+        manager = CronTaskManager(self.manager.configuration, clock=self.clock)
+        a, b = self.cron(ObjectId(), "a"), self.cron(ObjectId(), "b", 3)
+        manager.database.crons.crons = [a, b]
+        manager.start()
+        self.clock.pump([1] * 9)
+        self.assertEqual(len(manager.calls), 4)
+        self.assertEqual(manager.database.cron_states.writes, 0)
+
+        # one batch with the last state of each cron, 10 seconds after the first run
+        self.clock.advance(4)
+        states = manager.database.cron_states.states
+        self.assertEqual(manager.database.cron_states.writes, 1)
+        self.assertEqual(sorted(state['_id'] for state in states), sorted([a['_id'], b['_id']]))
+        manager.stop()
+
+    def restart(self, catchup, downtime):
+        # saved state of a cron due every 5 seconds, stopped for downtime seconds
+        manager = CronTaskManager(self.manager.configuration, clock=self.clock)
+        a = self.cron(ObjectId(), "a")
+        a['catchup'] = catchup
+        manager.database.crons.crons = [a]
+        start = datetime.fromtimestamp(self.clock.seconds())
+        manager.database.cron_states.states = [{'_id': a['_id'], 'last_runtime': start, 'next_runtime': start + timedelta(seconds=5)}]
+        self.clock.advance(downtime)
+        manager.start()
+        self.addCleanup(manager.stop)
+        self.clock.advance(0)
+        return manager
+
+    def test_catchup_skip(self):
+        manager = self.restart('skip', 22)
+        self.assertEqual(manager.calls, [])
+        self.assertEqual(manager.tasks[0].last_runtime, datetime.fromtimestamp(self.base))
+
+    def test_catchup_once(self):
+        manager = self.restart('once', 22)
+        self.assertEqual(manager.calls, [("a", self.base + 22)])
+
+    def test_catchup_all(self):
+        # 4 missed runs, capped to 3, run one after the other
+        manager = self.restart('all', 22)
+        self.assertEqual(manager.calls, [("a", self.base + 22)] * 3)
+        self.assertEqual(manager.tasks[0].missed, 0)
+
+
+class LisaCronInstanceTestCase(unittest.TestCase):
+    def setUp(self):
+        # imported here, the plugin manager needs the whole server
+        from lisa.server.plugins import PluginManager as module
+        self.module = module
+        self.manager = module.PluginManager
+        self.plugin = FakePlugin("p", __name__ + ".CronPlugin")
+        self.live = CronPlugin()
+
+        # registry with one enabled plugin and its live instance
+        self.patch(self.manager, '_PluginManager__PluginsIndex', {'name': {"Cron": self.plugin}, 'pk': {"p": self.plugin}})
+        self.patch(self.manager, '_PluginManager__PluginsInstances', {"p": self.live})
+        self.patch(self.manager, '_PluginManager__CronsInstances', {})
+        CronPlugin.cleaned = 0
+
+    def test_live_instance(self):
+        self.assertIdentical(self.manager.getCronInstance("p", __name__ + ".CronPlugin"), self.live)
+        self.assertEqual(self.manager._PluginManager__CronsInstances, {})
+
+    def test_lazy_instance(self):
+        instance = self.manager.getCronInstance("p", __name__ + ".OtherCron")
+        self.assertIsInstance(instance, OtherCron)
+        self.assertEqual(instance.uid, "p")
+        self.assertIdentical(self.manager.getCronInstance("p", __name__ + ".OtherCron"), instance)
+
+        # disabled plugin : its crons classes are instantiated too
+        instance = self.manager.getCronInstance("q", __name__ + ".CronPlugin")
+        self.assertNotIdentical(instance, self.live)
+        self.assertEqual(sorted(self.manager._PluginManager__CronsInstances), [("p", __name__ + ".OtherCron"), ("q", __name__ + ".CronPlugin")])
+
+    def test_uninstall(self):
+        self.manager.getCronInstance("p", __name__ + ".OtherCron")
+        self.manager.getCronInstance("q", __name__ + ".OtherCron")
+        self.patch(self.module, 'Plugin', FakeObjects([self.plugin]))
+        self.patch(self.module, 'Cron', FakeObjects([]))
+        self.patch(self.module, 'Intent', FakeObjects([]))
+        self.patch(self.manager, '_buildRegistry', classmethod(lambda cls: None))
+
+        answer = self.manager.uninstallPlugin(plugin_name="Cron", dev_mode=True)
+        self.assertEqual(answer['status'], "success")
+        self.assertTrue(self.plugin.deleted)
+        self.assertEqual(self.manager._PluginManager__CronsInstances.keys(), [("q", __name__ + ".OtherCron")])
+        self.assertEqual(CronPlugin.cleaned, 1)
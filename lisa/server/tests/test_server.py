@@ -0,0 +1,164 @@
+from lisa.server.libs import server
+from lisa.server.libs import NeoDialog
+from lisa.server.libs.server import ClientFactory
+from lisa.server.libs.NeoDialog import NeoContext
+from lisa.server.plugins.PluginManager import ContextTemplate
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.python.failure import Failure
+from twisted.internet.error import ConnectionDone
+
+from collections import OrderedDict
+import json
+
+
+class FakePluginManager(object):
+    template = ContextTemplate()
+
+    @classmethod
+    def init(cls, global_context):
+        pass
+
+    @classmethod
+    def deinit(cls):
+        pass
+
+    @classmethod
+    def getContextTemplate(cls):
+        return cls.template
+
+
+class LisaServerTestCase(unittest.TestCase):
+    """
+    Client factory with global contexts, without plugins nor TLS
+    """
+    def setUp(self):
+        self.patch(NeoDialog, 'PluginManager', FakePluginManager)
+        self.patch(server, 'configuration', dict(server.configuration, enable_secure_mode=False))
+        self.start()
+
+    def tearDown(self):
+        self.factory.stopFactory()
+
+    def start(self):
+        self.factory = ClientFactory.get()
+        NeoContext.init(factory=self.factory)
+
+
+class LisaClientFactoryTestCase(LisaServerTestCase):
+
+    def connect(self):
+        proto = self.factory.buildProtocol(('127.0.0.1', 0))
+        proto.makeConnection(proto_helpers.StringTransport())
+        return proto
+
+    def test_zone_index(self):
+        zone_uid = ClientFactory.getOrCreateZone("Kitchen")
+        self.assertEqual(ClientFactory.getOrCreateZone("Kitchen"), zone_uid)
+        self.assertNotEqual(ClientFactory.getOrCreateZone("Bedroom"), zone_uid)
+        self.assertEqual(ClientFactory.getOrCreateZone("all"), "all")
+        self.assertEqual(self.factory._zone_index, {"Kitchen": zone_uid, "Bedroom": ClientFactory.getOrCreateZone("Bedroom")})
+        self.assertEqual(self.factory.zones[zone_uid], {'name': "Kitchen", 'client_uids': []})
+
+    def test_client_index(self):
+        client = ClientFactory.initClient(client_name="Phone", zone_name="Kitchen")
+        self.assertIdentical(ClientFactory.initClient(client_name="Phone", zone_name="Kitchen"), client)
+        other = ClientFactory.initClient(client_name="Phone", zone_name="Bedroom")
+        self.assertNotEqual(other['uid'], client['uid'])
+        self.assertEqual(self.factory._client_index, {("Phone", "Kitchen"): client['uid'], ("Phone", "Bedroom"): other['uid']})
+        self.assertIdentical(ClientFactory.getClient(client['uid']), client)
+        self.assertEqual(self.factory.zones[client['zone_uid']]['client_uids'], [client['uid']])
+        self.assertEqual(self.factory.zones[other['zone_uid']]['client_uids'], [other['uid']])
+
+    def test_relogin(self):
+        proto = self.connect()
+        proto.initClient(client_name="Phone", zone_name="Kitchen")
+        client = proto.client
+        zone_uid = client['zone_uid']
+        self.assertEqual(self.factory._zone_protocols[zone_uid], set([proto]))
+
+        # Client and zone membership are kept after disconnection
+        proto.connectionLost(Failure(ConnectionDone()))
+        self.assertEqual(client['protocols'], {})
+        self.assertEqual(self.factory._zone_protocols[zone_uid], set())
+        self.assertEqual(self.factory.zones[zone_uid]['client_uids'], [client['uid']])
+
+        # Same client on login again
+        proto = self.connect()
+        proto.initClient(client_name="Phone", zone_name="Kitchen")
+        self.assertIdentical(proto.client, client)
+        self.assertEqual(client['protocols'].keys(), [proto.uid])
+        self.assertEqual(self.factory._zone_protocols[zone_uid], set([proto]))
+        self.assertEqual(self.factory.zones[zone_uid]['client_uids'], [client['uid']])
+
+    def test_login(self):
+        proto = self.connect()
+        proto.lineReceived(json.dumps({'type': 'command', 'command': 'LOGIN REQ', 'from': u"T\xe9l\xe9phone", 'zone': u"Entr\xe9e"}))
+        answer = json.loads(proto.transport.value())
+        self.assertEqual((answer['command'], answer['to'], answer['zone']), ('login ack', u"T\xe9l\xe9phone", u"Entr\xe9e"))
+        self.assertEqual(proto.queue.name, u"client T\xe9l\xe9phone in zone Entr\xe9e")
+        self.assertIdentical(ClientFactory.getClient(proto.client['uid']), proto.client)
+
+        # Disconnection of a client with a non-ASCII name
+        proto.connectionLost(Failure(ConnectionDone()))
+        self.assertEqual(self.factory._zone_protocols[proto.client['zone_uid']], set())
+
+    def test_stop(self):
+        proto = self.connect()
+        proto.initClient(client_name="Phone", zone_name="Kitchen")
+        self.factory.stopFactory()
+        self.start()
+        self.assertEqual((self.factory._client_index, self.factory._zone_index, self.factory._zone_protocols), ({}, {}, {}))
+        client = ClientFactory.initClient(client_name="Phone", zone_name="Kitchen")
+        self.assertNotEqual(client['uid'], proto.client['uid'])
+
+
+class LisaSendToClientsTestCase(LisaServerTestCase):
+    def setUp(self):
+        LisaServerTestCase.setUp(self)
+        self.kitchen = [self.login(u"Phone", u"Kitchen"), self.login(u"Phone", u"Kitchen"), self.login(u"T\xe9l\xe9", u"Kitchen")]
+        self.bedroom = self.login(u"Phone", u"Bedroom")
+
+    def login(self, client_name, zone_name):
+        proto = self.factory.buildProtocol(('127.0.0.1', 0))
+        proto.makeConnection(proto_helpers.StringTransport())
+        proto.initClient(client_name=client_name, zone_name=zone_name)
+        return proto
+
+    def received(self, proto):
+        lines = proto.transport.value().split(proto.delimiter)[:-1]
+        proto.transport.clear()
+        return lines
+
+    def test_fan_out(self):
+        jsonData = {'type': 'chat', 'body': "hello"}
+        zone_uid = self.kitchen[0].client['zone_uid']
+        ClientFactory.sendToClients(jsonData=jsonData, client_uids=[self.kitchen[0].client['uid']], zone_uids=[zone_uid, zone_uid])
+        self.assertEqual([len(self.received(proto)) for proto in self.kitchen], [1, 1, 1])
+        self.assertEqual(self.received(self.bedroom), [])
+        self.assertEqual(jsonData, {'type': 'chat', 'body': "hello"})
+
+        # Disconnected protocols are left out
+        self.kitchen[1].connectionLost(Failure(ConnectionDone()))
+        ClientFactory.sendToClients(jsonData=jsonData, zone_uids=[zone_uid])
+        self.assertEqual([len(self.received(proto)) for proto in self.kitchen], [1, 0, 1])
+
+    def test_all(self):
+        for client_uids, zone_uids in ((['all'], []), ([], ['all'])):
+            ClientFactory.sendToClients(jsonData={'type': 'chat', 'body': "hello"}, client_uids=client_uids, zone_uids=zone_uids)
+            self.assertEqual([len(self.received(proto)) for proto in self.kitchen + [self.bedroom]], [1, 1, 1, 1])
+
+    def test_serialize(self):
+        messages = [{}, {'type': 'chat', 'body': u"\xe7a va ?"}, {'type': 'command', 'command': 'kws', 'args': [1, None, {'a': True}]},
+                    {'type': 'chat', 'from': "Plugin", 'to': "x", 'zone': "y", 'body': "hello"}]
+        proto = self.kitchen[2]
+        for jsonData in messages:
+            ClientFactory.sendToClients(jsonData=jsonData, client_uids=[proto.client['uid']])
+            line = self.received(proto)[0]
+
+            # Old per-client serialization, with destination fields first
+            old = dict(jsonData, **{'from': 'Server', 'to': proto.client['name'], 'zone': proto.client['zone']})
+            ordered = OrderedDict([('from', 'Server'), ('to', proto.client['name']), ('zone', proto.client['zone'])])
+            ordered.update(dict((k, v) for k, v in jsonData.iteritems() if k not in ordered))
+            self.assertEqual(line, json.dumps(ordered))
+            self.assertEqual(json.loads(line), json.loads(json.dumps(old)))
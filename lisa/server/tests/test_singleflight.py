@@ -0,0 +1,35 @@
+from lisa.server.libs.singleflight import SingleFlight
+from twisted.trial import unittest
+from twisted.internet import defer
+
+
+class LisaSingleFlightTestCase(unittest.TestCase):
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.requests = []
+
+    def request(self, text):
+        d = defer.Deferred()
+        self.requests.append(d)
+        return d
+
+    def test_coalesce(self):
+        d1 = self.flights.call("hello", self.request, "hello")
+        d2 = self.flights.call("hello", self.request, "hello")
+        d3 = self.flights.call("bye", self.request, "bye")
+        self.assertEqual((len(self.requests), len(self.flights)), (2, 2))
+        self.requests[0].callback({'outcome': {'intent': "hello"}})
+        r1, r2 = self.successResultOf(d1), self.successResultOf(d2)
+        self.assertEqual(r1, r2)
+        self.assertIsNot(r1, r2)
+        self.assertNoResult(d3)
+        self.assertEqual(self.flights.getStats(), {'calls': 3, 'coalesced': 1, 'in_flight': 1, 'rate': 1 / 3.0})
+
+    def test_error(self):
+        d1 = self.flights.call("hello", self.request, "hello")
+        d2 = self.flights.call("hello", self.request, "hello")
+        self.requests[0].errback(ValueError("Wit error"))
+        self.failureResultOf(d1, ValueError)
+        self.failureResultOf(d2, ValueError)
+        self.flights.call("hello", self.request, "hello")
+        self.assertEqual(len(self.requests), 2)
@@ -0,0 +1,49 @@
+from lisa.server.libs.timingwheel import TimingWheel
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+
+
+class LisaTimingWheelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.wheel = TimingWheel(resolution=1, size=8, clock=self.clock)
+        self.fired = []
+
+    def test_expire(self):
+        self.wheel.schedule(3, self.fired.append, "a")
+        self.clock.advance(2)
+        self.assertEqual(self.fired, [])
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ["a"])
+        self.assertEqual(len(self.wheel), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_cancel(self):
+        timer = self.wheel.schedule(3, self.fired.append, "a")
+        self.wheel.schedule(5, self.fired.append, "b")
+        self.assertEqual(len(self.wheel), 2)
+        self.assertTrue(timer.cancel())
+        self.assertFalse(timer.cancel())
+        self.clock.pump([1] * 5)
+        self.assertEqual(self.fired, ["b"])
+
+    def test_several_turns(self):
+        self.wheel.schedule(20, self.fired.append, "a")
+        self.wheel.schedule(4, self.fired.append, "b")
+        self.clock.pump([1] * 19)
+        self.assertEqual(self.fired, ["b"])
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ["b", "a"])
+
+    def test_late_reactor(self):
+        self.wheel.schedule(2, self.fired.append, "a")
+        self.wheel.schedule(3, self.fired.append, "b")
+        self.clock.advance(10)
+        self.assertEqual(self.fired, ["a", "b"])
+
+    def test_stop(self):
+        self.wheel.schedule(2, self.fired.append, "a")
+        self.wheel.stop()
+        self.clock.advance(5)
+        self.assertEqual(self.fired, [])
+        self.assertEqual(len(self.wheel), 0)
@@ -0,0 +1,87 @@
+from lisa.server.libs.witclient import WitClient, WitError
+from twisted.trial import unittest
+from twisted.internet import reactor, defer
+from twisted.web import server, resource
+import json
+
+
+class WitStub(resource.Resource):
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.requests = []
+        self.hold = False
+        self.code = 200
+
+    def render_GET(self, request):
+        self.requests.append(request)
+        if self.hold:
+            return server.NOT_DONE_YET
+        return self.answer(request)
+
+    def answer(self, request):
+        request.setResponseCode(self.code)
+        request.setHeader('content-type', 'application/json')
+        jsonAnswer = {'msg_body': request.args['q'][0], 'outcome': {'intent': 'hello', 'entities': {}, 'confidence': 0.9}}
+        if 'context' in request.args:
+            jsonAnswer['context'] = json.loads(request.args['context'][0])
+        return json.dumps(jsonAnswer)
+
+    def release(self):
+        for request in self.requests:
+            if not request.finished and not request._disconnected:
+                request.write(self.answer(request))
+                request.finish()
+
+
+class LisaWitClientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.stub = WitStub()
+        self.port = reactor.listenTCP(0, server.Site(self.stub), interface='127.0.0.1')
+        url = 'http://127.0.0.1:%d' % self.port.getHost().port
+        self.wit = WitClient(token="token", url=url, timeout=1, max_requests=2)
+
+    def tearDown(self):
+        self.stub.release()
+        d = self.wit.close()
+        d.addCallback(lambda _: self.port.stopListening())
+        return d
+
+    @defer.inlineCallbacks
+    def test_get_message(self):
+        answer = yield self.wit.get_message(u"allume la lumi\xe8re")
+        self.assertEqual(answer['outcome']['intent'], "hello")
+        self.assertEqual(answer['msg_body'], u"allume la lumi\xe8re")
+        self.assertEqual(self.stub.requests[0].getHeader('authorization'), "Bearer token")
+
+    @defer.inlineCallbacks
+    def test_context(self):
+        answer = yield self.wit.get_message(u"oui", {'state': 'confirm'})
+        self.assertEqual(answer['context'], {'state': 'confirm'})
+
+    def test_error(self):
+        self.stub.code = 500
+        return self.assertFailure(self.wit.get_message(u"hello"), WitError)
+
+    def test_not_an_object(self):
+        self.assertRaises(WitError, self.wit._decode, '["error"]')
+        self.assertRaises(WitError, self.wit._decode, '"error"')
+
+    def test_timeout(self):
+        self.stub.hold = True
+        return self.assertFailure(self.wit.get_message(u"hello"), WitError)
+
+    @defer.inlineCallbacks
+    def test_max_requests(self):
+        self.stub.hold = True
+        dl = [self.wit.get_message(u"hello") for i in range(3)]
+        d = defer.Deferred()
+        reactor.callLater(0.2, d.callback, None)
+        yield d
+        self.assertEqual(len(self.stub.requests), 2)
+        self.stub.hold = False
+        self.stub.release()
+        answers = yield defer.gatherResults(dl)
+        self.assertEqual(len(self.stub.requests), 3)
+        self.assertEqual(answers[2]['outcome']['intent'], "hello")
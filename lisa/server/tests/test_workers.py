@@ -0,0 +1,156 @@
+import json
+from StringIO import StringIO
+from lisa.server.libs import workers
+from lisa.server.libs.workers import WorkerServer, WorkerPool, WorkerCrashed, WorkerError
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+from twisted.internet.error import ProcessTerminated
+from twisted.python.failure import Failure
+
+
+class EchoPlugin(object):
+    def echo(self, jsonInput):
+        jsonInput['context'].count += 1
+        jsonInput['context'].speakToClient(plugin_uid=self.uid, text=jsonInput['body'])
+        return {'body': jsonInput['body']}
+
+    def question(self, jsonInput):
+        jsonInput['context'].askClient(plugin_uid=self.uid, text="Sure ?", answer_cbk=self.answer)
+
+    def answer(self, context, jsonAnswer):
+        context.count = 10
+        return jsonAnswer['body']
+
+    def error(self, jsonInput):
+        raise ValueError("plugin error")
+
+
+class FakeProcess(object):
+    pid = 42
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(json.loads(data))
+
+
+class FakeReactor(Clock):
+    def spawnProcess(self, protocol, executable, args, env, childFDs):
+        self.protocol = protocol
+        self.args = args
+        return FakeProcess()
+
+
+class FakeContext(object):
+    def __init__(self):
+        self.client = {'uid': 1, 'name': "Kitchen", 'zone': "Home", 'zone_uid': 2, 'protocols': {}}
+        self.Vars = {'count': 0}
+
+
+class LisaWorkerServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.output = StringIO()
+        self.server = WorkerServer(input=None, output=self.output)
+
+    def call(self, message):
+        message.setdefault('client', {'uid': 1})
+        message.setdefault('vars', {'count': 0})
+        start = self.output.tell()
+        self.server.handle(message)
+        self.output.seek(start)
+        return [json.loads(line) for line in self.output.read().splitlines()]
+
+    def test_call(self):
+        module = __name__ + ".EchoPlugin"
+        messages = self.call({'id': 1, 'type': 'call', 'uid': "p", 'module': module, 'method': "echo", 'input': {'body': "hello"}})
+        self.assertEqual([m['type'] for m in messages], ['speak', 'result'])
+        self.assertEqual((messages[0]['id'], messages[0]['text']), (1, "hello"))
+        self.assertEqual(messages[1]['result'], {'body': "hello"})
+        self.assertEqual(messages[1]['vars'], {'count': 1})
+
+    def test_answer(self):
+        module = __name__ + ".EchoPlugin"
+        messages = self.call({'id': 1, 'type': 'call', 'uid': "p", 'module': module, 'method': "question", 'input': {}})
+        self.assertEqual(messages[0]['type'], 'ask')
+        messages = self.call({'id': 2, 'type': 'answer', 'cbk': messages[0]['cbk'], 'input': {'body': "yes"}})
+        self.assertEqual((messages[0]['result'], messages[0]['vars']), ("yes", {'count': 10}))
+        messages = self.call({'id': 3, 'type': 'answer', 'cbk': 1, 'input': None})
+        self.assertEqual(messages[0]['type'], 'error')
+
+    def test_error(self):
+        module = __name__ + ".EchoPlugin"
+        messages = self.call({'id': 1, 'type': 'call', 'uid': "p", 'module': module, 'method': "error", 'input': {}})
+        self.assertEqual((messages[0]['type'], messages[0]['error']), ('error', "plugin error"))
+
+    def test_global_ask(self):
+        self.server.ask(text="Sure ?", zone_uids=[2])
+        self.output.seek(0)
+        message = json.loads(self.output.read())
+        self.assertEqual((message['type'], message['global'], message['cbk']), ('ask', True, None))
+        self.assertEqual((message['text'], message['zone_uids']), ("Sure ?", [2]))
+
+
+class LisaWorkerPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.speeches = []
+        self.questions = []
+        self.pool = WorkerPool(count=1, timeout=5, reactor=self.reactor,
+                               on_speak=lambda context, plugin_uid, message: self.speeches.append((plugin_uid, message['text'])),
+                               on_ask=lambda context, plugin_uid, message, answer_cbk: self.questions.append((context, plugin_uid, answer_cbk)))
+        self.pool.start()
+        self.worker = self.pool._workers[0]
+        self.context = FakeContext()
+
+    def test_result(self):
+        d = self.pool.call(plugin_uid="p", module="m", method="echo", jsonInput={'body': "hello"}, context=self.context)
+        sent = self.worker._process.written[0]
+        self.assertEqual((sent['uid'], sent['client']['name'], sent['vars']), ("p", "Kitchen", {'count': 0}))
+        self.worker._messageReceived({'type': 'speak', 'global': False, 'id': sent['id'], 'text': "hello"})
+        self.worker._messageReceived({'type': 'result', 'id': sent['id'], 'result': None, 'vars': {'count': 1}})
+        self.assertEqual(self.successResultOf(d), None)
+        self.assertEqual((self.speeches, self.context.Vars), ([("p", "hello")], {'count': 1}))
+        self.assertEqual(self.pool.getStats()[0]['pending'], 0)
+
+    def test_error(self):
+        d = self.pool.call(plugin_uid="p", module="m", method="echo", jsonInput={}, context=self.context)
+        self.worker._messageReceived({'type': 'error', 'id': 1, 'error': "plugin error", 'traceback': ""})
+        self.failureResultOf(d, WorkerError)
+
+    def test_crash(self):
+        d = self.pool.call(plugin_uid="p", module="m", method="echo", jsonInput={}, context=self.context)
+        self.worker._ended(self.reactor.protocol, Failure(ProcessTerminated(exitCode=1)))
+        self.failureResultOf(d, WorkerCrashed)
+        self.reactor.advance(1)
+        stats = self.pool.getStats()[0]
+        self.assertEqual((stats['restarts'], stats['pid']), (1, 42))
+
+    def test_global_ask(self):
+        self.pool.call(plugin_uid="p", module="m", method="question", jsonInput={}, context=self.context)
+        sent = self.worker._process.written[0]
+        self.worker._messageReceived({'type': 'ask', 'global': True, 'id': sent['id'], 'cbk': None, 'text': "Sure ?"})
+        self.assertEqual(self.questions, [(None, "p", None)])
+        self.assertEqual(self.pool._callbacks_owners, {})
+
+    def test_crash_callbacks(self):
+        d = self.pool.call(plugin_uid="p", module="m", method="question", jsonInput={}, context=self.context)
+        sent = self.worker._process.written[0]
+        self.worker._messageReceived({'type': 'ask', 'global': False, 'id': sent['id'], 'cbk': 1, 'text': "Sure ?"})
+        context, plugin_uid, answer_cbk = self.questions[0]
+        self.assertEqual((context, plugin_uid), (self.context, "p"))
+        self.assertEqual(self.pool._callbacks_owners, {(0, 1): "p"})
+
+        # The new process reuses callback ids, the old callback must not reach it
+        self.worker._ended(self.reactor.protocol, Failure(ProcessTerminated(exitCode=1)))
+        self.failureResultOf(d, WorkerCrashed)
+        self.assertEqual(self.pool._callbacks_owners, {})
+        self.reactor.advance(1)
+        self.failureResultOf(answer_cbk(context=self.context, jsonAnswer={'body': "yes"}), WorkerCrashed)
+        self.assertEqual(self.worker._process.written, [])
+
+    def test_configuration(self):
+        self.assertEqual(self.reactor.args[1:], ['-c', workers._BOOTSTRAP])
+        pool = WorkerPool(count=1, reactor=self.reactor, config_file="/etc/lisa/server/configuration/lisa.json")
+        pool.start()
+        self.assertEqual(self.reactor.args[-1], "/etc/lisa/server/configuration/lisa.json")
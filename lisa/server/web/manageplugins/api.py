@@ -95,7 +95,7 @@ class PluginResource(resources.MongoEngineResource):
 
         status = PluginManager.enablePlugin(plugin_pk=kwargs['pk'])
         self.log_throttled_access(request)
-        ClientFactory.SchedReload()
+        ClientFactory.SchedReload(plugin_uid=kwargs['pk'])
         ClientFactory.LisaReload()
         return self.create_response(request, status, HttpAccepted)
 
@@ -106,7 +106,7 @@ class PluginResource(resources.MongoEngineResource):
 
         status = PluginManager.enablePlugin(plugin_pk=kwargs['pk'])
         self.log_throttled_access(request)
-        ClientFactory.SchedReload()
+        ClientFactory.SchedReload(plugin_uid=kwargs['pk'])
         ClientFactory.LisaReload()
 
         return self.create_response(request, status, HttpAccepted)
@@ -118,7 +118,7 @@ class PluginResource(resources.MongoEngineResource):
 
         status = PluginManager.uninstallPlugin(plugin_pk=kwargs['pk'])
         self.log_throttled_access(request)
-        ClientFactory.SchedReload()
+        ClientFactory.SchedReload(plugin_uid=kwargs['pk'])
         ClientFactory.LisaReload()
         return self.create_response(request, status, HttpAccepted)
 